@@ -17,21 +17,14 @@
 # python publisher.py  --mode encrypt --service_account '../svc-publisher.json' --project_id esp-demo-197318 --pubsub_topic my-new-topic --key btetykj7jJTiCNZmmGzTtuoRNLmnBtxY
 # python publisher.py  --mode sign --service_account '../svc-publisher.json' --project_id esp-demo-197318 --pubsub_topic my-new-topic  --salt mysalt --key btetykj7jJTiCNZmmGzTtuoRNLmnBtxY
 
-import os ,sys
+import os
 import time
 import logging
 import argparse
 
-import base64, binascii
-import httplib2
-import hmac
-import canonicaljson
 import simplejson as json
 from google.cloud import pubsub
 
-from apiclient.discovery import build
-from oauth2client.client import GoogleCredentials
-
 import utils
 from utils import AESCipher, HMACFunctions
 
@@ -44,6 +37,7 @@ parser.add_argument('--service_account',required=False,help='publisher service_a
 parser.add_argument('--project_id',required=True, help='publisher projectID')
 parser.add_argument('--pubsub_topic',required=True, help='pubsub_topic to publish message')
 parser.add_argument('--key',required=True, help='key, for encryption, use 32bytes, for sign, use use complex passphrase')
+utils.add_publisher_args(parser)
 args = parser.parse_args()
 
 scope='https://www.googleapis.com/auth/pubsub'
@@ -51,18 +45,16 @@ scope='https://www.googleapis.com/auth/pubsub'
 if args.service_account != None:
   os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.service_account
 
-credentials = GoogleCredentials.get_application_default()
-if credentials.create_scoped_required():
-  credentials = credentials.create_scoped(scope)
-
-http = httplib2.Http()
-credentials.authorize(http)
-
 project_id = args.project_id
 os.environ['GOOGLE_CLOUD_PROJECT'] = project_id
 PUBSUB_TOPIC = args.pubsub_topic
 
-publisher = pubsub.PublisherClient()
+# ordered publishing; the subscription must be created with message ordering enabled
+publisher_options = pubsub.types.PublisherOptions(enable_message_ordering=args.ordering_key is not None)
+
+# one long-lived client for the whole process
+clients = utils.ClientRegistry(keepalive_ms=args.grpc_keepalive_ms)
+publisher = clients.publisher(publisher_options)
 topic_name = 'projects/{project_id}/topics/{topic}'.format(
     project_id=os.getenv('GOOGLE_CLOUD_PROJECT'),
     topic=PUBSUB_TOPIC,
@@ -71,6 +63,13 @@ topic_name = 'projects/{project_id}/topics/{topic}'.format(
 
 key = args.key
 
+metrics = utils.Metrics(scheme='symmetric', role='publisher')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds)
+profiler.attach(metrics)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
 logging.info(">>>>>>>>>>> Start <<<<<<<<<<<")
 
 cleartext_message = {
@@ -85,31 +84,42 @@ cleartext_message = {
 # cleartext_message = canonicaljson.encode_canonical_json(cleartext_message)
 # logging.info("Canonical JSON message " + cleartext_message.decode('utf-8'))
 
-if args.mode=='encrypt':
-    logging.info("Starting AES encryption")
+def publish_encrypted(cleartext_message, attributes):
+  logging.debug("Starting AES encryption")
+  with metrics.stage('aead_encrypt'):
+    msg = ac.encrypt(json.dumps(cleartext_message).encode('utf-8'),associated_data='')
+  logging.debug("End AES encryption")
+  logging.debug("Encrypted Message: " + str(msg))
+  return publisher.publish(topic_name, data=msg.encode('utf-8'), ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
 
+def publish_signed(cleartext_message, attributes):
+  logging.debug("Starting signature")
+  with metrics.stage('mac_sign'):
+    msg_hash = hh.hash(json.dumps(cleartext_message).encode('utf-8'))
+  logging.debug("End signature")
+  logging.debug("  with hmac: " + str(msg_hash))
+  return publisher.publish(topic_name, data=json.dumps(cleartext_message).encode('utf-8'), signature=msg_hash, ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
+
+if args.mode=='encrypt':
     ac = AESCipher(key)
     logging.info("Loaded Key: " + ac.printKeyInfo())
-    msg = ac.encrypt(json.dumps(cleartext_message).encode('utf-8'),associated_data='')
-    logging.info("End AES encryption")
-    logging.info("Start PubSub Publish")
-    resp=publisher.publish(topic_name, data=msg.encode('utf-8'))
-    logging.info("Published Message: " + str(msg))
-    logging.info("Published MessageID: " + resp.result())
-    logging.info("End PubSub Publish")
 
 if args.mode=='sign':
-    logging.info("Starting signature")
     hh = HMACFunctions(key)
     logging.info("Loaded Key: " + hh.printKeyInfo())
-    msg_hash = hh.hash(json.dumps(cleartext_message).encode('utf-8'))
-    logging.info("End signature")
 
+publish_message = {'encrypt': publish_encrypted, 'sign': publish_signed}[args.mode]
+
+if args.load_rate is not None:
+    utils.LoadGenerator(publish_message, args.load_rate, duration=args.load_duration, sizes=args.load_sizes,
+                        attributes=args.load_attributes, publishers=args.load_publishers).run()
+else:
     logging.info("Start PubSub Publish")
-    resp=publisher.publish(topic_name, data=json.dumps(cleartext_message).encode('utf-8'), signature=msg_hash)
+    resp = publish_message(cleartext_message, {})
+    with metrics.stage('publish'):
+      message_id = resp.result()
     logging.info("Published Message: " + json.dumps(cleartext_message))
-    logging.info("  with hmac: " + str(msg_hash))
-    logging.info("Published MessageID: " + resp.result())
+    logging.info("Published MessageID: " + message_id)
     logging.info("End PubSub Publish")
 
 logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
@@ -24,9 +24,6 @@ from google.cloud import pubsub
 import argparse
 import json
 import base64
-import httplib2
-from apiclient.discovery import build
-from oauth2client.client import Error, GoogleCredentials
 
 import utils
 from utils import AESCipher, HMACFunctions
@@ -45,6 +42,7 @@ parser.add_argument('--service_account',required=False,help='subscriber service_
 parser.add_argument('--project_id',required=True, help='subscription projectID')
 parser.add_argument('--pubsub_subscription',required=True, help='pubsub_subscription to pull from')
 parser.add_argument('--key',required=True, help='key')
+utils.add_subscriber_args(parser, negative_cache=False)
 args = parser.parse_args()
 
 logging.info(">>>>>>>>>>> Start <<<<<<<<<<<")
@@ -54,21 +52,28 @@ scope='https://www.googleapis.com/auth/pubsub'
 if args.service_account != None:
   os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.service_account
 
-credentials = GoogleCredentials.get_application_default()
-if credentials.create_scoped_required():
-  credentials = credentials.create_scoped(scope)
-
-http = httplib2.Http()
-credentials.authorize(http)
-
 project_id = args.project_id
 os.environ['GOOGLE_CLOUD_PROJECT'] = project_id
 key = args.key
 
+metrics = utils.Metrics(scheme='symmetric', role='subscriber')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds, slowest=args.trace_slowest)
+profiler.attach(metrics)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
+quarantine = utils.Quarantine(path=args.dead_letter_file, max_failures=args.max_failures, base_delay=args.nack_delay)
+
+replay_guard = None
+if args.replay_window > 0:
+  replay_guard = utils.ReplayGuard(window=args.replay_window, capacity=args.replay_capacity, error_rate=args.replay_error_rate)
+replay = utils.ReplayChecks(replay_guard, metrics)
 
 PUBSUB_SUBSCRIPTION =args.pubsub_subscription
 
-subscriber = pubsub.SubscriberClient()
+clients = utils.ClientRegistry(keepalive_ms=args.grpc_keepalive_ms)
+subscriber = clients.subscriber()
 
 subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
     project_id=os.getenv('GOOGLE_CLOUD_PROJECT'),
@@ -76,8 +81,15 @@ subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
 )
 
 def callback(message):
+  with metrics.in_flight(), profiler.trace(message.message_id):
+    process(message)
+
+def process(message):
+  if quarantine.held(message):
+    return
+  if replay.replayed(message):
+    return
   logging.info("********** Start PubsubMessage ")
-  message.ack()
   logging.info('Received message ID: {}'.format(message.message_id))
   logging.info('Received message publish_time: {}'.format(message.publish_time))
 
@@ -85,36 +97,64 @@ def callback(message):
       try:    
         ac = AESCipher(key)
         logging.info("Loaded Key: " + ac.printKeyInfo())        
-        decrypted_data = ac.decrypt(message.data,associated_data='')
-        logging.info('Decrypted data ' + decrypted_data)
+        with metrics.stage('aead_decrypt'):
+          decrypted_data = ac.decrypt_bytes(message.data,associated_data='')
+        logging.info('Decrypted data ' + decrypted_data.decode('utf-8', 'replace'))
+        if not replay.accepted(message, decrypted_data):
+          return
         logging.info("ACK message")
-        message.ack()     
+        with metrics.stage('ack'):
+          message.ack()
       except Exception as e:
         logging.info("Unable to decrypt message; NACK pubsub message " + str(e))
-        message.nack()        
+        quarantine.reject(message, str(e))
       logging.info("End AES decryption")
 
   if args.mode=='verify':
     try:
       logging.info("Starting HMAC")
       hmac = message.attributes.get('signature')
+      if hmac is None:
+        raise ValueError("no signature attribute")
       hh = HMACFunctions(key)
       logging.info("Loaded Key: " + hh.printKeyInfo())
       logging.info("Verify message: " + str(message.data))
       logging.info('  With HMAC: ' + str(hmac))
-      hashed=hh.hash(message.data)
-      if (hh.verify(message.data,base64.b64decode(hashed))):
+      with metrics.stage('mac_verify'):
+        verified = hh.verify(message.data,base64.b64decode(hmac))
+      if verified and not replay.accepted(message, message.data):
+        return
+      if (verified):
         logging.info("Message authenticity verified")
-        message.ack()
+        with metrics.stage('ack'):
+          message.ack()
       else:
         logging.error("Unable to verify message")
-        message.nack()
+        quarantine.reject(message, 'signature mismatch')
     except Exception as e:
       logging.info("Unable to verify message; NACK pubsub message " +  str(e))
-      message.nack()     
+      quarantine.reject(message, str(e))
 
   logging.info("********** End PubsubMessage ")
 
+def self_test():
+  # loads --key and runs one message through the same primitive process() uses
+  if args.mode == 'decrypt':
+    ac = AESCipher(key)
+    if ac.decrypt_bytes(ac.encrypt(b'warmup', associated_data=''), associated_data='') != b'warmup':
+      raise ValueError("AEAD self-test failed")
+  if args.mode == 'verify':
+    hh = HMACFunctions(key)
+    if not hh.verify(b'warmup', base64.b64decode(hh.hash(b'warmup'))):
+      raise ValueError("MAC self-test failed")
+
+# the first messages should not pay for the channel, the token or loading the key
+warmup = utils.Warmup(metrics)
+if not args.no_warmup:
+  warmup.add('pubsub_connect', utils.Warmup.connect, subscriber, clients.credentials(subscriber))
+  warmup.add('self_test', self_test)
+warmup.run()
+
 subscriber.subscribe(subscription_name, callback=callback)
 
 logging.info('Listening for messages on {}'.format(subscription_name))
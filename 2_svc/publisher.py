@@ -17,7 +17,6 @@
 
 import argparse
 import base64
-import binascii
 import hashlib
 import logging
 import os
@@ -25,11 +24,8 @@ import sys
 import time
 
 import google.auth
-import httplib2
-import jwt
 import requests
 import simplejson as json
-from google.auth import crypt, impersonated_credentials, jwt
 from google.auth.transport import requests as authreq
 from google.cloud import pubsub
 
@@ -45,7 +41,10 @@ parser.add_argument('--recipient',required=False, help='Service Account to encry
 parser.add_argument('--recipient_key_id',required=False, help='Service Account key_id to use')
 parser.add_argument('--project_id',required=True, help='publisher projectID')
 parser.add_argument('--pubsub_topic',required=True, help='pubsub_topic to publish message')
+parser.add_argument('--aead_template',required=False, default='AES256_GCM', choices=utils.KEY_TEMPLATES['aead'] + ['auto'], help='Tink key template of new DEKs; auto times each on this host at startup and picks the fastest')
+parser.add_argument('--wrap_format',required=False, default='compact', choices=['compact','keyset'], help='wrap only the raw key and a 6 byte header (compact), or the whole Tink keyset as older subscribers expect (keyset)')
 
+utils.add_publisher_args(parser)
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.INFO,
@@ -58,10 +57,22 @@ if args.service_account != None:
 
 credentials, project_id = google.auth.default()
 
+metrics = utils.Metrics(scheme='svc', role='publisher')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds)
+profiler.attach(metrics)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
+# ordered publishing; the subscription must be created with message ordering enabled
+publisher_options = pubsub.types.PublisherOptions(enable_message_ordering=args.ordering_key is not None)
+
 project_id = args.project_id
 os.environ['GOOGLE_CLOUD_PROJECT'] = project_id
 PUBSUB_TOPIC = args.pubsub_topic
-publisher = pubsub.PublisherClient()
+# one long-lived client for the whole process
+clients = utils.ClientRegistry(keepalive_ms=args.grpc_keepalive_ms)
+publisher = clients.publisher(publisher_options)
 topic_name = 'projects/{project_id}/topics/{topic}'.format(
   project_id=os.getenv('GOOGLE_CLOUD_PROJECT'),
   topic=PUBSUB_TOPIC,
@@ -84,11 +95,6 @@ if args.mode =="sign":
 
   logging.info(">>>>>>>>>>> Start Sign with Service Account <<<<<<<<<<<")
 
-  m = hashlib.sha256()
-  m.update(json.dumps(cleartext_message).encode())
-  data_to_sign = m.digest()
-  logging.info("data_to_sign " + base64.b64encode(data_to_sign).decode('utf-8'))
-
   if args.impersonated_service_account != None:
     # note, we can't use the normal signer here since the existing `sign_bytes()` does not return the key_id
     #  technically, we don't need to submit the key_id into the pubsub message...the subscriber could just iterate
@@ -106,42 +112,10 @@ if args.mode =="sign":
         + "/serviceAccounts/{}:signBlob"
     )
     iam_sign_endpoint = IAM_SIGN_ENDPOINT.format(args.impersonated_service_account)
-    body = {
-      "payload": base64.b64encode(data_to_sign).decode("utf-8"),
-    }    
     headers = {"Content-Type": "application/json"}
     authed_session = authreq.AuthorizedSession(credentials)
-
-    response = authed_session.post(
-        url=iam_sign_endpoint, headers=headers, json=body
-    )
-
-    data_signed = base64.b64decode(response.json()["signedBlob"])
-    service_account = args.impersonated_service_account
-    key_id = response.json()["keyId"]
   else:
-    credentials, project_id = google.auth.load_credentials_from_file(args.cert_service_account)
-    data_signed = credentials.sign_bytes(data_to_sign)
-    key_id = credentials._signer._key_id
-    service_account = credentials.signer_email
-    
-  logging.info("Signature: {}".format(base64.b64encode(data_signed).decode('utf-8')))
-  logging.info("key_id {}".format(key_id))
-  logging.info("service_account {}".format(service_account))    
-
-  logging.info("Start PubSub Publish")
-  publisher = pubsub.PublisherClient()
-  topic_name = 'projects/{project_id}/topics/{topic}'.format(
-    project_id=os.getenv('GOOGLE_CLOUD_PROJECT'),
-    topic=PUBSUB_TOPIC,
-  )
-
-  resp=publisher.publish(topic_name, data=json.dumps(cleartext_message).encode('utf-8'), 
-      key_id=key_id, service_account=service_account, signature=base64.b64encode(data_signed))
-  logging.info("Published Message: " + str(cleartext_message))
-  logging.info("Published MessageID: " + resp.result())
-  logging.info("End PubSub Publish")
-  logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
+    signer_credentials, project_id = google.auth.load_credentials_from_file(args.cert_service_account)
 
 
 if args.mode =="encrypt":
@@ -156,32 +130,88 @@ if args.mode =="encrypt":
   logging.info('  For service account at: https://www.googleapis.com/service_accounts/v1/metadata/x509/' +  args.recipient)
 
   cert_url = 'https://www.googleapis.com/service_accounts/v1/metadata/x509/' + args.recipient
-  r = requests.get(cert_url)
-  pem = r.json().get(args.recipient_key_id)
+  with metrics.stage('cert_fetch'):
+    r = requests.get(cert_url)
+    pem = r.json().get(args.recipient_key_id)
   rs = RSACipher(public_key_pem = pem)
 
-  # Create a new TINK AES key used for data encryption
-  cc = AESCipher(encoded_key=None)
+  # the DEK's key type travels in its keyset, so subscribers need no matching setting
+  aead_template = args.aead_template
+  if aead_template == 'auto':
+    aead_template = utils.fastest_template('aead')
+
+  # alternatively, dont' bother with the dek; just use the rsa key itself to encrypt the message
+  #encrypted_payload = rs.encrypt(json.dumps(cleartext_message).encode('utf-8'))
+  #resp=publisher.publish(topic_name, data=json.dumps(encrypted_payload).encode('utf-8'), service_account=args.recipient, key_id=args.recipient_key_id)
+
+def publish_signed(cleartext_message, attributes):
+  m = hashlib.sha256()
+  m.update(json.dumps(cleartext_message).encode())
+  data_to_sign = m.digest()
+  logging.debug("data_to_sign " + base64.b64encode(data_to_sign).decode('utf-8'))
+
+  if args.impersonated_service_account != None:
+    body = {
+      "payload": base64.b64encode(data_to_sign).decode("utf-8"),
+    }    
+    with metrics.stage('iam_sign'):
+      response = authed_session.post(
+          url=iam_sign_endpoint, headers=headers, json=body
+      )
+
+    data_signed = base64.b64decode(response.json()["signedBlob"])
+    service_account = args.impersonated_service_account
+    key_id = response.json()["keyId"]
+  else:
+    with metrics.stage('rsa_sign'):
+      data_signed = signer_credentials.sign_bytes(data_to_sign)
+    key_id = signer_credentials._signer._key_id
+    service_account = signer_credentials.signer_email
+    
+  logging.debug("Signature: {}".format(base64.b64encode(data_signed).decode('utf-8')))
+  logging.debug("key_id {}".format(key_id))
+  logging.debug("service_account {}".format(service_account))    
+
+  return publisher.publish(topic_name, data=json.dumps(cleartext_message).encode('utf-8'), 
+      key_id=key_id, service_account=service_account, signature=base64.b64encode(data_signed), ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
+
+def key_plaintext(encoded_key):
+  # what gets wrapped: the compact form of the DEK, unless --wrap_format keyset or the keyset has none
+  if args.wrap_format == 'compact':
+    compact = utils.compact_key(encoded_key)
+    if compact is not None:
+      return compact
+  return encoded_key.encode('utf-8')
+
+def publish_encrypted(cleartext_message, attributes):
+  # Create a new TINK key used for data encryption
+  cc = AESCipher(encoded_key=None, template=aead_template)
   dek = cc.getKey()
-  logging.info("Generated DEK: " + cc.printKeyInfo() )
+  logging.debug("Generated DEK: " + cc.printKeyInfo() )
  
   # now use the DEK to encrypt the pubsub message
-  encrypted_payload = cc.encrypt(json.dumps(cleartext_message).encode('utf-8'),associated_data="")
-  logging.info("DEK Encrypted Message: " + encrypted_payload )
+  with metrics.stage('aead_encrypt'):
+    encrypted_payload = cc.encrypt(json.dumps(cleartext_message).encode('utf-8'),associated_data="")
+  logging.debug("DEK Encrypted Message: " + encrypted_payload )
   # encrypt the DEK with the service account's key
-  dek_wrapped = rs.encrypt(dek.encode('utf-8'))
-  logging.info("Wrapped DEK " + dek_wrapped.decode('utf-8'))
+  with metrics.stage('rsa_wrap'):
+    dek_wrapped = rs.encrypt(key_plaintext(dek))
+  logging.debug("Wrapped DEK " + dek_wrapped.decode('utf-8'))
 
   # now publish the dek-encrypted message, the encrypted dek 
-  resp=publisher.publish(topic_name, data=encrypted_payload.encode('utf-8'), service_account=args.recipient, key_id=args.recipient_key_id, dek_wrapped=dek_wrapped)
+  return publisher.publish(topic_name, data=encrypted_payload.encode('utf-8'), service_account=args.recipient, key_id=args.recipient_key_id, dek_wrapped=dek_wrapped, ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
 
-  # alternatively, dont' bother with the dek; just use the rsa key itself to encrypt the message
-  #encrypted_payload = rs.encrypt(json.dumps(cleartext_message).encode('utf-8'))
-  #resp=publisher.publish(topic_name, data=json.dumps(encrypted_payload).encode('utf-8'), service_account=args.recipient, key_id=args.recipient_key_id)
+publish_message = {'encrypt': publish_encrypted, 'sign': publish_signed}[args.mode]
 
+if args.load_rate is not None:
+  utils.LoadGenerator(publish_message, args.load_rate, duration=args.load_duration, sizes=args.load_sizes,
+                      attributes=args.load_attributes, publishers=args.load_publishers).run()
+else:
   logging.info("Start PubSub Publish")
-
-  logging.info("Published Message: " + str(encrypted_payload))
-  logging.info("Published MessageID: " + resp.result())
+  resp = publish_message(cleartext_message, {})
+  with metrics.stage('publish'):
+    message_id = resp.result()
+  logging.info("Published Message: " + str(cleartext_message))
+  logging.info("Published MessageID: " + message_id)
   logging.info("End PubSub Publish")
-  logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
+logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
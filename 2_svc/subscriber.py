@@ -16,21 +16,20 @@
 
 import argparse
 import base64
-import binascii
 import hashlib
 import logging
 import os
 import sys
 import time
 
-import httplib2
 import requests
 import simplejson as json
+from expiringdict import ExpiringDict
 from google.auth import crypt
 from google.cloud import pubsub
 from google.oauth2.service_account import Credentials
-from oauth2client.client import Error, GoogleCredentials
 
+import utils
 from utils import AESCipher, RSACipher
 
 parser = argparse.ArgumentParser(description='Subscribe and verify Service Account based messages')
@@ -40,6 +39,8 @@ parser.add_argument('--cert_service_account',required=False,help='publisher serv
 parser.add_argument('--project_id',required=True, help='subscriber projectID')
 parser.add_argument('--pubsub_topic',required=True, help='pubsub_topic to publish message')
 parser.add_argument('--pubsub_subscription',required=True, help='pubsub_subscription to pull message')
+parser.add_argument('--warmup_certs',required=False, help='comma separated publisher service accounts whose certificates are fetched before subscribing')
+utils.add_subscriber_args(parser)
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.INFO,
@@ -50,19 +51,13 @@ scope='https://www.googleapis.com/auth/cloudkms https://www.googleapis.com/auth/
 if args.service_account != None:
   os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.service_account
 
-credentials = GoogleCredentials.get_application_default()
-if credentials.create_scoped_required():
-  credentials = credentials.create_scoped(scope)
-
-http = httplib2.Http()
-credentials.authorize(http)
-
 project_id = args.project_id
 os.environ['GOOGLE_CLOUD_PROJECT'] = project_id
 PUBSUB_TOPIC = args.pubsub_topic
 PUBSUB_SUBSCRIPTION = args.pubsub_subscription
 
-subscriber = pubsub.SubscriberClient()
+clients = utils.ClientRegistry(keepalive_ms=args.grpc_keepalive_ms)
+subscriber = clients.subscriber()
 topic_name = 'projects/{project_id}/topics/{topic}'.format(
     project_id=os.getenv('GOOGLE_CLOUD_PROJECT'),
     topic=PUBSUB_TOPIC,
@@ -72,9 +67,68 @@ subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
     sub=PUBSUB_SUBSCRIPTION,
 )
 
+metrics = utils.Metrics(scheme='svc', role='subscriber')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds, slowest=args.trace_slowest)
+profiler.attach(metrics)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
+quarantine = utils.Quarantine(path=args.dead_letter_file, max_failures=args.max_failures, base_delay=args.nack_delay)
+
+replay_guard = None
+if args.replay_window > 0:
+  replay_guard = utils.ReplayGuard(window=args.replay_window, capacity=args.replay_capacity, error_rate=args.replay_error_rate)
+replay = utils.ReplayChecks(replay_guard, metrics)
+
+bad_keys = utils.NegativeCache(ttl=args.negative_ttl)
+
+# certificates by (service_account, key_id), and one session so the TLS
+# connection to the certificate endpoint is reused between fetches
+certs = ExpiringDict(max_len=100, max_age_seconds=300)
+http = requests.Session()
+
+def fetch_certs(service_account):
+  # returns the HTTP status; every certificate the service account publishes is cached
+  cert_url = 'https://www.googleapis.com/service_accounts/v1/metadata/x509/' + service_account
+  with metrics.stage('cert_fetch'):
+    r = http.get(cert_url)
+    if r.status_code == 200:
+      for key_id, pem in r.json().items():
+        certs[(service_account, key_id)] = pem
+  return r.status_code
+
+def get_cert(service_account, key_id):
+  try:
+    pem = certs[(service_account, key_id)]
+    metrics.cache('cert', True)
+    return pem
+  except KeyError:
+    metrics.cache('cert', False)
+  # a key_id the service account does not publish is remembered, not fetched again
+  cert_ref = service_account + '/' + key_id
+  reason = bad_keys.get(cert_ref)
+  metrics.cache('negative', reason is not None)
+  if reason is not None:
+    raise ValueError("certificate {} is known bad: {}".format(cert_ref, reason))
+  status = fetch_certs(service_account)
+  pem = certs.get((service_account, key_id))
+  if pem is None:
+    bad_keys.add(cert_ref, 'no certificate for key_id (HTTP {})'.format(status))
+    raise KeyError("no certificate {} for {}".format(key_id, service_account))
+  return pem
+
 #subscriber.create_subscription(name=subscription_name, topic=topic_name)
 
 def callback(message):
+  with metrics.in_flight(), profiler.trace(message.message_id):
+    process(message)
+
+def process(message):
+  if quarantine.held(message):
+    return
+  if replay.replayed(message):
+    return
 
   logging.info("********** Start PubsubMessage ")
   logging.info('Received message ID: {}'.format(message.message_id))
@@ -95,21 +149,24 @@ def callback(message):
       logging.info("Verify message with signature: " + str(signature))
       logging.info("  Using service_account/key_id: " + service_account + " " + key_id )
 
-      cert_url = 'https://www.googleapis.com/service_accounts/v1/metadata/x509/' + service_account
-      r = requests.get(cert_url)
-      pem = r.json().get(key_id)
-      v = crypt.RSAVerifier.from_string(pem)
+      pem = get_cert(service_account, key_id)
+      with metrics.stage('signature_verify'):
+        v = crypt.RSAVerifier.from_string(pem)
+        verified = v.verify(data_to_verify, base64.b64decode(signature))
 
-      if v.verify(data_to_verify, base64.b64decode(signature)):
+      if verified and not replay.accepted(message, message.data):
+        return
+      if verified:
         logging.info("Message integrity verified")
-        message.ack()
+        with metrics.stage('ack'):
+          message.ack()
       else:
         logging.info("Unable to verify message")
-        message.nack()
+        quarantine.reject(message, 'signature mismatch')
       logging.info("********** End PubsubMessage ")
     except Exception as e:
       logging.info("Unable to verify message; NACK pubsub message " + str(e))
-      message.nack()
+      quarantine.reject(message, str(e))
 
   if args.mode == "decrypt":
     try:
@@ -125,41 +182,77 @@ def callback(message):
         sys.exit()
 
       credentials = Credentials.from_service_account_file(args.cert_service_account)
-      key_key_id = credentials._signer._key_id
 
       key_service_account_email = credentials.service_account_email
       if (msg_service_account != key_service_account_email):
           logging.info("Service Account specified in command line does not match message payload service account")
           logging.info(msg_service_account + " --- " + args.cert_service_account)
-          message.nack()
+          quarantine.reject(message, 'message is for another service account')
           return
       else:
         private_key = credentials._signer._key
         rs = RSACipher(private_key = private_key)
         try:
-          logging.debug('Received message attributes["dek_wrapped"]: {}'.format(message.attributes['dek_wrapped']))
-          dek_wrapped = message.attributes['dek_wrapped']
-          logging.info('Wrapped DEK ' + dek_wrapped)
-          dek_cleartext = rs.decrypt(dek_wrapped)
-          logging.info('Decrypted DEK ' + dek_cleartext)
-          dek = AESCipher(encoded_key=dek_cleartext)
-          logging.info(dek.printKeyInfo())
-          plaintext = dek.decrypt(message.data, associated_data="")
-        except ValueError:
-          logging.error("dek_wrapped not sent, attempting to decrypt with svc account rsa key")
-          plaintext = rs.decrypt(message.data)
+          dek_wrapped = message.attributes.get('dek_wrapped')
+          if dek_wrapped is None:
+            logging.error("dek_wrapped not sent, attempting to decrypt with svc account rsa key")
+            with metrics.stage('rsa_decrypt'):
+              plaintext = rs.decrypt_bytes(message.data)
+          else:
+            logging.info('Wrapped DEK ' + dek_wrapped)
+            with metrics.stage('rsa_unwrap'):
+              dek_cleartext = rs.decrypt_bytes(dek_wrapped)
+            dek = AESCipher(encoded_key=utils.expand_key(dek_cleartext))
+            logging.info(dek.printKeyInfo())
+            with metrics.stage('aead_decrypt'):
+              plaintext = dek.decrypt_bytes(message.data, associated_data="")
         except Exception as e:
           logging.error("Error Decrypting payload " + str(e))
-          message.nack()
+          quarantine.reject(message, str(e))
+          return
+        logging.info("Decrypted Message payload: " + plaintext.decode('utf-8', 'replace'))
+        if not replay.accepted(message, plaintext):
           return
-        logging.info("Decrypted Message payload: " +plaintext)
-        message.ack()
+        with metrics.stage('ack'):
+          message.ack()
     except Exception as e:
       logging.info("Unable to decrypt message; NACK pubsub message " + str(e))
-      message.nack()
+      quarantine.reject(message, str(e))
 
     logging.info("********** End PubsubMessage ")
 
+def prefetch_certs(service_account):
+  status = fetch_certs(service_account)
+  if status != 200:
+    raise ValueError("certificates for {}: HTTP {}".format(service_account, status))
+  # parses each certificate the way process() will
+  for (sa, key_id), pem in list(certs.items()):
+    if sa == service_account:
+      crypt.RSAVerifier.from_string(pem)
+
+def self_test():
+  # loads --cert_service_account's key and runs a wrapped DEK through RSACipher and AESCipher
+  if args.mode == 'decrypt' and args.cert_service_account is not None:
+    credentials = Credentials.from_service_account_file(args.cert_service_account)
+    rs = RSACipher(private_key=credentials._signer._key)
+    wrapper = RSACipher(public_key=rs.private_key.public_key())
+    dek_key = utils.compact_key(AESCipher(encoded_key=None).getKey())
+    if rs.decrypt_bytes(wrapper.encrypt(dek_key)) != dek_key:
+      raise ValueError("RSA self-test failed")
+  dek = AESCipher(encoded_key=None)
+  if dek.decrypt_bytes(dek.encrypt(b'warmup', associated_data=''), associated_data='') != b'warmup':
+    raise ValueError("AEAD self-test failed")
+
+# the first messages should not pay for the channel, the token, TLS to the certificate endpoint or loading keys
+warmup = utils.Warmup(metrics)
+if not args.no_warmup:
+  warmup.add('pubsub_connect', utils.Warmup.connect, subscriber, clients.credentials(subscriber))
+  if args.mode == 'verify' and args.warmup_certs is not None:
+    for service_account in args.warmup_certs.split(','):
+      warmup.add('cert_' + service_account, prefetch_certs, service_account)
+  warmup.add('self_test', self_test)
+warmup.run()
+
 subscriber.subscribe(subscription_name, callback=callback)
 
 logging.info('Listening for messages on {}'.format(subscription_name))
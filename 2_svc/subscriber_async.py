@@ -0,0 +1,351 @@
+#!/usr/bin/python
+
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The same as subscriber.py, on one asyncio event loop: messages are pulled with
+# the asyncio Pub/Sub client, certificates are fetched with aiohttp and the RSA
+# and AEAD work runs on a thread pool, so a slow certificate fetch holds up only
+# the messages that need that certificate.
+
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import logging
+import os
+import sys
+
+import aiohttp
+import google.auth.transport.requests
+from expiringdict import ExpiringDict
+from google.api_core import exceptions
+from google.auth import crypt
+from google.oauth2.service_account import Credentials
+
+import utils
+from utils import AESCipher, RSACipher
+
+parser = argparse.ArgumentParser(description='Subscribe and verify Service Account based messages on an asyncio event loop')
+parser.add_argument('--mode',required=True, choices=['decrypt','verify'], help='mode must be decrypt or verify')
+parser.add_argument('--service_account',required=False,help='publisher service_account credentials file for ADC')
+parser.add_argument('--cert_service_account',required=False,help='publisher service_account file to decrypt')
+parser.add_argument('--project_id',required=True, help='subscriber projectID')
+parser.add_argument('--pubsub_topic',required=True, help='pubsub_topic to publish message')
+parser.add_argument('--pubsub_subscription',required=True, help='pubsub_subscription to pull message')
+parser.add_argument('--max_in_flight',required=False, type=int, default=1000, help='messages pulled but not yet acked or nacked')
+parser.add_argument('--crypto_workers',required=False, type=int, default=os.cpu_count(), help='threads the RSA and AEAD work runs on')
+parser.add_argument('--cert_timeout',required=False, type=float, default=10, help='seconds a certificate fetch may take')
+parser.add_argument('--ack_deadline',required=False, type=int, default=60, help='seconds the ack deadline of messages being processed is extended to')
+parser.add_argument('--warmup_certs',required=False, help='comma separated publisher service accounts whose certificates are fetched before subscribing')
+utils.add_subscriber_args(parser, trace_slowest=False)
+args = parser.parse_args()
+
+if args.mode == 'decrypt' and args.cert_service_account is None:
+  parser.error('--cert_service_account must be specified to decrypt')
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+if args.service_account != None:
+  os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.service_account
+
+project_id = args.project_id
+os.environ['GOOGLE_CLOUD_PROJECT'] = project_id
+PUBSUB_SUBSCRIPTION = args.pubsub_subscription
+
+clients = utils.ClientRegistry(keepalive_ms=args.grpc_keepalive_ms)
+subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
+    project_id=os.getenv('GOOGLE_CLOUD_PROJECT'),
+    sub=PUBSUB_SUBSCRIPTION,
+)
+
+metrics = utils.Metrics(scheme='svc', role='subscriber')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds)
+# one thread interleaves every message's coroutines, so a thread-local trace would mix
+# their stages: only /profile and SIGUSR1 sampling are available here
+profiler.attach(metrics, trace=False)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
+quarantine = utils.Quarantine(path=args.dead_letter_file, max_failures=args.max_failures, base_delay=args.nack_delay)
+
+replay_guard = None
+if args.replay_window > 0:
+  replay_guard = utils.ReplayGuard(window=args.replay_window, capacity=args.replay_capacity, error_rate=args.replay_error_rate)
+replay = utils.ReplayChecks(replay_guard, metrics)
+
+bad_keys = utils.NegativeCache(ttl=args.negative_ttl)
+
+# the private key is read once here, not per message as subscriber.py does
+rs = None
+key_service_account_email = None
+if args.mode == 'decrypt':
+  credentials = Credentials.from_service_account_file(args.cert_service_account)
+  key_service_account_email = credentials.service_account_email
+  rs = RSACipher(private_key=credentials._signer._key)
+
+crypto = concurrent.futures.ThreadPoolExecutor(max_workers=args.crypto_workers, thread_name_prefix='crypto')
+
+# certificates by (service_account, key_id); the aiohttp session is created on
+# the event loop in main() and keeps the TLS connection to the certificate endpoint
+certs = ExpiringDict(max_len=100, max_age_seconds=300)
+http = None
+loop = None
+
+# the fetch in progress per service account; messages that miss the cache while
+# it runs wait for it instead of starting their own
+cert_fetches = {}
+
+async def fetch_certs(service_account):
+  # returns the HTTP status; every certificate the service account publishes is cached
+  cert_url = 'https://www.googleapis.com/service_accounts/v1/metadata/x509/' + service_account
+  with metrics.stage('cert_fetch'):
+    async with http.get(cert_url) as r:
+      if r.status == 200:
+        for key_id, pem in (await r.json(content_type=None)).items():
+          certs[(service_account, key_id)] = pem
+      return r.status
+
+def fetch_certs_once(service_account):
+  fetch = cert_fetches.get(service_account)
+  if fetch is None:
+    fetch = cert_fetches[service_account] = asyncio.ensure_future(fetch_certs(service_account))
+    fetch.add_done_callback(lambda f: cert_fetches.pop(service_account, None))
+  # a waiter that is cancelled does not cancel the fetch the others wait on
+  return asyncio.shield(fetch)
+
+async def get_cert(service_account, key_id):
+  try:
+    pem = certs[(service_account, key_id)]
+    metrics.cache('cert', True)
+    return pem
+  except KeyError:
+    metrics.cache('cert', False)
+  # a key_id the service account does not publish is remembered, not fetched again
+  cert_ref = service_account + '/' + key_id
+  reason = bad_keys.get(cert_ref)
+  metrics.cache('negative', reason is not None)
+  if reason is not None:
+    raise ValueError("certificate {} is known bad: {}".format(cert_ref, reason))
+  status = await fetch_certs_once(service_account)
+  pem = certs.get((service_account, key_id))
+  if pem is None:
+    bad_keys.add(cert_ref, 'no certificate for key_id (HTTP {})'.format(status))
+    raise KeyError("no certificate {} for {}".format(key_id, service_account))
+  return pem
+
+def verify_signature(pem, data, signature):
+  # runs on the crypto pool
+  with metrics.stage('signature_verify'):
+    v = crypt.RSAVerifier.from_string(pem)
+    return v.verify(hashlib.sha256(data).digest(), base64.b64decode(signature))
+
+def decrypt_payload(dek_wrapped, data):
+  # runs on the crypto pool
+  if dek_wrapped is None:
+    logging.error("dek_wrapped not sent, attempting to decrypt with svc account rsa key")
+    with metrics.stage('rsa_decrypt'):
+      return rs.decrypt_bytes(data)
+  with metrics.stage('rsa_unwrap'):
+    dek_cleartext = rs.decrypt_bytes(dek_wrapped)
+  dek = AESCipher(encoded_key=utils.expand_key(dek_cleartext))
+  with metrics.stage('aead_decrypt'):
+    return dek.decrypt_bytes(data, associated_data="")
+
+# messages in flight, and the condition the pull loop waits on for room
+pending = 0
+room = None
+
+# the last task per ordering key; the next message with that key waits for it
+ordering_tails = {}
+
+def schedule(message):
+  key = message.ordering_key
+  if not key:
+    return asyncio.ensure_future(handle(message))
+  task = ordering_tails[key] = asyncio.ensure_future(handle(message, ordering_tails.get(key)))
+  task.add_done_callback(lambda t: ordering_tails.pop(key) if ordering_tails.get(key) is t else None)
+  return task
+
+async def handle(message, previous=None):
+  global pending
+  try:
+    if previous is not None:
+      await asyncio.wait([previous])
+    with metrics.in_flight():
+      await process(message)
+  finally:
+    async with room:
+      pending -= 1
+      room.notify()
+
+async def process(message):
+  if quarantine.held(message):
+    return
+  if replay.replayed(message):
+    return
+
+  logging.info("********** Start PubsubMessage ")
+  logging.info('Received message ID: {}'.format(message.message_id))
+  logging.info('Received message publish_time: {}'.format(message.publish_time))
+
+  if args.mode == "verify":
+    try:
+      key_id = message.attributes['key_id']
+      service_account= message.attributes['service_account']
+      signature = message.attributes['signature']
+
+      logging.info("Verify message with signature: " + str(signature))
+      logging.info("  Using service_account/key_id: " + service_account + " " + key_id )
+
+      pem = await get_cert(service_account, key_id)
+      verified = await loop.run_in_executor(crypto, verify_signature, pem, message.data, signature)
+
+      if verified and not replay.accepted(message, message.data):
+        return
+      if verified:
+        logging.info("Message integrity verified")
+        with metrics.stage('ack'):
+          message.ack()
+      else:
+        logging.info("Unable to verify message")
+        quarantine.reject(message, 'signature mismatch')
+      logging.info("********** End PubsubMessage ")
+    except Exception as e:
+      logging.info("Unable to verify message; NACK pubsub message " + str(e))
+      quarantine.reject(message, str(e))
+
+  if args.mode == "decrypt":
+    try:
+      key_id = message.attributes['key_id']
+      msg_service_account= message.attributes['service_account']
+
+      logging.info("  Using service_account/key_id: " + msg_service_account + " " + key_id )
+
+      if (msg_service_account != key_service_account_email):
+        logging.info("Service Account specified in command line does not match message payload service account")
+        logging.info(msg_service_account + " --- " + args.cert_service_account)
+        quarantine.reject(message, 'message is for another service account')
+        return
+      try:
+        plaintext = await loop.run_in_executor(crypto, decrypt_payload, message.attributes.get('dek_wrapped'), message.data)
+      except Exception as e:
+        logging.error("Error Decrypting payload " + str(e))
+        quarantine.reject(message, str(e))
+        return
+      logging.info("Decrypted Message payload: " + plaintext.decode('utf-8', 'replace'))
+      if not replay.accepted(message, plaintext):
+        return
+      with metrics.stage('ack'):
+        message.ack()
+    except Exception as e:
+      logging.info("Unable to decrypt message; NACK pubsub message " + str(e))
+      quarantine.reject(message, str(e))
+
+    logging.info("********** End PubsubMessage ")
+
+async def pull(client, acker):
+  global pending
+  backoff = 1
+  while True:
+    async with room:
+      await room.wait_for(lambda: pending < args.max_in_flight)
+      max_messages = min(1000, args.max_in_flight - pending)
+    try:
+      with metrics.stage('pull', count_errors=False):
+        response = await client.pull(subscription=subscription_name, max_messages=max_messages)
+    except exceptions.DeadlineExceeded:
+      # pull returns DeadlineExceeded when nothing arrived in time
+      logging.debug("Pull returned no messages")
+      await asyncio.sleep(1)
+      continue
+    except Exception as e:
+      # eg PermissionDenied or NotFound: these do not clear up by pulling again at once
+      logging.warning("Pull failed, retrying in {}s: {}".format(backoff, e))
+      await asyncio.sleep(backoff)
+      backoff = min(backoff * 2, 60)
+      continue
+    backoff = 1
+    pending += len(response.received_messages)
+    for received in response.received_messages:
+      schedule(utils.PulledMessage(received, acker))
+
+def on_loop(coroutine_function, *args):
+  # warm-up checks run on a worker thread; this runs a coroutine on the event loop and waits for it
+  return asyncio.run_coroutine_threadsafe(coroutine_function(*args), loop).result()
+
+async def channel_ready(client, timeout=10):
+  await asyncio.wait_for(client.transport.grpc_channel.channel_ready(), timeout)
+
+def connect(client):
+  # opens the gRPC channel and fetches its access token, so the first pull pays for neither
+  on_loop(channel_ready, client)
+  credentials = clients.credentials(client)
+  if credentials is not None and not credentials.valid:
+    credentials.refresh(google.auth.transport.requests.Request())
+
+def prefetch_certs(service_account):
+  status = on_loop(fetch_certs, service_account)
+  if status != 200:
+    raise ValueError("certificates for {}: HTTP {}".format(service_account, status))
+  # parses each certificate the way process() will
+  for (sa, key_id), pem in list(certs.items()):
+    if sa == service_account:
+      crypt.RSAVerifier.from_string(pem)
+
+def self_test():
+  # runs a wrapped DEK through RSACipher and AESCipher with --cert_service_account's key
+  if rs is not None:
+    wrapper = RSACipher(public_key=rs.private_key.public_key())
+    dek_key = utils.compact_key(AESCipher(encoded_key=None).getKey())
+    if rs.decrypt_bytes(wrapper.encrypt(dek_key)) != dek_key:
+      raise ValueError("RSA self-test failed")
+  dek = AESCipher(encoded_key=None)
+  if dek.decrypt_bytes(dek.encrypt(b'warmup', associated_data=''), associated_data='') != b'warmup':
+    raise ValueError("AEAD self-test failed")
+
+async def main():
+  global http, loop, room
+  loop = asyncio.get_running_loop()
+  room = asyncio.Condition()
+  http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=args.cert_timeout))
+  client = clients.async_subscriber()
+  acker = utils.AsyncAcker(client, subscription_name, lease_seconds=args.ack_deadline)
+
+  # the checks block, so they run on a worker thread while the loop serves their fetches
+  warmup = utils.Warmup(metrics)
+  if not args.no_warmup:
+    warmup.add('pubsub_connect', connect, client)
+    if args.mode == 'verify' and args.warmup_certs is not None:
+      for service_account in args.warmup_certs.split(','):
+        warmup.add('cert_' + service_account, prefetch_certs, service_account)
+    warmup.add('self_test', self_test)
+  await loop.run_in_executor(None, warmup.run)
+
+  acks = asyncio.ensure_future(acker.run())
+  logging.info('Listening for messages on {}'.format(subscription_name))
+  try:
+    await pull(client, acker)
+  finally:
+    acks.cancel()
+    await http.close()
+
+try:
+  asyncio.run(main())
+except KeyboardInterrupt:
+  sys.exit(0)
+logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
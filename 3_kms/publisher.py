@@ -15,34 +15,36 @@
 # limitations under the License.
 
 
-import os ,sys
+import os
 import time
 import logging
 import argparse
 import hashlib
 
 from google.cloud import pubsub
-from google.cloud import kms
 
-
-import jwt
 import simplejson as json
-import base64, binascii
-import httplib2
+import base64
+
+import utils
 
 parser = argparse.ArgumentParser(description='Publish encrypted message with KMS only')
-parser.add_argument('--mode',required=True, choices=['encrypt','sign'], help='mode must be encrypt or sign')
+parser.add_argument('--mode',required=True, choices=['encrypt','sign','asymmetric_sign'], help='mode must be encrypt, sign or asymmetric_sign')
 parser.add_argument('--service_account',required=False,help='publisher service_account credentials file')
 parser.add_argument('--project_id',required=True, help='publisher service_acount credentials file')
 parser.add_argument('--pubsub_topic',required=True, help='pubsub_topic to publish message')
 parser.add_argument('--kms_location_id',required=True, help='KMS kms_location_id (eg, us-central1)')
 parser.add_argument('--kms_key_ring_id',required=True, help='KMS kms_key_ring_id (eg, mykeyring)')
 parser.add_argument('--kms_crypto_key_id',required=True, help='KMS kms_crypto_key_id (eg, key1)')
-parser.add_argument('--kms_crypto_key_version',required=False, help='KMS kms_crypto_key_version; required for mode=sign ')
+parser.add_argument('--kms_crypto_key_version',required=False, help='KMS kms_crypto_key_version; required for mode=sign and mode=asymmetric_sign')
 parser.add_argument('--tenantID',required=False, default="tenantKey", help='Optional additionalAuthenticatedData')
 
+utils.add_publisher_args(parser, grpc_pool=True)
 args = parser.parse_args()
 
+if args.mode == 'asymmetric_sign' and args.kms_crypto_key_version is None:
+  parser.error('--kms_crypto_key_version is required for mode=asymmetric_sign')
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
 
@@ -61,7 +63,19 @@ kms_crypto_key_id = args.kms_crypto_key_id
 kms_crypto_key_version = args.kms_crypto_key_version
 tenantID = args.tenantID
 
-kms_client = kms.KeyManagementServiceClient()
+# long-lived KMS and Pub/Sub clients, shared by every publish
+clients = utils.ClientRegistry(channels=args.grpc_channels, keepalive_ms=args.grpc_keepalive_ms, max_streams=args.grpc_max_streams)
+kms_client = clients.kms()
+
+metrics = utils.Metrics(scheme='kms', role='publisher')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds)
+profiler.attach(metrics)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
+# ordered publishing; the subscription must be created with message ordering enabled
+publisher_options = pubsub.types.PublisherOptions(enable_message_ordering=args.ordering_key is not None)
 
 if kms_crypto_key_version is not None:
     name = 'projects/{}/locations/{}/keyRings/{}/cryptoKeys/{}/cryptoKeyVersions/{}'.format(
@@ -82,42 +96,63 @@ cleartext_message = {
     }
 }
 
-publisher = pubsub.PublisherClient()
+publisher = clients.publisher(publisher_options)
 topic_name = 'projects/{project_id}/topics/{topic}'.format(
     project_id=os.getenv('GOOGLE_CLOUD_PROJECT'),
     topic=PUBSUB_TOPIC,
 )
 
-if args.mode=='encrypt':
-    logging.info("Start KMS encryption API call")
+def publish_encrypted(cleartext_message, attributes):
+  logging.debug("Start KMS encryption API call")
+  with metrics.stage('kms_encrypt'):
     encrypt_response = kms_client.encrypt(
         request={'name': name, 'plaintext': json.dumps(cleartext_message).encode('utf-8'), 'additional_authenticated_data': tenantID.encode('utf-8')  })
-    logging.info("End KMS encryption API call")
+  logging.debug("End KMS encryption API call")
+  logging.debug("Encrypted Message: " + base64.b64encode(encrypt_response.ciphertext).decode())
+  return publisher.publish(topic_name, data=base64.b64encode(encrypt_response.ciphertext), kms_key=name, ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
 
-    logging.info("Start PubSub Publish")
-    resp=publisher.publish(topic_name, data=base64.b64encode(encrypt_response.ciphertext), kms_key=name)
-    logging.info("Published Message: " + base64.b64encode(encrypt_response.ciphertext).decode())
-    logging.info("Published MessageID: " + resp.result())
-    logging.info("End PubSub Publish")
-
-if args.mode=='sign':
-    logging.info("Start KMS mac API call")
+def publish_mac_signed(cleartext_message, attributes):
+  logging.debug("Start KMS mac API call")
 
-    m = hashlib.sha256()
-    m.update(json.dumps(cleartext_message).encode())
-    data_to_sign = m.digest()
-    logging.info("data_to_sign " + base64.b64encode(data_to_sign).decode('utf-8'))
+  m = hashlib.sha256()
+  m.update(json.dumps(cleartext_message).encode())
+  data_to_sign = m.digest()
+  logging.debug("data_to_sign " + base64.b64encode(data_to_sign).decode('utf-8'))
 
+  with metrics.stage('kms_mac_sign'):
     mac_response = kms_client.mac_sign(
         request={'name': name, 'data': data_to_sign })
-    logging.info("End KMS mac API call")
-
-    logging.info("MAC: " + base64.b64encode(mac_response.mac).decode())
-    
+  logging.debug("End KMS mac API call")
+  logging.debug("MAC: " + base64.b64encode(mac_response.mac).decode())
+  return publisher.publish(topic_name, data=json.dumps(cleartext_message).encode('utf-8'), kms_key=name, signature=base64.b64encode(mac_response.mac).decode(), ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
+
+# EC_SIGN_P256_SHA256 or RSA_SIGN_PSS_*_SHA256 key; subscribers verify with the cached public key
+def publish_asymmetric_signed(cleartext_message, attributes):
+  logging.debug("Start KMS asymmetric sign API call")
+  data = json.dumps(cleartext_message).encode('utf-8')
+  data_to_sign = hashlib.sha256(data).digest()
+  logging.debug("data_to_sign " + base64.b64encode(data_to_sign).decode('utf-8'))
+
+  with metrics.stage('kms_asymmetric_sign'):
+    sign_response = kms_client.asymmetric_sign(
+        request={'name': name, 'digest': {'sha256': data_to_sign}})
+  logging.debug("End KMS asymmetric sign API call")
+  logging.debug("Signature: " + base64.b64encode(sign_response.signature).decode())
+  return publisher.publish(topic_name, data=data, kms_key=name, signature=base64.b64encode(sign_response.signature).decode(),
+                           signature_type='asymmetric_sign', ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
+
+publish_message = {'encrypt': publish_encrypted, 'sign': publish_mac_signed, 'asymmetric_sign': publish_asymmetric_signed}[args.mode]
+
+if args.load_rate is not None:
+    utils.LoadGenerator(publish_message, args.load_rate, duration=args.load_duration, sizes=args.load_sizes,
+                        attributes=args.load_attributes, publishers=args.load_publishers).run()
+else:
     logging.info("Start PubSub Publish")
-    resp=publisher.publish(topic_name, data=json.dumps(cleartext_message).encode('utf-8'), kms_key=name, signature=base64.b64encode(mac_response.mac).decode())
-    logging.info("Published MessageID: " + resp.result())
-    logging.info("End PubSub Publish")    
+    resp = publish_message(cleartext_message, {})
+    with metrics.stage('publish'):
+      message_id = resp.result()
+    logging.info("Published MessageID: " + message_id)
+    logging.info("End PubSub Publish")
 
 
 logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
@@ -17,16 +17,18 @@
 import os
 import time
 import argparse
+import threading
+from google.api_core import exceptions
 from google.cloud import pubsub
-from google.cloud import kms
 
 import json
 import base64
-import httplib2
 import hashlib
 
 import logging
 
+import utils
+
 parser = argparse.ArgumentParser(description='Publish encrypted message with KMS only')
 parser.add_argument('--mode',required=True, choices=['decrypt','verify'], help='mode must be decrypt or verify')
 parser.add_argument('--service_account',required=False,help='publisher service_acount credentials file')
@@ -34,7 +36,10 @@ parser.add_argument('--project_id',required=True, help='publisher service_acount
 parser.add_argument('--pubsub_topic',required=True, help='pubsub_topic to publish message')
 parser.add_argument('--pubsub_subscription',required=True, help='pubsub_subscription to pull message')
 parser.add_argument('--tenantID',required=False, default="tenantKey", help='Optional additionalAuthenticatedData')
+parser.add_argument('--kms_keys',required=True, help='comma separated KMS keys, or key versions, a message may name in its kms_key attribute; a key covers all its versions')
+parser.add_argument('--warmup_keys',required=False, help='comma separated asymmetric signing key versions whose public keys are fetched before subscribing')
 
+utils.add_subscriber_args(parser, grpc_pool=True)
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.INFO,
@@ -52,11 +57,13 @@ PUBSUB_TOPIC = args.pubsub_topic
 PUBSUB_SUBSCRIPTION = args.pubsub_subscription
 
 tenantID = args.tenantID
+kms_keys = args.kms_keys.split(',')
 
 
-kms_client = kms.KeyManagementServiceClient()
+clients = utils.ClientRegistry(channels=args.grpc_channels, keepalive_ms=args.grpc_keepalive_ms, max_streams=args.grpc_max_streams)
+kms_client = clients.kms()
 
-subscriber = pubsub.SubscriberClient()
+subscriber = clients.subscriber()
 topic_name = 'projects/{project_id}/topics/{topic}'.format(
     project_id=os.getenv('GOOGLE_CLOUD_PROJECT'),
     topic=PUBSUB_TOPIC,
@@ -66,35 +73,99 @@ subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
     sub=PUBSUB_SUBSCRIPTION,
 )
 
+metrics = utils.Metrics(scheme='kms', role='subscriber')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds, slowest=args.trace_slowest)
+profiler.attach(metrics)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
+quarantine = utils.Quarantine(path=args.dead_letter_file, max_failures=args.max_failures, base_delay=args.nack_delay)
+
+replay_guard = None
+if args.replay_window > 0:
+  replay_guard = utils.ReplayGuard(window=args.replay_window, capacity=args.replay_capacity, error_rate=args.replay_error_rate)
+replay = utils.ReplayChecks(replay_guard, metrics)
+
+bad_keys = utils.NegativeCache(ttl=args.negative_ttl)
+
+# errors about the key itself; retrying the message will not fix them
+KEY_ERRORS = (exceptions.NotFound, exceptions.PermissionDenied, exceptions.FailedPrecondition)
+
+def kms_call(stage, method, request):
+  name = request['name']
+  reason = bad_keys.get(name)
+  metrics.cache('negative', reason is not None)
+  if reason is not None:
+    raise ValueError("KMS key {} is known bad: {}".format(name, reason))
+  try:
+    with metrics.stage(stage):
+      return method(request=request)
+  except KEY_ERRORS as e:
+    bad_keys.add(name, str(e))
+    raise
+
+# public keys of asymmetric signing key versions; a version's key never changes
+verifiers = {}
+verifiers_lock = threading.Lock()
+
+def get_verifier(name):
+  verifier = verifiers.get(name)
+  metrics.cache('public_key', verifier is not None)
+  if verifier is None:
+    with verifiers_lock:
+      verifier = verifiers.get(name)
+      if verifier is None:
+        public_key = kms_call('kms_get_public_key', kms_client.get_public_key, {'name': name})
+        verifier = verifiers[name] = utils.AsymmetricVerifier(public_key.pem, public_key.algorithm.name)
+  return verifier
+
+def message_kms_key(message):
+  name = message.attributes['kms_key']
+  if not utils.kms_key_allowed(name, kms_keys):
+    raise ValueError("KMS key {} is not one of --kms_keys".format(name))
+  return name
+
 #subscriber.create_subscription(name=subscription_name, topic=topic_name)
 
 def callback(message):
+  with metrics.in_flight(), profiler.trace(message.message_id):
+    process(message)
+
+def process(message):
+  if quarantine.held(message):
+    return
+  if replay.replayed(message):
+    return
 
   logging.info("********** Start PubsubMessage ")
   logging.info('Received message ID: {}'.format(message.message_id))
   logging.info('Received message publish_time: {}'.format(message.publish_time))
-  logging.info('Received message attributes["kms_key"]: {}'.format(message.attributes['kms_key']))
-  name = message.attributes['kms_key']
+  logging.info('Received message attributes["kms_key"]: {}'.format(message.attributes.get('kms_key')))
 
   if args.mode=='decrypt':
       try:
+        name = message_kms_key(message)
         logging.info("Starting KMS decryption API call")
 
-        decrypted_message = kms_client.decrypt(
-            request={'name': name, 'ciphertext': base64.b64decode(message.data), 'additional_authenticated_data': tenantID.encode('utf-8')  })
+        decrypted_message = kms_call('kms_decrypt', kms_client.decrypt,
+            {'name': name, 'ciphertext': base64.b64decode(message.data), 'additional_authenticated_data': tenantID.encode('utf-8')  })
 
-        dec =  base64.b64decode(decrypted_message.plaintext)
         logging.info("End KMS decryption API call")
         logging.info('Decrypted data ' + decrypted_message.plaintext.decode('utf-8'))
-        message.ack()
+        if not replay.accepted(message, decrypted_message.plaintext):
+          return
+        with metrics.stage('ack'):
+          message.ack()
         logging.info("ACK message")
       except Exception as e:
         logging.info("Unable to decrypt message; NACK pubsub message " + str(e))
-        message.nack()
+        quarantine.reject(message, str(e))
       logging.info("End AES decryption")
 
   if args.mode=='verify':
     try:
+      name = message_kms_key(message)
       logging.info("Starting HMAC")
       hmac = message.attributes.get('signature')
 
@@ -106,20 +177,40 @@ def callback(message):
       logging.info("data_to_verify " + base64.b64encode(data_to_verify).decode('utf-8'))
       logging.info('  With HMAC: ' + str(hmac))
 
-      verification_message = kms_client.mac_verify(
-            request={'name': name, 'data': data_to_verify, 'mac': base64.b64decode(hmac)  })
-      if verification_message.success:
+      if message.attributes.get('signature_type') == 'asymmetric_sign':
+        # only the first message per key version calls KMS; verification is local
+        verifier = get_verifier(name)
+        with metrics.stage('signature_verify'):
+          verified = verifier.verify(data_to_verify, base64.b64decode(hmac))
+      else:
+        verification_message = kms_call('kms_mac_verify', kms_client.mac_verify,
+              {'name': name, 'data': data_to_verify, 'mac': base64.b64decode(hmac)  })
+        verified = verification_message.success
+      if verified and not replay.accepted(message, message.data):
+        return
+      if verified:
         logging.info("MAC verified ")
-        message.ack()
+        with metrics.stage('ack'):
+          message.ack()
       else:
         logging.info("Mac verification failed; NACK pubsub message")
-        message.nack()        
+        quarantine.reject(message, 'signature mismatch')
     except Exception as e:
       logging.info("Unable to verify message; NACK pubsub message " + str(e))
-      message.nack()
+      quarantine.reject(message, str(e))
 
   logging.info("********** End PubsubMessage ")
 
+# the first messages should not pay for the KMS and Pub/Sub channels, the token or public key fetches
+warmup = utils.Warmup(metrics)
+if not args.no_warmup:
+  warmup.add('pubsub_connect', utils.Warmup.connect, subscriber, clients.credentials(subscriber))
+  warmup.add('kms_connect', utils.Warmup.connect, kms_client, clients.credentials(kms_client))
+  if args.mode == 'verify' and args.warmup_keys is not None:
+    for name in args.warmup_keys.split(','):
+      warmup.add('public_key_' + name, get_verifier, name)
+warmup.run()
+
 subscriber.subscribe(subscription_name, callback=callback)
 
 logging.info('Listening for messages on {}'.format(subscription_name))
@@ -0,0 +1,31 @@
+#!/bin/python
+
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# everything here lives in common/ at the top of the repository, shared by every scheme;
+# this module re-exports what 3_kms uses so the scripts keep running from this directory
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.cli import add_publisher_args, add_subscriber_args
+from common.metrics import Metrics, Profiler
+from common.load import LoadGenerator, ordering_key
+from common.delivery import NegativeCache, Quarantine, Warmup
+from common.replay import ReplayChecks, ReplayGuard, stamped
+from common.clients import ClientRegistry
+from common.asymmetric import AsymmetricVerifier, kms_key_allowed
@@ -1,23 +1,21 @@
 #!/usr/bin/python
 
-import os ,sys
+import io
+import os
 import time
 import logging
+import threading
 
 from google.cloud import pubsub
-from google.cloud import kms
 import argparse
-import jwt
 import simplejson as json
-import time
-import base64, binascii
-import httplib2
+import base64
 
 
 from expiringdict import ExpiringDict
 
 import utils
-from utils import AESCipher, RSACipher, HMACFunctions
+from utils import AESCipher, HMACFunctions, StreamingCipher
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -32,8 +30,36 @@ parser.add_argument('--kms_key_id',required=True, help='KMS keyid')
 parser.add_argument('--pubsub_project_id',required=True, help='publisher projectID')
 parser.add_argument('--pubsub_topic',required=True, help='pubsub_topic to publish message')
 parser.add_argument('--tenantID',required=False, default="tenantKey", help='Optional additionalAuthenticatedData')
+parser.add_argument('--wrapped_key_messages',required=False, type=int, default=0, help='attach the wrapped key only to the first N messages after each rotation (0: every message)')
+parser.add_argument('--wrapped_key_refresh',required=False, type=float, default=10, help='with --wrapped_key_messages, attach the wrapped key again once it has not been sent for N seconds; keep it below the subscribers\' 20s key TTL')
+parser.add_argument('--control_topic',required=False, help='Optional topic to announce each wrapped key on before it is used')
+parser.add_argument('--derive_keys',required=False, action='store_true', help='wrap one master secret per rotation and derive per-tenant keys locally with HKDF')
+parser.add_argument('--key_window_seconds',required=False, type=int, default=0, help='with --derive_keys, also derive a new key every N seconds (0: one key per rotation)')
+parser.add_argument('--announce_lead_seconds',required=False, type=float, default=2, help='how long to wait after announcing the first key before using it; with --load_rotate_seconds, also how long before a rotation the next key is announced')
+parser.add_argument('--offload_bytes',required=False, type=int, default=0, help='stream-encrypt payloads larger than N bytes to --blob_dir and publish only a reference (0: never)')
+parser.add_argument('--blob_dir',required=False, default='blobs', help='blob store for --offload_bytes: a local directory, or gs://bucket/prefix')
+parser.add_argument('--field_schema',required=False, help='Optional JSON schema file: encrypt only its sensitive fields and publish its routing fields as clear attributes (mode=encrypt)')
+parser.add_argument('--aggregate_bytes',required=False, type=int, default=0, help='load generator: pack records into frames of up to N bytes, encrypted and published as one message (0: one record per message)')
+parser.add_argument('--aggregate_records',required=False, type=int, default=500, help='with --aggregate_bytes, maximum records per frame')
+parser.add_argument('--aggregate_latency',required=False, type=float, default=0.05, help='with --aggregate_bytes, seconds a record may wait for its frame to fill')
+parser.add_argument('--load_rotate_seconds',required=False, type=float, default=0, help='load generator: wrap a new key every N seconds (0: one key for the whole run)')
+parser.add_argument('--aead_template',required=False, default='AES256_GCM', choices=utils.KEY_TEMPLATES['aead'] + ['auto'], help='Tink key template of new DEKs; auto times each on this host at startup and picks the fastest')
+parser.add_argument('--mac_template',required=False, default='HMAC_SHA256_256BITTAG', choices=utils.KEY_TEMPLATES['mac'] + ['auto'], help='Tink key template of new signing keys; auto times each on this host at startup and picks the fastest')
+parser.add_argument('--wrap_format',required=False, default='compact', choices=['compact','keyset'], help='wrap only the raw key and a 6 byte header (compact), or the whole Tink keyset as older subscribers expect (keyset)')
+utils.add_publisher_args(parser, grpc_pool=True)
 args = parser.parse_args()
 
+if args.field_schema is not None and (args.mode != 'encrypt' or args.aggregate_bytes > 0):
+  parser.error('--field_schema needs mode=encrypt and cannot be combined with --aggregate_bytes')
+if args.aggregate_bytes > 0 and args.load_rate is None:
+  parser.error('--aggregate_bytes packs load generator records; it needs --load_rate')
+if args.aggregate_bytes > 0 and args.offload_bytes > 0 and args.aggregate_bytes >= args.offload_bytes:
+  parser.error('--aggregate_bytes must be below --offload_bytes; frames are not offloaded')
+if args.wrapped_key_messages > 0 and args.control_topic is None:
+  parser.error('--wrapped_key_messages needs --control_topic: subscribers that miss the first messages after a rotation, eg other replicas, get the key from the announcement')
+if args.derive_keys and (args.aead_template != 'AES256_GCM' or args.mac_template != 'HMAC_SHA256_256BITTAG'):
+  parser.error('--derive_keys always derives AES256_GCM and HMAC_SHA256_256BITTAG keys; --aead_template and --mac_template do not apply')
+
 scope='https://www.googleapis.com/auth/cloudkms https://www.googleapis.com/auth/pubsub'
 
 if args.service_account != None:
@@ -49,33 +75,276 @@ tenantID = args.tenantID
 PUBSUB_TOPIC=args.pubsub_topic
 
 cache = ExpiringDict(max_len=100, max_age_seconds=20)
+# wrapped keys attached to a message in the last --wrapped_key_refresh seconds
+wrapped_sent = ExpiringDict(max_len=100, max_age_seconds=args.wrapped_key_refresh)
+
+metrics = utils.Metrics(scheme='kms_dek', role='publisher')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds)
+profiler.attach(metrics)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
+# ordered publishing; the subscription must be created with message ordering enabled
+publisher_options = pubsub.types.PublisherOptions(enable_message_ordering=args.ordering_key is not None)
+
+# one long-lived client each for KMS and Pub/Sub; the control topic shares the data publisher's batches and connection
+clients = utils.ClientRegistry(channels=args.grpc_channels, keepalive_ms=args.grpc_keepalive_ms, max_streams=args.grpc_max_streams)
+kms_client = clients.kms()
+publisher = clients.publisher(publisher_options)
+topic_name = 'projects/{project_id}/topics/{topic}'.format(
+  project_id=pubsub_project_id,
+  topic=PUBSUB_TOPIC,
+)
 
-
-kms_client = kms.KeyManagementServiceClient()
 name = 'projects/{}/locations/{}/keyRings/{}/cryptoKeys/{}'.format(
         kms_project_id, location_id, key_ring_id, crypto_key_id)
 
-if args.mode =="sign":
+control_topic_name = None
+if args.control_topic is not None:
+  control_publisher = publisher
+  control_topic_name = 'projects/{project_id}/topics/{topic}'.format(
+    project_id=pubsub_project_id,
+    topic=args.control_topic,
+  )
+
+def key_plaintext(encoded_key):
+  # what gets wrapped: the compact form of the key, unless --wrap_format keyset or the keyset has none
+  if args.wrap_format == 'compact':
+    compact = utils.compact_key(encoded_key)
+    if compact is not None:
+      return compact
+  return encoded_key.encode('utf-8')
+
+def wrap_key(plaintext, aad=None):
+  if aad is None:
+    aad = tenantID
+  logging.info("Starting KMS encryption API call")
+  with metrics.stage('kms_wrap'):
+    encrypt_response = kms_client.encrypt(
+        request={'name': name, 'plaintext': plaintext, 'additional_authenticated_data': aad.encode('utf-8')  })
+  logging.info("End KMS encryption API call")
+  wrapped =  base64.b64encode(encrypt_response.ciphertext).decode('utf-8')
+  return wrapped, utils.wrapped_key_id(wrapped)
+
+# the key type travels in the wrapped keyset, so subscribers need no matching setting
+aead_template = args.aead_template
+if aead_template == 'auto' and args.mode == 'encrypt':
+  aead_template = utils.fastest_template('aead')
+mac_template = args.mac_template
+if mac_template == 'auto' and args.mode == 'sign':
+  mac_template = utils.fastest_template('mac')
+
+def rotate_sign_key():
+  hh = HMACFunctions(encoded_key=None, template=mac_template)
+  sign_key = hh.getKey()
+  logging.info(hh.printKeyInfo())
+  logging.debug("Generated hmac: " + sign_key )
+  hh_encrypted, sign_key_id = wrap_key(key_plaintext(sign_key))
+  logging.info("Wrapped hmac key: " +  hh_encrypted)
+  logging.info("Wrapped hmac key id: " +  sign_key_id)
+  return hh, hh_encrypted, sign_key_id
+
+def rotate_dek():
+  # create a new TINK DEK and encrypt it with KMS.
+  #  (i.,e an encrypted tink keyset)
+  cc = AESCipher(encoded_key=None, template=aead_template)
+  dek = cc.getKey()
+  logging.info(cc.printKeyInfo())
+  logging.debug("Generated dek: " + dek )
+  dek_encrypted, dek_id = wrap_key(key_plaintext(dek))
+  logging.info("Wrapped dek: " +  dek_encrypted)
+  logging.info("Wrapped dek id: " +  dek_id)
+  return cc, dek_encrypted, dek_id
+
+def rotate_master():
+  # one KMS call per rotation regardless of how many tenants or windows use it
+  master_secret = utils.new_master_secret()
+  master_wrapped, master_id = wrap_key(master_secret.encode('utf-8'), aad=utils.MASTER_SECRET_AAD)
+  logging.info("Wrapped master secret: " +  master_wrapped)
+  logging.info("Wrapped master secret id: " +  master_id)
+  return master_secret, master_wrapped, master_id
+
+def key_window():
+  if args.key_window_seconds == 0:
+    return 0
+  return int(time.time() // args.key_window_seconds)
+
+def derived_key(master_secret, master_id, key_type):
+  window = key_window()
+  try:
+    return cache[(master_id, key_type, window)], window
+  except KeyError:
+    encoded_key = utils.derived_keyset(master_secret, key_type, tenantID, window)
+    if key_type == 'aead':
+      derived = AESCipher(encoded_key=encoded_key)
+    else:
+      derived = HMACFunctions(encoded_key=encoded_key)
+    logging.info("Derived {} key for tenant {} window {}".format(key_type, tenantID, window))
+    cache[(master_id, key_type, window)] = derived
+    return derived, window
+
+blob_store = None
+if args.offload_bytes > 0:
+  blob_store = utils.open_blob_store(args.blob_dir)
+
+def encrypt_payload(cipher, plaintext, associated_data=None):
+  # returns the message data and any attributes it needs besides the key ones
+  if blob_store is None or len(plaintext) <= args.offload_bytes:
+    with metrics.stage('aead_encrypt'):
+      return cipher.encrypt(plaintext,associated_data=associated_data or tenantID), {}
+  # claim check: the payload goes to the blob store under its own streaming key,
+  # and the message only carries that key encrypted with the DEK
+  sc = StreamingCipher(encoded_key=None)
+  ref = blob_store.new_ref()
+  epoch_time = str(int(time.time()))
+  with metrics.stage('blob_put'):
+    with blob_store.writer(ref) as f:
+      digest = sc.encrypt_stream(io.BytesIO(plaintext), f, utils.blob_aad(tenantID, ref, epoch_time))
+  with metrics.stage('aead_encrypt'):
+    encrypted_key = cipher.encrypt(sc.getKey().encode('utf-8'),associated_data=tenantID)
+  logging.debug("Offloaded {} bytes to blob {}".format(len(plaintext), ref))
+  return encrypted_key, {'blob_ref': ref, 'blob_sha256': digest, 'epoch_time': epoch_time}
+
+field_schema = None
+if args.field_schema is not None:
+  with open(args.field_schema) as f:
+    field_schema = utils.FieldSchema(json.load(f))
+
+def encrypt_message(cipher, message, associated_data=None):
+  # message is the cleartext dict, or an already serialized frame of records
+  if isinstance(message, bytes):
+    return encrypt_payload(cipher, message, associated_data)
+  if field_schema is None:
+    return encrypt_payload(cipher, json.dumps(message).encode('utf-8'))
+  # the data stays a JSON document; only the sensitive fields in it are ciphertext
+  with metrics.stage('field_encrypt'):
+    return field_schema.encrypt(cipher, json.loads(json.dumps(message)), tenantID)
+
+def announce(key_type, wrapped, key_id):
+  # let subscribers unwrap the key before the first data message needs it
+  if control_topic_name is None:
+    return
+  resp = control_publisher.publish(control_topic_name, data=b'', key_type=key_type, key_id=key_id, kms_key=name, key_wrapped=wrapped, tenant=tenantID)
+  logging.info("Announced {} {} on control topic: {}".format(key_type, key_id, resp.result()))
+
+def key_attributes(key_type, wrapped, key_id, window, y):
+  # subscribers index their cache by the short key id; the wrapped key itself
+  # is only needed until they have unwrapped it once.  It is sent again every
+  # --wrapped_key_refresh seconds for subscribers that started after the
+  # announcement and the first messages
+  if key_type == 'master':
+    attributes = {'master_id': key_id, 'key_window': str(window)}
+  else:
+    attributes = {key_type + '_id': key_id}
+  # lets a multi-tenant subscriber (--tenant_attribute tenant) pick the tenant before any crypto
+  attributes['tenant'] = tenantID
+  if args.wrapped_key_messages == 0 or y < args.wrapped_key_messages or key_id not in wrapped_sent:
+    attributes['kms_key'] = name
+    attributes[key_type + '_wrapped'] = wrapped
+    wrapped_sent[key_id] = True
+  return attributes
+
+# with --derive_keys KMS wraps a master secret, and the DEK or signing key is derived from it
+if args.derive_keys:
+  rotate = rotate_master
+  key_type = 'master'
+else:
+  rotate = {'encrypt': rotate_dek, 'sign': rotate_sign_key}[args.mode]
+  key_type = {'encrypt': 'dek', 'sign': 'sign_key'}[args.mode]
+
+if args.load_rate is not None:
+  logging.info(">>>>>>>>>>> Start load generator <<<<<<<<<<<")
+  derived_type = {'encrypt': 'aead', 'sign': 'mac'}[args.mode]
+
+  # the key in use, when it expires, how many messages have used it, and the
+  # key after it once that has been wrapped and announced
+  load_key = {'key': None, 'expires': 0, 'sent': 0, 'next': None, 'preparing': False}
+  load_key_lock = threading.Lock()
+
+  def prepare_next_key():
+    # the KMS wrap and the announcement block, so they run on their own thread, outside load_key_lock
+    next_key = None
+    try:
+      next_key = rotate()
+      announce(key_type, next_key[1], next_key[2])
+    finally:
+      # after a failure the next current_key() call tries again
+      with load_key_lock:
+        load_key['next'] = next_key
+        load_key['preparing'] = False
+
+  def current_key():
+    with load_key_lock:
+      now = time.time()
+      if args.load_rotate_seconds > 0:
+        # announce the next key --announce_lead_seconds before it is used, at most a rotation ahead
+        if load_key['next'] is None and not load_key['preparing'] and now >= load_key['expires'] - args.announce_lead_seconds:
+          load_key['preparing'] = True
+          threading.Thread(target=prepare_next_key, name='next_key', daemon=True).start()
+        # until the next key is ready the current one stays in use, rather than switch to an unannounced key
+        if now >= load_key['expires'] and load_key['next'] is not None:
+          load_key['key'], load_key['next'] = load_key['next'], None
+          load_key['expires'] = now + args.load_rotate_seconds
+          load_key['sent'] = 0
+      load_key['sent'] += 1
+      return load_key['key'], load_key['sent'] - 1
+
+  load_key['key'] = rotate()
+  announce(key_type, load_key['key'][1], load_key['key'][2])
+  if control_topic_name is not None:
+    time.sleep(args.announce_lead_seconds)
+  load_key['expires'] = time.time() + args.load_rotate_seconds
+
+  def publish_message(cleartext_message, attributes):
+    (primitive, wrapped, key_id), y = current_key()
+    window = None
+    if args.derive_keys:
+      primitive, window = derived_key(primitive, key_id, derived_type)
+    attributes = dict(key_attributes(key_type, wrapped, key_id, window, y), **attributes)
+    # a frame's record count is covered by the AEAD or MAC, so the records attribute cannot be changed or dropped
+    count = attributes.get('records')
+    if args.mode == 'encrypt':
+      associated_data = None if count is None else utils.frame_aad(tenantID, count)
+      encrypted_message, extra_attributes = encrypt_message(primitive, cleartext_message, associated_data)
+      attributes.update(extra_attributes)
+      return publisher.publish(topic_name, data=encrypted_message.encode(), ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
+    data = cleartext_message if isinstance(cleartext_message, bytes) else json.dumps(cleartext_message).encode('utf-8')
+    with metrics.stage('mac_sign'):
+      msg_hash = primitive.hash(data if count is None else utils.signed_frame(tenantID, count, data))
+    return publisher.publish(topic_name, data=data, signature=msg_hash, ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
+
+  if args.aggregate_bytes > 0:
+    # one encryption or signature, one set of key attributes and one Pub/Sub message per frame;
+    # the records attribute tells subscribers to unpack it
+    aggregator = utils.RecordAggregator(lambda frame, count: publish_message(frame, {'records': str(count)}),
+                                        max_bytes=args.aggregate_bytes, max_records=args.aggregate_records,
+                                        max_latency=args.aggregate_latency)
+
+  def publish_record(cleartext_message, attributes):
+    return aggregator.add(json.dumps(cleartext_message).encode('utf-8'))
+
+  utils.LoadGenerator(publish_record if args.aggregate_bytes > 0 else publish_message, args.load_rate, duration=args.load_duration, sizes=args.load_sizes,
+                      attributes=args.load_attributes, publishers=args.load_publishers).run()
+  logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
+elif args.mode =="sign":
   logging.info(">>>>>>>>>>> Start Sign with with locally generated key. <<<<<<<<<<<")
+  sign_key = rotate()
+  announce(key_type, sign_key[1], sign_key[2])
+  if control_topic_name is not None:
+    time.sleep(args.announce_lead_seconds)
   for x in range(5):
 
         logging.info("Rotating key")
+        hh, hh_encrypted, sign_key_id = sign_key
 
-        hh = HMACFunctions(encoded_key=None)
-        sign_key = hh.getKey()
-        logging.info(hh.printKeyInfo())
-        logging.debug("Generated hmac: " + sign_key )
-        logging.info("Starting KMS encryption API call")
-        encrypt_response = kms_client.encrypt(
-            request={'name': name, 'plaintext': sign_key.encode('utf-8'), 'additional_authenticated_data': tenantID.encode('utf-8')  })
+        # with a control topic, the next key is wrapped and announced while this one is in use
+        next_sign_key = None
+        if control_topic_name is not None and x < 4:
+          next_sign_key = rotate()
+          announce(key_type, next_sign_key[1], next_sign_key[2])
 
-        hh_encrypted =  base64.b64encode(encrypt_response.ciphertext).decode('utf-8')  
-
-        logging.info("Wrapped hmac key: " +  hh_encrypted)
-        logging.info("End KMS encryption API call")
-        publisher = pubsub.PublisherClient()
-
-        for x in range(5):
+        for y in range(5):
                 cleartext_message = {
                         "data" : "foo".encode(),
                         "attributes" : {
@@ -86,58 +355,57 @@ if args.mode =="sign":
                         }
                 }
 
-                msg_hash = hh.hash(json.dumps(cleartext_message).encode('utf-8'))
+                window = None
+                signer = hh
+                if args.derive_keys:
+                  signer, window = derived_key(hh, sign_key_id, 'mac')
+                with metrics.stage('mac_sign'):
+                  msg_hash = signer.hash(json.dumps(cleartext_message).encode('utf-8'))
                 logging.debug("Generated Signature: " + msg_hash.decode('utf-8'))
                 logging.debug("End signature")
 
                 logging.info("Start PubSub Publish")
 
-                topic_name = 'projects/{project_id}/topics/{topic}'.format(
-                project_id=pubsub_project_id,
-                topic=PUBSUB_TOPIC,
-                )
-
-                resp=publisher.publish(topic_name, data=json.dumps(cleartext_message).encode('utf-8'), kms_key=name, sign_key_wrapped=hh_encrypted, signature=msg_hash)
+                attributes = key_attributes(key_type, hh_encrypted, sign_key_id, window, y)
+                with metrics.stage('publish'):
+                  resp=publisher.publish(topic_name, data=json.dumps(cleartext_message).encode('utf-8'), signature=msg_hash, ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
+                  message_id = resp.result()
                 logging.info("Published Message: " + str(cleartext_message))
                 logging.info(" with key_id: " + name)
-                logging.debug(" with wrapped signature key " + hh_encrypted )
-                logging.info("Published MessageID: " + resp.result())
+                logging.debug(" with attributes " + str(attributes))
+                logging.info("Published MessageID: " + message_id)
 
                 logging.debug("End PubSub Publish")
                 time.sleep(1)
-  logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
 
-if args.mode =="encrypt":
+        if x < 4:
+          sign_key = next_sign_key or rotate()
+  logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
+elif args.mode =="encrypt":
     logging.info(">>>>>>>>>>> Start Encryption with locally generated key.  <<<<<<<<<<<")
     ## Send pubsub messages using two different symmetric keys
     ## Note, i'm not using the expiringdict here...i'm just picking a DEK, sending N messages using it
     ## then picking another DEK and sending N messages with that one.
     ## The subscriber will use a cache of DEK values.  If it detects a DEK in the metadata that doesn't 
     ## match whats in its cache, it will use KMS to try to decode it and then keep it in its cache.
+    ## With --control_topic, each DEK is also announced ahead of time so subscribers can unwrap it early.
+    ## With --derive_keys, KMS wraps a master secret instead and the DEK is derived from it with HKDF.
+    dek = rotate()
+    announce(key_type, dek[1], dek[2])
+    if control_topic_name is not None:
+        time.sleep(args.announce_lead_seconds)
     for x in range(5):
         logging.info("Rotating symmetric key")
+        cc, dek_encrypted, dek_id = dek
 
-        # create a new TINK AES DEK and encrypt it with KMS.
-        #  (i.,e an encrypted tink keyset)
-        cc = AESCipher(encoded_key=None)
-        dek = cc.getKey()
-        logging.info(cc.printKeyInfo())
-
-        logging.debug("Generated dek: " + dek )
-        logging.info("Starting KMS encryption API call")
-        encrypt_response = kms_client.encrypt(
-            request={'name': name, 'plaintext': dek.encode('utf-8'), 'additional_authenticated_data': tenantID.encode('utf-8')  })
-
-        dek_encrypted =  base64.b64encode(encrypt_response.ciphertext).decode('utf-8')  
-
-        logging.info("Wrapped dek: " +  dek_encrypted)
-        logging.info("End KMS encryption API call")
+        next_dek = None
+        if control_topic_name is not None and x < 4:
+            next_dek = rotate()
+            announce(key_type, next_dek[1], next_dek[2])
 
-
-        publisher = pubsub.PublisherClient()
         logging.info("Start PubSub Publish")
          ## Send 5 messages using the same symmetric key...
-        for x in range(5):
+        for y in range(5):
                 cleartext_message = {
                         "data" : "foo".encode(),
                         "attributes" : {
@@ -147,19 +415,25 @@ if args.mode =="encrypt":
                                 'b': "bbb"
                         }
                 }
+                window = None
+                cipher = cc
+                if args.derive_keys:
+                  cipher, window = derived_key(cc, dek_id, 'aead')
                 logging.debug("Start AES encryption")
-                encrypted_message = cc.encrypt(json.dumps(cleartext_message).encode('utf-8'),associated_data=tenantID)
+                encrypted_message, extra_attributes = encrypt_message(cipher, cleartext_message)
                 logging.debug("End AES encryption")
                 logging.debug("Encrypted Message with dek: " + encrypted_message)
 
-                topic_name = 'projects/{project_id}/topics/{topic}'.format(
-                        project_id=pubsub_project_id,
-                        topic=PUBSUB_TOPIC,
-                )
-
-                resp=publisher.publish(topic_name, data=encrypted_message.encode(), kms_key=name, dek_wrapped=dek_encrypted)
+                attributes = key_attributes(key_type, dek_encrypted, dek_id, window, y)
+                attributes.update(extra_attributes)
+                with metrics.stage('publish'):
+                  resp=publisher.publish(topic_name, data=encrypted_message.encode(), ordering_key=utils.ordering_key(args.ordering_key, attributes), **utils.stamped(attributes))
+                  message_id = resp.result()
                 logging.info("Published Message: " + encrypted_message)
-                logging.info("Published MessageID: " + resp.result())
+                logging.info("Published MessageID: " + message_id)
                 time.sleep(1)
+
+        if x < 4:
+            dek = next_dek or rotate()
     logging.info("End PubSub Publish")
     logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
@@ -2,14 +2,16 @@
 
 import os
 import time
+from google.api_core import exceptions
 from google.cloud import pubsub
-from google.cloud import kms
 import argparse
 import simplejson as json
 import base64
-import httplib2
+import threading
 
-from utils import AESCipher, HMACFunctions, RSACipher
+import utils
+from utils import AESCipher, HMACFunctions, RSACipher, PersistentKeyCache, TenantKeys, TenantScheduler
+import tink
 
 from expiringdict import ExpiringDict
 
@@ -26,8 +28,27 @@ parser.add_argument('--pubsub_project_id',required=True, help='subscriber PubSub
 parser.add_argument('--pubsub_topic',required=True, help='pubsub_topic to publish message')
 parser.add_argument('--pubsub_subscription',required=True, help='pubsub_subscription to pull message')
 parser.add_argument('--tenantID',required=False, default="tenantKey", help='Optional additionalAuthenticatedData')
+parser.add_argument('--tenant_attribute',required=False, help='Optional message attribute to read the tenant from instead of --tenantID (eg, tenant)')
+parser.add_argument('--tenants',required=False, help='with --tenant_attribute, comma separated tenants to accept with optional weights (eg, A:3,B,C:2)')
+parser.add_argument('--tenant_workers',required=False, type=int, default=4, help='with --tenant_attribute, number of decrypt worker threads')
+parser.add_argument('--tenant_cache_size',required=False, type=int, default=100, help='maximum cached keys per tenant')
+parser.add_argument('--control_subscription',required=False, help='Optional subscription to the publisher key announcement topic')
+parser.add_argument('--dek_cache_file',required=False, help='Optional SQLite file to share unwrapped keys between subscribers on this host')
+parser.add_argument('--dek_cache_kek_uri',required=False, help='with --dek_cache_file, Cloud KMS key (gcp-kms://...) that encrypts the key-encryption key kept in --dek_cache_kek_file')
+parser.add_argument('--dek_cache_kek_file',required=False, help='with --dek_cache_kek_uri, where the encrypted key-encryption key is kept (default: <dek_cache_file>.kek); without it, a cleartext Tink keyset you provide, mode 0600')
+parser.add_argument('--dek_cache_ttl',required=False, type=int, help='seconds a key stays in --dek_cache_file after it was unwrapped (default: --rotation_seconds)')
+parser.add_argument('--rotation_seconds',required=False, type=int, default=3600, help='how often the publishers wrap a new key')
+parser.add_argument('--read_fields',required=False, help='with field-level encrypted messages, comma separated fields to decrypt (default: all encrypted fields)')
+parser.add_argument('--route',required=False, help='Optional comma separated attribute=value pairs; other messages are acked without any crypto (eg, b=bbb)')
+parser.add_argument('--blob_dir',required=False, help='Optional blob store to read offloaded payloads from: a local directory, or gs://bucket/prefix')
+parser.add_argument('--delete_blobs',required=False, action='store_true', help='delete an offloaded payload once its message is acked; only when this is the topic\'s only subscription')
+parser.add_argument('--warmup_keys',required=False, help='Optional JSON lines file of key announcements to unwrap before subscribing')
+utils.add_subscriber_args(parser, grpc_pool=True)
 args = parser.parse_args()
 
+if args.dek_cache_file is not None and args.dek_cache_kek_uri is None and args.dek_cache_kek_file is None:
+  parser.error('--dek_cache_file needs --dek_cache_kek_uri or --dek_cache_kek_file')
+
 scope='https://www.googleapis.com/auth/cloudkms https://www.googleapis.com/auth/pubsub'
 
 if args.service_account != None:
@@ -40,9 +61,10 @@ tenantID = args.tenantID
 PUBSUB_TOPIC = args.pubsub_topic
 PUBSUB_SUBSCRIPTION = args.pubsub_subscription
 
-kms_client = kms.KeyManagementServiceClient()
+clients = utils.ClientRegistry(channels=args.grpc_channels, keepalive_ms=args.grpc_keepalive_ms, max_streams=args.grpc_max_streams)
+kms_client = clients.kms()
 
-subscriber = pubsub.SubscriberClient()
+subscriber = clients.subscriber()
 topic_name = 'projects/{project_id}/topics/{topic}'.format(
     project_id=pubsub_project_id,
     topic=PUBSUB_TOPIC,
@@ -52,55 +74,319 @@ subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
     sub=PUBSUB_SUBSCRIPTION,
 )
 
-cache = ExpiringDict(max_len=100, max_age_seconds=20)
+metrics = utils.Metrics(scheme='kms_dek', role='subscriber')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds, slowest=args.trace_slowest)
+profiler.attach(metrics)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
+# each tenant gets its own bounded key cache and rolling keysets
+tenant_keys = {}
+tenant_keys_lock = threading.Lock()
+# unwrapped master secrets for publishers using --derive_keys; shared by all tenants
+masters = ExpiringDict(max_len=100, max_age_seconds=20)
+
+tenant_weights = None
+if args.tenants is not None:
+  tenant_weights = {}
+  for t in args.tenants.split(','):
+    tenant, _, weight = t.partition(':')
+    tenant_weights[tenant] = int(weight or 1)
+
+scheduler = None
+if args.tenant_attribute is not None:
+  scheduler = TenantScheduler(workers=args.tenant_workers, weights=tenant_weights)
+
+quarantine = utils.Quarantine(path=args.dead_letter_file, max_failures=args.max_failures, base_delay=args.nack_delay)
+
+replay_guard = None
+if args.replay_window > 0:
+  replay_guard = utils.ReplayGuard(window=args.replay_window, capacity=args.replay_capacity, error_rate=args.replay_error_rate)
+replay = utils.ReplayChecks(replay_guard, metrics)
+
+bad_keys = utils.NegativeCache(ttl=args.negative_ttl)
+
+# KMS errors that retrying the same wrapped key will not fix
+KEY_ERRORS = (exceptions.InvalidArgument, exceptions.NotFound, exceptions.PermissionDenied, exceptions.FailedPrecondition)
+
+def get_tenant_keys(tenant):
+  keys = tenant_keys.get(tenant)
+  if keys is None:
+    with tenant_keys_lock:
+      keys = tenant_keys.get(tenant)
+      if keys is None:
+        keys = TenantKeys(tenant, max_len=args.tenant_cache_size, max_age_seconds=20)
+        tenant_keys[tenant] = keys
+  return keys
+
+persistent_cache = None
+if args.dek_cache_file is not None:
+  persistent_cache = PersistentKeyCache(args.dek_cache_file, kek_path=args.dek_cache_kek_file, kek_uri=args.dek_cache_kek_uri,
+                                        max_age_seconds=args.dek_cache_ttl or args.rotation_seconds)
+
+def unwrap_key(key_id, name, wrapped, aad):
+  # warm restarts: another subscriber on this host may have already unwrapped this key
+  cache_key = aad + '/' + key_id
+  if persistent_cache is not None:
+    encoded_key = persistent_cache.get(cache_key)
+    metrics.cache('persistent', encoded_key is not None)
+    if encoded_key is not None:
+      logging.info("Using DEK from on-host cache")
+      return encoded_key
+  if wrapped is None or name is None:
+    raise KeyError("key id {} is not cached and the message does not carry the wrapped key".format(key_id))
+  if utils.wrapped_key_id(wrapped) != key_id:
+    raise ValueError("key id {} does not match the wrapped key".format(key_id))
+  # a wrapped key KMS refused (bad ciphertext, wrong tenant, disabled key) fails locally until it expires
+  reason = bad_keys.get(cache_key)
+  metrics.cache('negative', reason is not None)
+  if reason is not None:
+    raise ValueError("wrapped key {} is known bad: {}".format(key_id, reason))
+  logging.info(">>>>>>>>>>>>>>>>   Starting KMS decryption API call")
+  try:
+    with metrics.stage('kms_unwrap'):
+      decrypted_message = kms_client.decrypt(
+          request={'name': name, 'ciphertext': base64.b64decode(wrapped.encode('utf-8')), 'additional_authenticated_data': aad.encode('utf-8')  })
+  except KEY_ERRORS as e:
+    bad_keys.add(cache_key, str(e))
+    raise
+  logging.info("End KMS decryption API call")
+  if persistent_cache is not None:
+    persistent_cache.put(cache_key, decrypted_message.plaintext)
+  return decrypted_message.plaintext
+
+def load_key(keys, keyset, key_id, name, wrapped):
+  # returns False if the key was already loaded
+  try:
+    if keyset.contains(keys.cache[key_id]):
+      logging.info("Using Cached DEK")
+      return False
+  except KeyError:
+    pass
+  encoded_key = utils.expand_key(unwrap_key(key_id, name, wrapped, aad=keys.tenant))
+  keys.cache[key_id] = keyset.add(encoded_key)
+  logging.info("Added key {} to rolling keyset of tenant {}".format(key_id, keys.tenant))
+  return True
+
+def load_master(master_id, name, master_wrapped):
+  try:
+    master_secret = masters[master_id]
+    metrics.cache('master', True)
+    # a master secret expires 20s after it was last needed, not after it was unwrapped
+    masters[master_id] = master_secret
+    return master_secret
+  except KeyError:
+    metrics.cache('master', False)
+    master_secret = unwrap_key(master_id, name, master_wrapped, aad=utils.MASTER_SECRET_AAD).decode('utf-8')
+    masters[master_id] = master_secret
+    return master_secret
+
+def load_derived_key(keys, keyset, key_type, master_id, window, name, master_wrapped):
+  # per-tenant (and per-window) keys are derived locally; KMS only ever sees the master secret
+  derived_id = '{}/{}/{}'.format(master_id, key_type, window)
+  try:
+    if keyset.contains(keys.cache[derived_id]):
+      logging.info("Using Cached DEK")
+      return False
+  except KeyError:
+    pass
+  master_secret = load_master(master_id, name, master_wrapped)
+  keys.cache[derived_id] = keyset.add(utils.derived_keyset(master_secret, key_type, keys.tenant, window))
+  logging.info("Derived {} key for tenant {} window {}".format(key_type, keys.tenant, window))
+  return True
+
+def load_message_key(keys, message, keyset, key_type, prefix):
+  attributes = message.attributes
+  name = attributes.get('kms_key')
+  if 'master_id' in attributes:
+    return load_derived_key(keys, keyset, key_type, attributes['master_id'], attributes.get('key_window', '0'), name, attributes.get('master_wrapped'))
+  wrapped = attributes.get(prefix + '_wrapped')
+  # older publishers only send the wrapped key
+  key_id = attributes.get(prefix + '_id') or utils.wrapped_key_id(wrapped)
+  return load_key(keys, keyset, key_id, name, wrapped)
+
+blob_store = None
+if args.blob_dir is not None:
+  blob_store = utils.open_blob_store(args.blob_dir)
+
+def read_blob(attributes, encoded_key, tenant):
+  # the message carried the blob's streaming key.  The payload comes back as a temporary
+  # file, once every segment and the digest at the end of the blob checked out
+  if blob_store is None:
+    raise ValueError("message payload is in blob {} but --blob_dir is not set".format(attributes['blob_ref']))
+  with metrics.stage('blob_get'):
+    payload = utils.open_blob(blob_store, encoded_key, tenant, attributes)
+  logging.info("Read {} bytes from blob {}".format(os.fstat(payload.fileno()).st_size, attributes['blob_ref']))
+  return payload
+
+def delete_blob(message):
+  # only with --delete_blobs: another subscription to the topic may still need the blob
+  if args.delete_blobs and 'blob_ref' in message.attributes:
+    with metrics.stage('blob_delete'):
+      blob_store.delete(message.attributes['blob_ref'])
+
+read_fields = None
+if args.read_fields is not None:
+  read_fields = set(args.read_fields.split(','))
+
+route = {}
+if args.route is not None:
+  route = dict(r.split('=', 1) for r in args.route.split(','))
+
+def routed(message):
+  # routing fields are clear attributes, so this needs no key and no decryption
+  return all(message.attributes.get(k) == v for k, v in route.items())
+
+def decrypt_message_fields(keys, message):
+  # the seal covers the whole document, so its clear fields are trusted even when no field is read
+  document = json.loads(message.data)
+  fields = [f for f in message.attributes['encrypted_fields'].split(',') if f and (read_fields is None or f in read_fields)]
+  try:
+    with metrics.stage('field_decrypt', count_errors=False):
+      utils.check_field_seal(keys.dek_keyset, message.data, message.attributes, keys.tenant)
+      document = utils.decrypt_fields(keys.dek_keyset, document, fields, keys.tenant)
+    metrics.cache('keyset', True)
+  except tink.TinkError:
+    metrics.cache('keyset', False)
+    if not load_message_key(keys, message, keys.dek_keyset, 'aead', 'dek'):
+      raise
+    with metrics.stage('field_decrypt'):
+      utils.check_field_seal(keys.dek_keyset, message.data, message.attributes, keys.tenant)
+      document = utils.decrypt_fields(keys.dek_keyset, document, fields, keys.tenant)
+  return document
+
+def payload_aad(tenant, attributes):
+  # frames authenticate their record count: a changed or stripped records attribute fails to decrypt
+  if 'records' in attributes:
+    return utils.frame_aad(tenant, attributes['records'])
+  return tenant
+
+def signed_data(tenant, message):
+  if 'records' in message.attributes:
+    return utils.signed_frame(tenant, message.attributes['records'], message.data)
+  return message.data
+
+def message_records(data, attributes):
+  # aggregated messages carry a frame of length-prefixed records, handed on one at a time
+  if 'records' not in attributes:
+    return [data]
+  with metrics.stage('unpack'):
+    records = utils.unpack_records(data)
+  if len(records) != int(attributes['records']):
+    raise ValueError("frame holds {} records, expected {}".format(len(records), attributes['records']))
+  return records
+
+def message_tenant(message):
+  return attributes_tenant(message.attributes)
+
+def attributes_tenant(attributes):
+  if args.tenant_attribute is None:
+    return tenantID
+  tenant = attributes.get(args.tenant_attribute)
+  if tenant is None:
+    raise KeyError("message has no {} attribute".format(args.tenant_attribute))
+  if tenant_weights is not None and tenant not in tenant_weights:
+    raise KeyError("tenant {} is not accepted by this subscriber".format(tenant))
+  return tenant
 
 #subscriber.create_subscription(name=subscription_name, topic=topic_name)
 
+def load_announced_key(attributes):
+  # key announcements: unwrap the next key into the cache before data messages use it
+  key_type = attributes['key_type']
+  key_id = attributes['key_id']
+  logging.info("Received key announcement {} {}".format(key_type, key_id))
+  if key_type == 'dek' and args.mode == "decrypt":
+    keys = get_tenant_keys(attributes_tenant(attributes))
+    load_key(keys, keys.dek_keyset, key_id, attributes['kms_key'], attributes['key_wrapped'])
+  if key_type == 'sign_key' and args.mode == "verify":
+    keys = get_tenant_keys(attributes_tenant(attributes))
+    load_key(keys, keys.sign_keyset, key_id, attributes['kms_key'], attributes['key_wrapped'])
+  if key_type == 'master':
+    load_master(key_id, attributes['kms_key'], attributes['key_wrapped'])
+
+def control_callback(message):
+  try:
+    load_announced_key(message.attributes)
+    message.ack()
+  except Exception as e:
+    logging.info("Unable to load announced key; NACK pubsub message " + str(e))
+    quarantine.reject(message, str(e))
+
 logging.info(">>>>>>>>>>> Start <<<<<<<<<<<")
 
 def callback(message):
+  try:
+    tenant = message_tenant(message)
+  except KeyError as e:
+    logging.info("Unable to determine tenant; NACK pubsub message " + str(e))
+    quarantine.reject(message, str(e))
+    return
+  if scheduler is None:
+    with metrics.in_flight(), profiler.trace(message.message_id):
+      process(message, get_tenant_keys(tenant))
+    return
+  # decrypt work is queued per tenant and drained round-robin by the worker threads
+  metrics.gauge('queued', 1)
+  scheduler.submit(tenant, process_queued, message, get_tenant_keys(tenant))
+
+def process_queued(message, keys):
+  metrics.gauge('queued', -1)
+  with metrics.in_flight(), profiler.trace(message.message_id):
+    process(message, keys)
+
+def process(message, keys):
+  if quarantine.held(message):
+    return
+
+  if not routed(message):
+    logging.info("Message {} does not match --route; ACK without decrypting".format(message.message_id))
+    message.ack()
+    return
+
+  if replay.replayed(message):
+    return
 
   if (args.mode == "verify"):
     try:
       logging.info("********** Start PubsubMessage ")
       logging.info('Received message ID: {}'.format(message.message_id))
       logging.info('Received message publish_time: {}'.format(message.publish_time))
-      logging.info('Received message attributes["kms_key"]: {}'.format(message.attributes['kms_key']))
-      logging.debug('Received message attributes["sign_key_wrapped"]: {}'.format(message.attributes['sign_key_wrapped']))
+      logging.info('Received message attributes["kms_key"]: {}'.format(message.attributes.get('kms_key')))
+      logging.debug('Received message attributes["sign_key_wrapped"]: {}'.format(message.attributes.get('sign_key_wrapped')))
       logging.info('Received message attributes["signature"]: {}'.format(message.attributes['signature']))
       signature = message.attributes['signature']
-      name = message.attributes['kms_key']
-      sign_key_wrapped = message.attributes['sign_key_wrapped']
-
-      try:
-         unwrapped_key = cache[sign_key_wrapped]
-         logging.info("Using Cached DEK")
-      except KeyError:
-        logging.info(">>>>>>>>>>>>>>>>   Starting KMS decryption API call")
-        decrypted_message = kms_client.decrypt(
-            request={'name': name, 'ciphertext': base64.b64decode(sign_key_wrapped.encode('utf-8')), 'additional_authenticated_data': tenantID.encode('utf-8')  })
-        logging.info("Decrypted HMAC " + decrypted_message.plaintext.decode('utf-8'))
-
-        unwrapped_key = HMACFunctions(encoded_key=decrypted_message.plaintext)
-        logging.info(unwrapped_key.printKeyInfo())
-        cache[sign_key_wrapped] = unwrapped_key
 
-        logging.info("End KMS decryption API call")
-        logging.debug("Verify message: " + message.data.decode('utf-8'))
-        logging.debug('  With HMAC: ' + signature)
+      logging.debug("Verify message: " + message.data.decode('utf-8'))
+      logging.debug('  With HMAC: ' + signature)
 
-      sig = unwrapped_key.hash(message.data)
+      # the rolling keyset picks the key from the tag prefix; only a miss needs the key id
+      with metrics.stage('mac_verify'):
+        verified = keys.sign_keyset.verify(signed_data(keys.tenant, message), base64.b64decode(signature))
+      metrics.cache('keyset', verified)
+      if not verified and load_message_key(keys, message, keys.sign_keyset, 'mac', 'sign_key'):
+        with metrics.stage('mac_verify'):
+          verified = keys.sign_keyset.verify(signed_data(keys.tenant, message), base64.b64decode(signature))
+      if not verified:
+        metrics.error('mac_verify')
 
-      if (unwrapped_key.verify(message.data,base64.b64decode(sig))):
+      if verified:
         logging.info("Message authenticity verified")
-        message.ack()
+        records = message_records(message.data, message.attributes)
+        for record in records:
+          logging.debug("Verified record: " + record.decode('utf-8', 'replace'))
+        if not replay.accepted(message, *records):
+          return
+        with metrics.stage('ack'):
+          message.ack()
       else:
         logging.error("Unable to verify message")
-        message.nack()
+        quarantine.reject(message, 'signature mismatch')
       logging.debug("********** End PubsubMessage ")
     except Exception as e:
       logging.info("Unable to decrypt message; NACK pubsub message " + str(e))
-      message.nack() 
+      quarantine.reject(message, str(e))
           
 
   if (args.mode == "decrypt"):
@@ -108,39 +394,94 @@ def callback(message):
       logging.info("********** Start PubsubMessage ")
       logging.info('Received message ID: {}'.format(message.message_id))
       logging.info('Received message publish_time: {}'.format(message.publish_time))
-      logging.info('Received message attributes["kms_key"]: {}'.format(message.attributes['kms_key']))
-      logging.info('Received message attributes["dek_wrapped"]: {}'.format(message.attributes['dek_wrapped']))
-      dek_wrapped = message.attributes['dek_wrapped']
-      name = message.attributes['kms_key']
+      logging.info('Received message attributes["kms_key"]: {}'.format(message.attributes.get('kms_key')))
+      logging.info('Received message attributes["dek_wrapped"]: {}'.format(message.attributes.get('dek_wrapped')))
 
-      try:
-         dek = cache[dek_wrapped]
-         logging.info("Using Cached DEK")
-      except KeyError:
-        logging.info(">>>>>>>>>>>>>>>>   Starting KMS decryption API call")
-        decrypted_message = kms_client.decrypt(
-            request={'name': name, 'ciphertext': base64.b64decode(dek_wrapped.encode('utf-8')), 'additional_authenticated_data': tenantID.encode('utf-8')  })
-        logging.info("Decrypted DEK " + decrypted_message.plaintext.decode('utf-8'))
-
-        dek = AESCipher(encoded_key=decrypted_message.plaintext)
-        logging.info(dek.printKeyInfo())
-        cache[dek_wrapped] = dek
+      if 'encrypted_fields' in message.attributes:
+        # field-level encryption: only the fields this subscriber reads are decrypted
+        document = decrypt_message_fields(keys, message)
+        logging.info('Decrypted fields ' + json.dumps(document))
+        if not replay.accepted(message, document):
+          return
+        with metrics.stage('ack'):
+          message.ack()
+        logging.info("********** End PubsubMessage ")
+        return
 
       logging.debug("Starting AES decryption")
 
-      decrypted_data = dek.decrypt(message.data,associated_data=tenantID)
+      # the rolling keyset picks the key from the ciphertext prefix; only a miss needs the key id
+      try:
+        # a failure here is usually a key the keyset does not hold yet, not an error
+        with metrics.stage('aead_decrypt', count_errors=False):
+          decrypted_data = keys.dek_keyset.decrypt_bytes(message.data,associated_data=payload_aad(keys.tenant, message.attributes))
+        metrics.cache('keyset', True)
+      except tink.TinkError:
+        metrics.cache('keyset', False)
+        if not load_message_key(keys, message, keys.dek_keyset, 'aead', 'dek'):
+          raise
+        with metrics.stage('aead_decrypt'):
+          decrypted_data = keys.dek_keyset.decrypt_bytes(message.data,associated_data=payload_aad(keys.tenant, message.attributes))
       logging.debug("End AES decryption")
-      logging.info('Decrypted data ' + decrypted_data)
-      message.ack()
+      if 'blob_ref' in message.attributes:
+        # an offloaded payload is handed on as a file, and read from there
+        records = [read_blob(message.attributes, decrypted_data, keys.tenant)]
+      else:
+        records = message_records(decrypted_data, message.attributes)
+        for record in records:
+          logging.info('Decrypted data ' + record.decode('utf-8', 'replace'))
+      if not replay.accepted(message, *records):
+        return
+      with metrics.stage('ack'):
+        message.ack()
+      delete_blob(message)
       logging.debug("ACK message")
       logging.info("********** End PubsubMessage ")
     except Exception as e:
       logging.info("Unable to decrypt message; NACK pubsub message " + str(e))
-      message.nack() 
+      quarantine.reject(message, str(e))
+
+if args.control_subscription is not None:
+  control_subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
+      project_id=pubsub_project_id,
+      sub=args.control_subscription,
+  )
+  subscriber.subscribe(control_subscription_name, callback=control_callback)
+  logging.info('Listening for key announcements on {}'.format(control_subscription_name))
+
+def warmup_keys(path):
+  # one key announcement per line, with the attributes the publisher sends on --control_topic
+  with open(path) as f:
+    for line in f:
+      if line.strip():
+        load_announced_key(json.loads(line))
+
+def self_test():
+  # a fresh key through the primitives process() uses; the tenant keysets are empty until the first message
+  if args.mode == 'decrypt':
+    cipher = AESCipher(encoded_key=None)
+    if cipher.decrypt_bytes(cipher.encrypt(b'warmup', tenantID), tenantID) != b'warmup':
+      raise ValueError("AEAD self-test failed")
+  if args.mode == 'verify':
+    hh = HMACFunctions(encoded_key=None)
+    if not hh.verify(b'warmup', base64.b64decode(hh.hash(b'warmup'))):
+      raise ValueError("MAC self-test failed")
+
+# the first messages should not pay for the KMS and Pub/Sub channels, the token or unwrapping known keys
+warmup = utils.Warmup(metrics)
+if not args.no_warmup:
+  warmup.add('pubsub_connect', utils.Warmup.connect, subscriber, clients.credentials(subscriber))
+  warmup.add('kms_connect', utils.Warmup.connect, kms_client, clients.credentials(kms_client))
+  if args.warmup_keys is not None:
+    warmup.add('keys', warmup_keys, args.warmup_keys)
+  warmup.add('self_test', self_test)
+warmup.run()
 
 subscriber.subscribe(subscription_name, callback=callback)
 
 logging.info('Listening for messages on {}'.format(subscription_name))
 while True:
   time.sleep(10)
+  for keys in list(tenant_keys.values()):
+    keys.prune()
 logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
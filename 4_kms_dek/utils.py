@@ -14,141 +14,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
-import hashlib
-import hmac
-import binascii
+# everything here lives in common/ at the top of the repository, shared by every scheme;
+# this module re-exports what 4_kms_dek uses so the scripts keep running from this directory
 
 import os
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes, padding, hmac
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
-from cryptography.hazmat.primitives import hashes
-from cryptography.exceptions import InvalidKey
-
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import dsa, rsa
-from cryptography.hazmat.primitives.serialization import load_pem_public_key
-
-from cryptography.x509 import load_pem_x509_certificate
-from cryptography.hazmat.primitives.asymmetric.padding import OAEP, MGF1
-from cryptography.exceptions import InvalidSignature
-import string
-import random
-import json
-
-import base64
-import io
-import tink
-from tink import aead
-from tink import tink_config
-from tink import mac
-from tink.proto import tink_pb2
-from tink.proto import common_pb2
-from tink.integration import gcpkms
-from tink import core
-
-from tink import cleartext_keyset_handle
-from tink import read_keyset_handle
-
-
-class RSACipher(object):
-
-   public_key = None
-   private_key = None
-
-   def __init__(self, public_key_pem = None, private_key = None):
-     if public_key_pem  is not None:
-       self.public_key = load_pem_x509_certificate(public_key_pem.encode(), backend=default_backend()).public_key()
-     if private_key is not None:
-       self.private_key = private_key
-
-   def encrypt(self, raw):
-     return  base64.b64encode(self.public_key.encrypt(
-       raw, OAEP( mgf=MGF1(algorithm=hashes.SHA256()),
-        algorithm=hashes.SHA256(),label=None)))
-
-   def decrypt(self, raw):
-     return  self.private_key.decrypt(base64.b64decode(raw), OAEP( mgf=MGF1(algorithm=hashes.SHA256()),algorithm=hashes.SHA256(), label=None )).decode('utf-8').strip()
-
-
-tink_config.register()
-aead.register()
-mac.register()
-
-class AESCipher(object):
-
-    def __init__(self, encoded_key):
-      if (encoded_key==None):
-        self.keyset_handle = tink.new_keyset_handle(aead.aead_key_templates.AES256_GCM)
-      else:
-        reader = tink.BinaryKeysetReader(base64.b64decode(encoded_key))
-        self.keyset_handle = cleartext_keyset_handle.read(reader)
-      self.key=self.keyset_handle.keyset_info()
-      self.aead_primitive = self.keyset_handle.primitive(aead.Aead)
-
-    def printKeyInfo(self):
-      stream = io.StringIO()
-      writer = tink.JsonKeysetWriter(stream)    
-      cleartext_keyset_handle.write(writer, self.keyset_handle)
-      return stream.getvalue()
-
-    def getKey(self):
-      iostream = io.BytesIO()
-      writer = tink.BinaryKeysetWriter(iostream)      
-      cleartext_keyset_handle.write(writer, self.keyset_handle)
-      encoded_key = base64.b64encode(iostream.getvalue()).decode('utf-8')
-      return encoded_key
-
-    def encrypt(self, plaintext, associated_data):
-      try:
-        ciphertext = self.aead_primitive.encrypt(plaintext, associated_data.encode('utf-8'))
-        base64_bytes = base64.b64encode(ciphertext)
-        return (base64_bytes.decode('utf-8'))  
-      except tink.TinkError as e:
-        raise e      
-
-    def decrypt(self, ciphertext, associated_data):
-      try:
-        plaintext = self.aead_primitive.decrypt(base64.b64decode(ciphertext), associated_data.encode('utf-8'))
-        return(plaintext.decode('utf-8'))
-      except tink.TinkError as e:
-        raise e      
-
-class HMACFunctions(object):
-
-    def __init__(self, encoded_key):
-      if (encoded_key==None):
-        self.keyset_handle = tink.new_keyset_handle(mac.mac_key_templates.HMAC_SHA256_256BITTAG)
-      else:
-        reader = tink.BinaryKeysetReader(base64.b64decode(encoded_key))          
-        self.keyset_handle = cleartext_keyset_handle.read(reader)
-      self.key = self.keyset_handle.keyset_info()        
-      self.mac = self.keyset_handle.primitive(mac.Mac)
-
-    def printKeyInfo(self):
-      stream = io.StringIO()
-      writer = tink.JsonKeysetWriter(stream)    
-      cleartext_keyset_handle.write(writer, self.keyset_handle)
-      return stream.getvalue()
-
-    def getKey(self):
-      iostream = io.BytesIO()
-      writer = tink.BinaryKeysetWriter(iostream)      
-      cleartext_keyset_handle.write(writer, self.keyset_handle)
-      encoded_key = base64.b64encode(iostream.getvalue()).decode('utf-8')
-      return encoded_key
-
-    def hash(self, msg):
-      tag = self.mac.compute_mac(msg)
-      return base64.b64encode(tag)
-
-    def verify(self,data, signature):
-      try:
-        self.mac.verify_mac(signature, data)
-        return True
-      except tink.TinkError as e:
-        return False
- 
\ No newline at end of file
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.cli import add_publisher_args, add_subscriber_args
+from common.metrics import Metrics, Profiler
+from common.load import LoadGenerator, ordering_key
+from common.delivery import NegativeCache, Quarantine, Warmup
+from common.replay import ReplayChecks, ReplayGuard, stamped
+from common.clients import ClientRegistry
+from common.crypto import AESCipher, compact_key, expand_key, fastest_template, HMACFunctions, KEY_TEMPLATES, RSACipher
+from common.dek import derived_keyset, MASTER_SECRET_AAD, new_master_secret, PersistentKeyCache, TenantKeys, TenantScheduler, wrapped_key_id
+from common.payloads import blob_aad, check_field_seal, decrypt_fields, FieldSchema, frame_aad, open_blob, open_blob_store, RecordAggregator, signed_frame, StreamingCipher, unpack_records
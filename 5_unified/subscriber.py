@@ -0,0 +1,512 @@
+#!/usr/bin/python
+
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python subscriber.py --pubsub_project_id $PROJECT_ID --pubsub_subscription my-new-subscriber \
+#    --tenantID A --symmetric_key <encoded keyset> --cert_service_account '../svc-subscriber.json'
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent import futures
+
+import requests
+from expiringdict import ExpiringDict
+from google.api_core import exceptions
+from google.auth import crypt
+from google.cloud import pubsub
+from google.oauth2.service_account import Credentials
+
+import tink
+import utils
+from utils import AESCipher, HMACFunctions, RSACipher, TenantKeys
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+parser = argparse.ArgumentParser(description='Subscribe to messages from any of the four schemes on one subscription')
+parser.add_argument('--service_account',required=False,help='subscriber service_account credentials file for ADC')
+parser.add_argument('--pubsub_project_id',required=True, help='subscriber PubSub project')
+parser.add_argument('--pubsub_subscription',required=True, help='pubsub_subscription to pull message')
+parser.add_argument('--schemes',required=False, default='symmetric,svc,kms,kms_dek', help='comma separated schemes to accept')
+parser.add_argument('--symmetric_key',required=False, help='symmetric scheme: shared key')
+parser.add_argument('--cert_service_account',required=False, help='svc scheme: service_account file to decrypt with')
+parser.add_argument('--tenantID',required=False, default="tenantKey", help='kms and kms_dek schemes: additionalAuthenticatedData')
+parser.add_argument('--kms_keys',required=False, help='kms scheme: comma separated KMS keys, or key versions, a message may name in its kms_key attribute; a key covers all its versions')
+parser.add_argument('--blob_dir',required=False, help='kms_dek scheme: blob store for offloaded payloads, a local directory or gs://bucket/prefix')
+parser.add_argument('--delete_blobs',required=False, action='store_true', help='kms_dek scheme: delete an offloaded payload once its message is acked; only when this is the topic\'s only subscription')
+parser.add_argument('--workers',required=False, type=int, default=10, help='worker threads shared by all schemes')
+parser.add_argument('--max_messages',required=False, type=int, default=1000, help='maximum outstanding messages')
+parser.add_argument('--warmup_certs',required=False, help='comma separated publisher service accounts whose certificates are fetched before subscribing')
+utils.add_subscriber_args(parser, grpc_pool=True)
+args = parser.parse_args()
+
+if args.service_account != None:
+  os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.service_account
+
+tenantID = args.tenantID
+schemes = set(args.schemes.split(','))
+if 'kms' in schemes and args.kms_keys is None:
+  parser.error('the kms scheme needs --kms_keys')
+kms_keys = args.kms_keys.split(',') if args.kms_keys is not None else []
+
+# one client, one set of caches and one worker pool for every scheme
+clients = utils.ClientRegistry(channels=args.grpc_channels, keepalive_ms=args.grpc_keepalive_ms, max_streams=args.grpc_max_streams)
+# the Cloud KMS client library takes a long time to import; only the kms schemes need it
+kms_client = None
+if schemes & {'kms', 'kms_dek'}:
+  kms_client = clients.kms()
+subscriber = clients.subscriber()
+subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
+    project_id=args.pubsub_project_id,
+    sub=args.pubsub_subscription,
+)
+
+metrics = utils.Metrics(scheme='unified', role='subscriber')
+profiler = utils.Profiler(output_dir=args.profile_dir, seconds=args.profile_seconds, slowest=args.trace_slowest)
+profiler.attach(metrics)
+profiler.install_signals()
+if args.metrics_port is not None:
+  metrics.serve(args.metrics_port)
+
+quarantine = utils.Quarantine(path=args.dead_letter_file, max_failures=args.max_failures, base_delay=args.nack_delay)
+
+replay_guard = None
+if args.replay_window > 0:
+  replay_guard = utils.ReplayGuard(window=args.replay_window, capacity=args.replay_capacity, error_rate=args.replay_error_rate)
+replay = utils.ReplayChecks(replay_guard, metrics)
+
+bad_keys = utils.NegativeCache(ttl=args.negative_ttl)
+
+# KMS errors about the key itself; for a wrapped key InvalidArgument is final too
+KEY_ERRORS = (exceptions.NotFound, exceptions.PermissionDenied, exceptions.FailedPrecondition)
+
+certs = ExpiringDict(max_len=100, max_age_seconds=300)
+# one session, so the TLS connection to the certificate endpoint is reused between fetches
+http = requests.Session()
+keys = TenantKeys(tenantID, max_len=100, max_age_seconds=20)
+masters = ExpiringDict(max_len=100, max_age_seconds=20)
+
+blob_store = None
+if args.blob_dir is not None:
+  blob_store = utils.open_blob_store(args.blob_dir)
+
+symmetric_cipher = None
+symmetric_mac = None
+if args.symmetric_key is not None:
+  symmetric_cipher = AESCipher(encoded_key=args.symmetric_key)
+  symmetric_mac = HMACFunctions(encoded_key=args.symmetric_key)
+
+svc_rsa = None
+svc_email = None
+if args.cert_service_account is not None:
+  svc_credentials = Credentials.from_service_account_file(args.cert_service_account)
+  svc_rsa = RSACipher(private_key=svc_credentials._signer._key)
+  svc_email = svc_credentials.service_account_email
+
+
+def detect_scheme(attributes):
+  """Returns (scheme, mode) for a message based on the attributes its publisher sets."""
+  mode = 'verify' if 'signature' in attributes else 'decrypt'
+  if 'service_account' in attributes and 'key_id' in attributes:
+    return 'svc', mode
+  for attribute in ('dek_id', 'dek_wrapped', 'sign_key_id', 'sign_key_wrapped', 'master_id'):
+    if attribute in attributes:
+      return 'kms_dek', mode
+  if 'kms_key' in attributes:
+    return 'kms', mode
+  return 'symmetric', mode
+
+
+def handle_symmetric(message, mode):
+  if symmetric_cipher is None:
+    raise ValueError("--symmetric_key is required for symmetric messages")
+  if mode == 'decrypt':
+    with metrics.stage('aead_decrypt'):
+      plaintext = symmetric_cipher.decrypt_bytes(message.data, associated_data='')
+    logging.info('Decrypted data ' + plaintext.decode('utf-8', 'replace'))
+    return [plaintext]
+  with metrics.stage('mac_verify'):
+    verified = symmetric_mac.verify(message.data, base64.b64decode(message.attributes['signature']))
+  return [message.data] if verified else []
+
+
+def check_bad(ref, what):
+  reason = bad_keys.get(ref)
+  metrics.cache('negative', reason is not None)
+  if reason is not None:
+    raise ValueError("{} {} is known bad: {}".format(what, ref, reason))
+
+
+def fetch_certs(service_account):
+  # returns the HTTP status; every certificate the service account publishes is cached
+  cert_url = 'https://www.googleapis.com/service_accounts/v1/metadata/x509/' + service_account
+  with metrics.stage('cert_fetch'):
+    r = http.get(cert_url)
+    if r.status_code == 200:
+      for key_id, pem in r.json().items():
+        certs[(service_account, key_id)] = pem
+  return r.status_code
+
+
+def get_cert(service_account, key_id):
+  try:
+    pem = certs[(service_account, key_id)]
+    metrics.cache('cert', True)
+    return pem
+  except KeyError:
+    metrics.cache('cert', False)
+    cert_ref = service_account + '/' + key_id
+    check_bad(cert_ref, 'certificate')
+    status = fetch_certs(service_account)
+    pem = certs.get((service_account, key_id))
+    if pem is None:
+      bad_keys.add(cert_ref, 'no certificate for key_id (HTTP {})'.format(status))
+      raise KeyError("no certificate {} for {}".format(key_id, service_account))
+    return pem
+
+
+def handle_svc(message, mode):
+  service_account = message.attributes['service_account']
+  key_id = message.attributes['key_id']
+  if mode == 'verify':
+    data_to_verify = hashlib.sha256(message.data).digest()
+    pem = get_cert(service_account, key_id)
+    with metrics.stage('signature_verify'):
+      v = crypt.RSAVerifier.from_string(pem)
+      verified = v.verify(data_to_verify, base64.b64decode(message.attributes['signature']))
+    return [message.data] if verified else []
+  if svc_rsa is None:
+    raise ValueError("--cert_service_account is required for svc messages")
+  if service_account != svc_email:
+    raise ValueError("message is for {}, not {}".format(service_account, svc_email))
+  dek_wrapped = message.attributes.get('dek_wrapped')
+  if dek_wrapped is None:
+    with metrics.stage('rsa_decrypt'):
+      plaintext = svc_rsa.decrypt_bytes(message.data)
+  else:
+    with metrics.stage('rsa_unwrap'):
+      dek = AESCipher(encoded_key=utils.expand_key(svc_rsa.decrypt_bytes(dek_wrapped)))
+    with metrics.stage('aead_decrypt'):
+      plaintext = dek.decrypt_bytes(message.data, associated_data="")
+  logging.info("Decrypted Message payload: " + plaintext.decode('utf-8', 'replace'))
+  return [plaintext]
+
+
+def kms_call(stage, method, request):
+  name = request['name']
+  check_bad(name, 'KMS key')
+  try:
+    with metrics.stage(stage):
+      return method(request=request)
+  except KEY_ERRORS as e:
+    bad_keys.add(name, str(e))
+    raise
+
+
+# public keys of asymmetric signing key versions; a version's key never changes
+verifiers = {}
+verifiers_lock = threading.Lock()
+
+def get_verifier(name):
+  verifier = verifiers.get(name)
+  metrics.cache('public_key', verifier is not None)
+  if verifier is None:
+    with verifiers_lock:
+      verifier = verifiers.get(name)
+      if verifier is None:
+        public_key = kms_call('kms_get_public_key', kms_client.get_public_key, {'name': name})
+        verifier = verifiers[name] = utils.AsymmetricVerifier(public_key.pem, public_key.algorithm.name)
+  return verifier
+
+
+def handle_kms(message, mode):
+  name = message.attributes['kms_key']
+  if not utils.kms_key_allowed(name, kms_keys):
+    raise ValueError("KMS key {} is not one of --kms_keys".format(name))
+  if mode == 'decrypt':
+    decrypted_message = kms_call('kms_decrypt', kms_client.decrypt,
+        {'name': name, 'ciphertext': base64.b64decode(message.data), 'additional_authenticated_data': tenantID.encode('utf-8')  })
+    logging.info('Decrypted data ' + decrypted_message.plaintext.decode('utf-8', 'replace'))
+    return [decrypted_message.plaintext]
+  data_to_verify = hashlib.sha256(message.data).digest()
+  signature = base64.b64decode(message.attributes['signature'])
+  if message.attributes.get('signature_type') == 'asymmetric_sign':
+    verifier = get_verifier(name)
+    with metrics.stage('signature_verify'):
+      verified = verifier.verify(data_to_verify, signature)
+  else:
+    verification_message = kms_call('kms_mac_verify', kms_client.mac_verify,
+        {'name': name, 'data': data_to_verify, 'mac': signature})
+    verified = verification_message.success
+  return [message.data] if verified else []
+
+
+def unwrap_key(key_id, name, wrapped, aad):
+  if wrapped is None or name is None:
+    raise KeyError("key id {} is not cached and the message does not carry the wrapped key".format(key_id))
+  if utils.wrapped_key_id(wrapped) != key_id:
+    raise ValueError("key id {} does not match the wrapped key".format(key_id))
+  cache_key = aad + '/' + key_id
+  check_bad(cache_key, 'wrapped key')
+  logging.info("Starting KMS decryption API call")
+  try:
+    with metrics.stage('kms_unwrap'):
+      decrypted_message = kms_client.decrypt(
+          request={'name': name, 'ciphertext': base64.b64decode(wrapped.encode('utf-8')), 'additional_authenticated_data': aad.encode('utf-8')  })
+  except KEY_ERRORS + (exceptions.InvalidArgument,) as e:
+    bad_keys.add(cache_key, str(e))
+    raise
+  logging.info("End KMS decryption API call")
+  return decrypted_message.plaintext
+
+
+def load_message_key(message, keyset, key_type, prefix):
+  # returns False if the key was already loaded
+  attributes = message.attributes
+  name = attributes.get('kms_key')
+  if 'master_id' in attributes:
+    master_id = attributes['master_id']
+    window = attributes.get('key_window', '0')
+    key_id = '{}/{}/{}'.format(master_id, key_type, window)
+  else:
+    wrapped = attributes.get(prefix + '_wrapped')
+    key_id = attributes.get(prefix + '_id') or utils.wrapped_key_id(wrapped)
+  try:
+    if keyset.contains(keys.cache[key_id]):
+      return False
+  except KeyError:
+    pass
+  if 'master_id' in attributes:
+    try:
+      master_secret = masters[master_id]
+      # a master secret expires 20s after it was last needed, not after it was unwrapped
+      masters[master_id] = master_secret
+    except KeyError:
+      master_secret = unwrap_key(master_id, name, attributes.get('master_wrapped'), utils.MASTER_SECRET_AAD).decode('utf-8')
+      masters[master_id] = master_secret
+    encoded_key = utils.derived_keyset(master_secret, key_type, tenantID, window)
+  else:
+    encoded_key = utils.expand_key(unwrap_key(key_id, name, wrapped, tenantID))
+  keys.cache[key_id] = keyset.add(encoded_key)
+  return True
+
+
+def read_blob(attributes, encoded_key):
+  # the message carried the blob's streaming key.  The payload comes back as a temporary
+  # file, once every segment and the digest at the end of the blob checked out
+  if blob_store is None:
+    raise ValueError("message payload is in blob {} but --blob_dir is not set".format(attributes['blob_ref']))
+  with metrics.stage('blob_get'):
+    payload = utils.open_blob(blob_store, encoded_key, tenantID, attributes)
+  logging.info("Read {} bytes from blob {}".format(os.fstat(payload.fileno()).st_size, attributes['blob_ref']))
+  return payload
+
+def delete_blob(message):
+  # only with --delete_blobs: another subscription to the topic may still need the blob
+  if args.delete_blobs and 'blob_ref' in message.attributes:
+    with metrics.stage('blob_delete'):
+      blob_store.delete(message.attributes['blob_ref'])
+
+
+def payload_aad(attributes):
+  # kms_dek frames authenticate their record count: a changed or stripped records attribute fails to decrypt
+  if 'records' in attributes:
+    return utils.frame_aad(tenantID, attributes['records'])
+  return tenantID
+
+
+def signed_data(message):
+  if 'records' in message.attributes:
+    return utils.signed_frame(tenantID, message.attributes['records'], message.data)
+  return message.data
+
+
+def message_records(data, attributes):
+  # aggregated kms_dek messages carry a frame of length-prefixed records
+  if 'records' not in attributes:
+    return [data]
+  with metrics.stage('unpack'):
+    records = utils.unpack_records(data)
+  if len(records) != int(attributes['records']):
+    raise ValueError("frame holds {} records, expected {}".format(len(records), attributes['records']))
+  return records
+
+
+def decrypt_kms_dek_fields(message):
+  # field-level encrypted message: the data is a JSON document with some fields encrypted, sealed as a whole
+  document = json.loads(message.data)
+  fields = [f for f in message.attributes['encrypted_fields'].split(',') if f]
+  try:
+    with metrics.stage('field_decrypt', count_errors=False):
+      utils.check_field_seal(keys.dek_keyset, message.data, message.attributes, tenantID)
+      document = utils.decrypt_fields(keys.dek_keyset, document, fields, tenantID)
+    metrics.cache('keyset', True)
+  except tink.TinkError:
+    metrics.cache('keyset', False)
+    if not load_message_key(message, keys.dek_keyset, 'aead', 'dek'):
+      raise
+    with metrics.stage('field_decrypt'):
+      utils.check_field_seal(keys.dek_keyset, message.data, message.attributes, tenantID)
+      document = utils.decrypt_fields(keys.dek_keyset, document, fields, tenantID)
+  logging.info('Decrypted fields ' + json.dumps(document))
+  return [document]
+
+
+def handle_kms_dek(message, mode):
+  if mode == 'decrypt' and 'encrypted_fields' in message.attributes:
+    return decrypt_kms_dek_fields(message)
+  if mode == 'decrypt':
+    try:
+      with metrics.stage('aead_decrypt', count_errors=False):
+        decrypted_data = keys.dek_keyset.decrypt_bytes(message.data, associated_data=payload_aad(message.attributes))
+      metrics.cache('keyset', True)
+    except tink.TinkError:
+      metrics.cache('keyset', False)
+      if not load_message_key(message, keys.dek_keyset, 'aead', 'dek'):
+        raise
+      with metrics.stage('aead_decrypt'):
+        decrypted_data = keys.dek_keyset.decrypt_bytes(message.data, associated_data=payload_aad(message.attributes))
+    if 'blob_ref' in message.attributes:
+      # an offloaded payload is handed on as a file, and read from there
+      return [read_blob(message.attributes, decrypted_data)]
+    records = message_records(decrypted_data, message.attributes)
+    for record in records:
+      logging.info('Decrypted data ' + record.decode('utf-8', 'replace'))
+    return records
+  signature = base64.b64decode(message.attributes['signature'])
+  with metrics.stage('mac_verify'):
+    verified = keys.sign_keyset.verify(signed_data(message), signature)
+  metrics.cache('keyset', verified)
+  if not verified and load_message_key(message, keys.sign_keyset, 'mac', 'sign_key'):
+    with metrics.stage('mac_verify'):
+      verified = keys.sign_keyset.verify(signed_data(message), signature)
+  if not verified:
+    return []
+  records = message_records(message.data, message.attributes)
+  for record in records:
+    logging.debug("Verified record: " + record.decode('utf-8', 'replace'))
+  return records
+
+
+# each handler returns the payloads it decrypted or verified; none is a signature mismatch
+handlers = {
+  'symmetric': handle_symmetric,
+  'svc': handle_svc,
+  'kms': handle_kms,
+  'kms_dek': handle_kms_dek,
+}
+
+
+def callback(message):
+  with metrics.in_flight(), profiler.trace(message.message_id):
+    process(message)
+
+
+def process(message):
+  if quarantine.held(message):
+    return
+  if replay.replayed(message):
+    return
+  with metrics.stage('deserialize'):
+    scheme, mode = detect_scheme(message.attributes)
+  logging.info("********** Start PubsubMessage {} ({} {})".format(message.message_id, scheme, mode))
+  if scheme not in schemes:
+    # backs off like any failure: a subscriber with the scheme enabled may pick it up meanwhile
+    logging.info("Scheme {} not enabled; NACK pubsub message".format(scheme))
+    quarantine.reject(message, 'scheme {} not enabled'.format(scheme))
+    return
+  try:
+    with metrics.stage(scheme + '_' + mode):
+      payloads = handlers[scheme](message, mode)
+    if payloads:
+      if not replay.accepted(message, *payloads):
+        return
+      logging.info("ACK message")
+      with metrics.stage('ack'):
+        message.ack()
+      delete_blob(message)
+    else:
+      logging.info("Unable to verify message; NACK pubsub message")
+      metrics.error(scheme + '_' + mode)
+      quarantine.reject(message, 'signature mismatch')
+  except Exception as e:
+    logging.info("Unable to {} message; NACK pubsub message {}".format(mode, e))
+    quarantine.reject(message, str(e))
+  logging.info("********** End PubsubMessage ")
+
+
+def prefetch_certs(service_account):
+  status = fetch_certs(service_account)
+  if status != 200:
+    raise ValueError("certificates for {}: HTTP {}".format(service_account, status))
+  for (sa, key_id), pem in list(certs.items()):
+    if sa == service_account:
+      crypt.RSAVerifier.from_string(pem)
+
+
+def self_test():
+  # the configured keys, and a fresh key, through the primitives the handlers use
+  if symmetric_cipher is not None:
+    if symmetric_cipher.decrypt_bytes(symmetric_cipher.encrypt(b'warmup', ''), '') != b'warmup':
+      raise ValueError("symmetric AEAD self-test failed")
+    if not symmetric_mac.verify(b'warmup', base64.b64decode(symmetric_mac.hash(b'warmup'))):
+      raise ValueError("symmetric MAC self-test failed")
+  if svc_rsa is not None:
+    wrapper = RSACipher(public_key=svc_rsa.private_key.public_key())
+    dek_key = utils.compact_key(AESCipher(encoded_key=None).getKey())
+    if svc_rsa.decrypt_bytes(wrapper.encrypt(dek_key)) != dek_key:
+      raise ValueError("svc RSA self-test failed")
+  cipher = AESCipher(encoded_key=None)
+  if cipher.decrypt_bytes(cipher.encrypt(b'warmup', tenantID), tenantID) != b'warmup':
+    raise ValueError("AEAD self-test failed")
+
+
+logging.info(">>>>>>>>>>> Start <<<<<<<<<<<")
+
+# the first messages should not pay for the channels, the token, TLS to the certificate endpoint or loading keys
+warmup = utils.Warmup(metrics)
+if not args.no_warmup:
+  warmup.add('pubsub_connect', utils.Warmup.connect, subscriber, clients.credentials(subscriber))
+  if kms_client is not None:
+    warmup.add('kms_connect', utils.Warmup.connect, kms_client, clients.credentials(kms_client))
+  if 'svc' in schemes and args.warmup_certs is not None:
+    for service_account in args.warmup_certs.split(','):
+      warmup.add('cert_' + service_account, prefetch_certs, service_account)
+  warmup.add('self_test', self_test)
+warmup.run()
+
+executor = futures.ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='handler')
+streaming_pull_future = subscriber.subscribe(
+    subscription_name, callback=callback,
+    flow_control=pubsub.types.FlowControl(max_messages=args.max_messages),
+    scheduler=pubsub.subscriber.scheduler.ThreadScheduler(executor))
+
+logging.info('Listening for messages on {}'.format(subscription_name))
+try:
+  while True:
+    try:
+      streaming_pull_future.result(timeout=10)
+      break
+    except futures.TimeoutError:
+      keys.prune()
+except KeyboardInterrupt:
+  streaming_pull_future.cancel()
+  streaming_pull_future.result()
+logging.info(">>>>>>>>>>> END <<<<<<<<<<<")
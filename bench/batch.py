@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python batch.py --sizes 1024,65536 --batch 2000
+
+import argparse
+import base64
+import importlib.util
+import json
+import logging
+import os
+import time
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+parser = argparse.ArgumentParser(description='Compare per-message and batched crypto throughput with raw AES-GCM')
+parser.add_argument('--scheme',required=False, default='kms_dek', choices=['symmetric', 'svc', 'kms_dek', 'unified'], help='scheme whose utils.py to measure')
+parser.add_argument('--sizes',required=False, default='256,4096,65536', help='comma separated message sizes in bytes')
+parser.add_argument('--batch',required=False, type=int, default=1000, help='messages per batch')
+parser.add_argument('--rounds',required=False, type=int, default=5, help='batches per measurement; the best round is reported')
+parser.add_argument('--workers',required=False, type=int, help='threads the batch methods spread over (default: one per CPU)')
+parser.add_argument('--output',required=False, help='also write the results as JSON to this file')
+args = parser.parse_args()
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+scheme_dirs = {
+  'symmetric': '1_symmetric',
+  'svc': '2_svc',
+  'kms_dek': '4_kms_dek',
+  'unified': '5_unified',
+}
+
+
+def load_utils(scheme):
+  path = os.path.join(root, scheme_dirs[scheme], 'utils.py')
+  spec = importlib.util.spec_from_file_location('utils_' + scheme, path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def best(fn):
+  # seconds of the fastest of --rounds runs; the first run also warms up
+  fn()
+  times = []
+  for i in range(args.rounds):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+
+def check(result):
+  values, errors = result
+  if errors:
+    raise ValueError('{} of {} items failed: {}'.format(len(errors), len(values), next(iter(errors.values()))))
+  return values
+
+
+utils = load_utils(args.scheme)
+results = []
+for size in [int(s) for s in args.sizes.split(',')]:
+  messages = [os.urandom(size) for i in range(args.batch)]
+  ac = utils.AESCipher(None)
+  ciphertexts = check(ac.encrypt_many(messages, b'tenant'))
+  raw_ciphertexts = check(ac.encrypt_many(messages, b'tenant', encoded=False))
+  buffer = bytearray(sum(len(c) for c in ciphertexts))
+
+  # the ceiling: one raw AES-GCM key, no base64, no Tink, one thread
+  key = AESGCM(os.urandom(32))
+  iv = os.urandom(12)
+  raw = [key.encrypt(iv, m, b'tenant') for m in messages]
+
+  timings = {
+    'aesgcm encrypt': best(lambda: [key.encrypt(iv, m, b'tenant') for m in messages]),
+    'aesgcm decrypt': best(lambda: [key.decrypt(iv, c, b'tenant') for c in raw]),
+    'encrypt': best(lambda: [ac.encrypt(m, 'tenant') for m in messages]),
+    'encrypt_many': best(lambda: check(ac.encrypt_many(messages, b'tenant', workers=args.workers))),
+    'decrypt_bytes': best(lambda: [ac.decrypt_bytes(c, b'tenant') for c in ciphertexts]),
+    'decrypt_many': best(lambda: check(ac.decrypt_many(ciphertexts, b'tenant', workers=args.workers))),
+    'decrypt_many buffer': best(lambda: check(ac.decrypt_many(ciphertexts, b'tenant', buffer=buffer, workers=args.workers))),
+    'encrypt_many raw': best(lambda: check(ac.encrypt_many(messages, b'tenant', workers=args.workers, encoded=False))),
+    'decrypt_many raw': best(lambda: check(ac.decrypt_many(raw_ciphertexts, b'tenant', buffer=buffer, workers=args.workers, encoded=False))),
+  }
+  if hasattr(utils, 'HMACFunctions'):
+    hh = utils.HMACFunctions(None)
+    tags = [base64.b64decode(t) for t in check(hh.hash_many(messages))]
+    timings['hash'] = best(lambda: [hh.hash(m) for m in messages])
+    timings['hash_many'] = best(lambda: check(hh.hash_many(messages, workers=args.workers)))
+    timings['verify'] = best(lambda: [hh.verify(m, t) for m, t in zip(messages, tags)])
+    timings['verify_many'] = best(lambda: check(hh.verify_many(messages, tags, workers=args.workers)))
+
+  for name, seconds in timings.items():
+    results.append({'size': size, 'operation': name, 'messages_per_second': args.batch / seconds,
+                    'mb_per_second': args.batch * size / seconds / 1e6})
+
+print('{:>8} {:<20} {:>12} {:>10}'.format('size', 'operation', 'messages/s', 'MB/s'))
+for r in results:
+  print('{:>8} {:<20} {:>12.0f} {:>10.1f}'.format(r['size'], r['operation'], r['messages_per_second'], r['mb_per_second']))
+
+if args.output is not None:
+  with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python replay.py --messages 2000 --rate 500 --sizes 256:0.8,65536:0.2 --tenants A:3,B \
+#    --rotate_seconds 1 --kms_latency_ms 8:40 --http_latency_ms 30:150 --workers 16
+
+import argparse
+import base64
+import datetime
+import importlib.util
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from concurrent import futures
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.x509.oid import NameOID
+
+import tink
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+parser = argparse.ArgumentParser(description='Replay a message trace through each scheme against local fakes')
+parser.add_argument('--schemes',required=False, default='symmetric,svc,kms,kms_dek', help='comma separated schemes to run')
+parser.add_argument('--trace',required=False, help='JSONL trace to replay; one {"t", "size", "tenant", "key_epoch"} per line')
+parser.add_argument('--save_trace',required=False, help='write the synthetic trace to this file')
+parser.add_argument('--messages',required=False, type=int, default=1000, help='synthetic trace: number of messages')
+parser.add_argument('--rate',required=False, type=float, default=200, help='synthetic trace: mean messages per second (Poisson arrivals)')
+parser.add_argument('--sizes',required=False, default='1024', help='synthetic trace: payload sizes in bytes with optional weights, eg 256:0.8,65536:0.2')
+parser.add_argument('--tenants',required=False, default='tenantKey', help='synthetic trace: tenants with optional weights, eg A:3,B')
+parser.add_argument('--rotate_seconds',required=False, type=float, default=10, help='synthetic trace: key rotation cadence in seconds')
+parser.add_argument('--seed',required=False, type=int, default=1, help='synthetic trace: random seed')
+parser.add_argument('--speed',required=False, type=float, default=0, help='replay speed relative to the trace timestamps; 0 replays as fast as possible')
+parser.add_argument('--workers',required=False, type=int, default=8, help='concurrent publish/pull workers')
+parser.add_argument('--kms_latency_ms',required=False, default='8:40', help='fake KMS latency as p50:p99 milliseconds (log-normal); 0 for none')
+parser.add_argument('--http_latency_ms',required=False, default='30:150', help='fake certificate endpoint latency as p50:p99 milliseconds; 0 for none')
+parser.add_argument('--pubsub_latency_ms',required=False, default='0', help='fake publish latency as p50:p99 milliseconds; 0 for none')
+parser.add_argument('--output',required=False, help='also write the results as JSON to this file')
+args = parser.parse_args()
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+scheme_dirs = {
+  'symmetric': '1_symmetric',
+  'svc': '2_svc',
+  'kms': '3_kms',
+  'kms_dek': '4_kms_dek',
+}
+
+
+def load_utils(scheme):
+  # every scheme ships its own utils.py; load each under its own module name
+  path = os.path.join(root, scheme_dirs[scheme], 'utils.py')
+  spec = importlib.util.spec_from_file_location('utils_' + scheme, path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def weighted(spec, convert):
+  values = []
+  weights = []
+  for item in spec.split(','):
+    value, _, weight = item.partition(':')
+    values.append(convert(value))
+    weights.append(float(weight or 1))
+  return values, weights
+
+
+class Latency(object):
+    """Log-normal latency model given its median and 99th percentile."""
+
+    def __init__(self, spec):
+      p50, _, p99 = spec.partition(':')
+      self.p50 = float(p50) / 1000
+      p99 = float(p99 or p50) / 1000
+      self.sigma = math.log(p99 / self.p50) / 2.3263 if self.p50 > 0 and p99 > self.p50 else 0
+
+    def wait(self):
+      if self.p50 > 0:
+        time.sleep(random.lognormvariate(math.log(self.p50), self.sigma))
+
+
+class FakeKMS(object):
+    """In-process stand-in for KeyManagementServiceClient.encrypt/decrypt."""
+
+    def __init__(self, latency):
+      self.latency = latency
+      self.keys = {}
+      self.lock = threading.Lock()
+      self.calls = 0
+
+    def _key(self, name):
+      with self.lock:
+        self.calls += 1
+        if name not in self.keys:
+          self.keys[name] = AESGCM(AESGCM.generate_key(bit_length=256))
+        return self.keys[name]
+
+    def encrypt(self, request):
+      key = self._key(request['name'])
+      self.latency.wait()
+      nonce = os.urandom(12)
+      ciphertext = nonce + key.encrypt(nonce, request['plaintext'], request.get('additional_authenticated_data'))
+      return argparse.Namespace(ciphertext=ciphertext)
+
+    def decrypt(self, request):
+      key = self._key(request['name'])
+      self.latency.wait()
+      ciphertext = request['ciphertext']
+      plaintext = key.decrypt(ciphertext[:12], ciphertext[12:], request.get('additional_authenticated_data'))
+      return argparse.Namespace(plaintext=plaintext)
+
+
+class FakeCertServer(object):
+    """Serves the x509 certificate of one generated service account key."""
+
+    def __init__(self, latency):
+      self.latency = latency
+      self.lock = threading.Lock()
+      self.calls = 0
+      self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+      name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'subscriber@replay.iam.gserviceaccount.com')])
+      now = datetime.datetime.now(datetime.timezone.utc)
+      cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+          self.private_key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+          now).not_valid_after(now + datetime.timedelta(days=1)).sign(self.private_key, hashes.SHA256())
+      self.pem = cert.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+    def get(self, key_id):
+      with self.lock:
+        self.calls += 1
+      self.latency.wait()
+      return self.pem
+
+
+class Symmetric(object):
+    """1_symmetric: one shared Tink AEAD key."""
+
+    def __init__(self, utils, kms, http):
+      self.cipher = utils.AESCipher(encoded_key=None)
+
+    def publish(self, record, payload):
+      return self.cipher.encrypt(payload, associated_data=''), {}
+
+    def receive(self, data, attributes):
+      return self.cipher.decrypt(data, associated_data='')
+
+
+class Svc(object):
+    """2_svc: a fresh DEK per message, wrapped with the recipient's certificate."""
+
+    def __init__(self, utils, kms, http):
+      self.utils = utils
+      self.http = http
+      self.lock = threading.Lock()
+      self.certs = {}
+      self.rsa = utils.RSACipher(private_key=http.private_key)
+
+    def publish(self, record, payload):
+      # the certificate is fetched again whenever the key epoch changes
+      epoch = record['key_epoch']
+      with self.lock:
+        rs = self.certs.get(epoch)
+      if rs is None:
+        rs = self.utils.RSACipher(public_key_pem=self.http.get(epoch))
+        with self.lock:
+          self.certs[epoch] = rs
+      cc = self.utils.AESCipher(encoded_key=None)
+      encrypted_payload = cc.encrypt(payload, associated_data="")
+      return encrypted_payload, {'dek_wrapped': rs.encrypt(self.utils.compact_key(cc.getKey()))}
+
+    def receive(self, data, attributes):
+      dek = self.utils.AESCipher(encoded_key=self.utils.expand_key(self.rsa.decrypt_bytes(attributes['dek_wrapped'])))
+      return dek.decrypt(data, associated_data="")
+
+
+class Kms(object):
+    """3_kms: one KMS encrypt and one KMS decrypt per message."""
+
+    name = 'projects/replay/locations/global/keyRings/replay/cryptoKeys/key1'
+
+    def __init__(self, utils, kms, http):
+      self.kms = kms
+
+    def publish(self, record, payload):
+      response = self.kms.encrypt(
+          request={'name': self.name, 'plaintext': payload, 'additional_authenticated_data': record['tenant'].encode('utf-8')})
+      return base64.b64encode(response.ciphertext), {'kms_key': self.name, 'tenant': record['tenant']}
+
+    def receive(self, data, attributes):
+      response = self.kms.decrypt(
+          request={'name': attributes['kms_key'], 'ciphertext': base64.b64decode(data), 'additional_authenticated_data': attributes['tenant'].encode('utf-8')})
+      return response.plaintext.decode('utf-8')
+
+
+class KmsDek(object):
+    """4_kms_dek: a KMS-wrapped DEK per tenant and key epoch, cached by the subscriber."""
+
+    name = Kms.name
+
+    def __init__(self, utils, kms, http):
+      self.utils = utils
+      self.kms = kms
+      self.lock = threading.Lock()
+      self.deks = {}
+      self.tenant_keys = {}
+
+    def publish(self, record, payload):
+      tenant = record['tenant']
+      with self.lock:
+        dek = self.deks.get((tenant, record['key_epoch']))
+      if dek is None:
+        cc = self.utils.AESCipher(encoded_key=None)
+        response = self.kms.encrypt(
+            request={'name': self.name, 'plaintext': self.utils.compact_key(cc.getKey()), 'additional_authenticated_data': tenant.encode('utf-8')})
+        wrapped = base64.b64encode(response.ciphertext).decode('utf-8')
+        dek = (cc, wrapped, self.utils.wrapped_key_id(wrapped))
+        with self.lock:
+          self.deks[(tenant, record['key_epoch'])] = dek
+      cc, wrapped, dek_id = dek
+      attributes = {'kms_key': self.name, 'tenant': tenant, 'dek_id': dek_id, 'dek_wrapped': wrapped}
+      return cc.encrypt(payload, associated_data=tenant), attributes
+
+    def receive(self, data, attributes):
+      tenant = attributes['tenant']
+      with self.lock:
+        keys = self.tenant_keys.get(tenant)
+        if keys is None:
+          keys = self.tenant_keys[tenant] = self.utils.TenantKeys(tenant, max_len=100, max_age_seconds=3600)
+      try:
+        return keys.dek_keyset.decrypt(data, associated_data=tenant)
+      except tink.TinkError:
+        dek_id = attributes['dek_id']
+        try:
+          if keys.dek_keyset.contains(keys.cache[dek_id]):
+            raise
+        except KeyError:
+          pass
+        response = self.kms.decrypt(
+            request={'name': attributes['kms_key'], 'ciphertext': base64.b64decode(attributes['dek_wrapped']), 'additional_authenticated_data': tenant.encode('utf-8')})
+        keys.cache[dek_id] = keys.dek_keyset.add(self.utils.expand_key(response.plaintext))
+        return keys.dek_keyset.decrypt(data, associated_data=tenant)
+
+
+schemes = {
+  'symmetric': Symmetric,
+  'svc': Svc,
+  'kms': Kms,
+  'kms_dek': KmsDek,
+}
+
+
+def synthetic_trace():
+  rng = random.Random(args.seed)
+  sizes, size_weights = weighted(args.sizes, int)
+  tenants, tenant_weights = weighted(args.tenants, str)
+  t = 0.0
+  trace = []
+  for i in range(args.messages):
+    trace.append({
+      't': round(t, 6),
+      'size': rng.choices(sizes, size_weights)[0],
+      'tenant': rng.choices(tenants, tenant_weights)[0],
+      'key_epoch': int(t // args.rotate_seconds),
+    })
+    t += rng.expovariate(args.rate)
+  return trace
+
+
+def load_trace():
+  if args.trace is not None:
+    with open(args.trace) as f:
+      return [json.loads(line) for line in f if line.strip()]
+  trace = synthetic_trace()
+  if args.save_trace is not None:
+    with open(args.save_trace, 'w') as f:
+      for record in trace:
+        f.write(json.dumps(record) + '\n')
+  return trace
+
+
+def cleartext(record):
+  # same shape as the message the publishers send, padded to the trace size
+  message = {
+    "data": "",
+    "attributes": {
+      'epoch_time': int(time.time()),
+      'tenant': record.get('tenant', 'tenantKey'),
+    }
+  }
+  message['data'] = 'x' * max(record['size'] - len(json.dumps(message)), 0)
+  return json.dumps(message).encode('utf-8')
+
+
+def percentile(ordered, q):
+  if not ordered:
+    return 0
+  return ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)]
+
+
+def run(scheme, trace):
+  kms = FakeKMS(Latency(args.kms_latency_ms))
+  http = FakeCertServer(Latency(args.http_latency_ms))
+  pubsub_latency = Latency(args.pubsub_latency_ms)
+  handler = schemes[scheme](load_utils(scheme), kms, http)
+  payloads = [cleartext(record) for record in trace]
+  latencies = []
+  errors = []
+  lock = threading.Lock()
+
+  def replay(record, payload, intended):
+    start = intended or time.perf_counter()
+    try:
+      data, attributes = handler.publish(record, payload)
+      pubsub_latency.wait()
+      handler.receive(data, attributes)
+      elapsed = time.perf_counter() - start
+      with lock:
+        latencies.append(elapsed)
+    except Exception as e:
+      with lock:
+        errors.append(str(e))
+
+  logging.info("Replaying {} messages through {}".format(len(trace), scheme))
+  cpu = time.process_time()
+  started = time.perf_counter()
+  with futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+    for record, payload in zip(trace, payloads):
+      intended = None
+      if args.speed > 0:
+        intended = started + record['t'] / args.speed
+        delay = intended - time.perf_counter()
+        if delay > 0:
+          time.sleep(delay)
+      executor.submit(replay, record, payload, intended)
+  wall = time.perf_counter() - started
+  cpu = time.process_time() - cpu
+
+  if errors:
+    logging.error("{}: {} messages failed, first error: {}".format(scheme, len(errors), errors[0]))
+  latencies.sort()
+  n = len(trace)
+  return {
+    'scheme': scheme,
+    'messages': n,
+    'errors': len(errors),
+    'throughput': n / wall,
+    'p50_ms': percentile(latencies, 0.50) * 1000,
+    'p99_ms': percentile(latencies, 0.99) * 1000,
+    'cpu_ms_per_message': cpu * 1000 / n,
+    'kms_calls_per_message': kms.calls / n,
+    'http_calls_per_message': http.calls / n,
+  }
+
+
+trace = load_trace()
+results = [run(scheme, trace) for scheme in args.schemes.split(',')]
+
+print('{:<10} {:>8} {:>10} {:>9} {:>9} {:>11} {:>8} {:>9}'.format(
+    'scheme', 'messages', 'msg/s', 'p50 ms', 'p99 ms', 'cpu ms/msg', 'kms/msg', 'http/msg'))
+for r in results:
+  print('{scheme:<10} {messages:>8} {throughput:>10.1f} {p50_ms:>9.2f} {p99_ms:>9.2f} {cpu_ms_per_message:>11.3f} {kms_calls_per_message:>8.3f} {http_calls_per_message:>9.3f}'.format(**r))
+
+if args.output is not None:
+  with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python startup.py --runs 20
+
+import argparse
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+parser = argparse.ArgumentParser(description='Measure cold start time of each scheme in fresh interpreters')
+parser.add_argument('--schemes',required=False, default='symmetric,svc,kms,kms_dek,unified', help='comma separated schemes to run')
+parser.add_argument('--runs',required=False, type=int, default=10, help='fresh processes per measurement')
+parser.add_argument('--scripts',required=False, default='publisher.py,subscriber.py', help='comma separated scripts to time with --help; empty to skip')
+parser.add_argument('--output',required=False, help='also write the results as JSON to this file')
+args = parser.parse_args()
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+scheme_dirs = {
+  'symmetric': '1_symmetric',
+  'svc': '2_svc',
+  'kms': '3_kms',
+  'kms_dek': '4_kms_dek',
+  'unified': '5_unified',
+}
+
+# the first local crypto operation a publisher or subscriber of each mode runs;
+# kms and unified do theirs in Cloud KMS or only once a message arrives
+first_ops = {
+  'symmetric': {
+    'encrypt': "c = utils.AESCipher(None); c.decrypt(c.encrypt(b'x', ''), '')",
+    'sign': "h = utils.HMACFunctions(None); h.hash(b'x')",
+  },
+  'svc': {
+    'encrypt': "c = utils.AESCipher(None); c.decrypt(c.encrypt(b'x', 't'), 't')",
+  },
+  'kms': {
+    'import': "",
+  },
+  'kms_dek': {
+    'encrypt': "c = utils.AESCipher(None); c.decrypt(c.encrypt(b'x', 't'), 't')",
+    'sign': "h = utils.HMACFunctions(None); h.hash(b'x')",
+  },
+  'unified': {
+    'import': "",
+  },
+}
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+import utils
+imported = time.perf_counter()
+{op}
+done = time.perf_counter()
+print(json.dumps({{'import_ms': (imported - start) * 1000, 'first_op_ms': (done - imported) * 1000}}))
+"""
+
+
+def percentiles(values):
+  values = sorted(values)
+  if not values:
+    return None, None
+  p50 = values[int(math.ceil(0.5 * len(values))) - 1]
+  p90 = values[int(math.ceil(0.9 * len(values))) - 1]
+  return p50, p90
+
+
+def run(command, cwd):
+  # returns (wall ms, stdout) of one fresh interpreter, or (None, stderr) if it failed
+  start = time.perf_counter()
+  p = subprocess.run(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  elapsed = (time.perf_counter() - start) * 1000
+  if p.returncode != 0:
+    return None, p.stderr.decode('utf-8', 'replace').strip().splitlines()[-1:]
+  return elapsed, p.stdout.decode('utf-8')
+
+
+def measure_utils(scheme, mode, op):
+  cwd = os.path.join(root, scheme_dirs[scheme])
+  command = [sys.executable, '-c', CHILD.format(op=op)]
+  samples = {'process_ms': [], 'import_ms': [], 'first_op_ms': []}
+  for i in range(args.runs):
+    elapsed, out = run(command, cwd)
+    if elapsed is None:
+      logging.error("{} {}: {}".format(scheme, mode, out))
+      return None
+    timings = json.loads(out.strip().splitlines()[-1])
+    samples['process_ms'].append(elapsed)
+    samples['import_ms'].append(timings['import_ms'])
+    samples['first_op_ms'].append(timings['first_op_ms'])
+  return {k: percentiles(v) for k, v in samples.items()}
+
+
+def measure_script(scheme, script):
+  # --help exits right after argparse, so this is interpreter start, imports and argument parsing
+  cwd = os.path.join(root, scheme_dirs[scheme])
+  if not os.path.exists(os.path.join(cwd, script)):
+    return None
+  samples = []
+  for i in range(args.runs):
+    elapsed, out = run([sys.executable, script, '--help'], cwd)
+    if elapsed is None:
+      logging.error("{} {}: {}".format(scheme, script, out))
+      return None
+    samples.append(elapsed)
+  return {'process_ms': percentiles(samples)}
+
+
+def fmt(pair):
+  if pair is None or pair[0] is None:
+    return '{:>17}'.format('-')
+  return '{:>8.1f}/{:<8.1f}'.format(pair[0], pair[1])
+
+
+results = []
+for scheme in args.schemes.split(','):
+  for mode, op in first_ops[scheme].items():
+    results.append({'scheme': scheme, 'target': 'utils ' + mode, 'timings': measure_utils(scheme, mode, op)})
+  for script in [s for s in args.scripts.split(',') if s]:
+    timings = measure_script(scheme, script)
+    if timings is not None:
+      results.append({'scheme': scheme, 'target': script + ' --help', 'timings': timings})
+
+print('{:<10} {:<22} {:>17} {:>17} {:>17}'.format('scheme', 'target', 'process p50/p90', 'import p50/p90', 'first op p50/p90'))
+for r in results:
+  t = r['timings'] or {}
+  print('{:<10} {:<22} {} {} {}'.format(r['scheme'], r['target'], fmt(t.get('process_ms')), fmt(t.get('import_ms')), fmt(t.get('first_op_ms'))))
+
+if args.output is not None:
+  with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
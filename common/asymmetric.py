@@ -0,0 +1,58 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cloud KMS keys a message may name, and local verification of asymmetric signatures."""
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.padding import MGF1, PSS
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+
+def kms_key_allowed(name, allowed):
+    # allowed lists crypto keys, which cover every version, or single key versions.  The
+    # kms_key attribute is the sender's to set, so it must not pick the key that checks it
+    return any(name == key or name.startswith(key + '/cryptoKeyVersions/') for key in allowed)
+
+
+class AsymmetricVerifier(object):
+    """Verifies Cloud KMS asymmetric_sign signatures locally.
+
+    Built from the PEM and algorithm that get_public_key returns for a key
+    version.  Supports EC_SIGN_P256_SHA256 and RSA_SIGN_PSS_*_SHA256; the
+    signature covers a SHA-256 digest.
+    """
+
+    def __init__(self, public_key_pem, algorithm):
+      if algorithm == 'EC_SIGN_P256_SHA256':
+        self.padding = None
+      elif algorithm.startswith('RSA_SIGN_PSS_') and algorithm.endswith('_SHA256'):
+        # Cloud KMS uses a salt as long as the digest
+        self.padding = PSS(mgf=MGF1(hashes.SHA256()), salt_length=32)
+      else:
+        raise ValueError("unsupported signing algorithm " + algorithm)
+      self.algorithm = algorithm
+      self.public_key = load_pem_public_key(public_key_pem.encode('utf-8'))
+
+    def verify(self, digest, signature):
+      try:
+        if self.padding is None:
+          self.public_key.verify(signature, digest, ec.ECDSA(Prehashed(hashes.SHA256())))
+        else:
+          self.public_key.verify(signature, digest, self.padding, Prehashed(hashes.SHA256()))
+        return True
+      except InvalidSignature:
+        return False
@@ -0,0 +1,65 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Command line options every publisher or every subscriber takes."""
+
+
+def _add_metrics_args(parser):
+  parser.add_argument('--metrics_port',required=False, type=int, help='Optional port to serve Prometheus /metrics on')
+  parser.add_argument('--profile_dir',required=False, default='.', help='directory SIGUSR1 or /profile writes collapsed stack samples to')
+  parser.add_argument('--profile_seconds',required=False, type=int, default=30, help='seconds each profile samples for')
+
+
+def _add_grpc_args(parser, pool):
+  # pool: the script makes KMS calls, which ClientRegistry spreads over a pool of channels
+  if pool:
+    parser.add_argument('--grpc_channels',required=False, type=int, default=1, help='gRPC connections the KMS client spreads its calls over')
+  parser.add_argument('--grpc_keepalive_ms',required=False, type=int, default=30000, help='ping idle gRPC connections after this many milliseconds so they are not dropped')
+  if pool:
+    parser.add_argument('--grpc_max_streams',required=False, type=int, default=100, help='KMS calls in flight per gRPC connection; more wait for a free one')
+
+
+def add_publisher_args(parser, grpc_pool=False):
+  """Adds the metrics, profiler, load generator, ordering key and gRPC options."""
+  _add_metrics_args(parser)
+  parser.add_argument('--load_rate',required=False, type=float, help='Optional load generator mode: target messages per second across all publishers')
+  parser.add_argument('--load_duration',required=False, type=float, default=60, help='load generator: seconds to publish for')
+  parser.add_argument('--load_sizes',required=False, default='1024', help='load generator: data sizes in bytes with optional weights, eg 256:0.8,65536:0.2')
+  parser.add_argument('--load_attributes',required=False, type=int, default=1, help='load generator: distinct values of the load_key attribute')
+  parser.add_argument('--load_publishers',required=False, type=int, default=1, help='load generator: concurrent publisher threads')
+  parser.add_argument('--ordering_key',required=False, help='Optional ordering key to publish with; in load generator mode each load_key gets its own ordering key')
+  _add_grpc_args(parser, grpc_pool)
+
+
+def add_subscriber_args(parser, grpc_pool=False, negative_cache=True, trace_slowest=True):
+  """Adds the metrics, profiler, quarantine, negative cache, warm-up, gRPC and replay options.
+
+  negative_cache=False leaves out --negative_ttl, for schemes without wrapped
+  keys or key references, and trace_slowest=False leaves out --trace_slowest,
+  for subscribers whose stages are not traced.
+  """
+  _add_metrics_args(parser)
+  if trace_slowest:
+    parser.add_argument('--trace_slowest',required=False, type=int, default=0, help='keep the stage breakdown of the N slowest messages (SIGUSR2 or /slowest)')
+  if negative_cache:
+    parser.add_argument('--negative_ttl',required=False, type=int, default=300, help='seconds a wrapped key or key reference that failed stays known-bad (0: off)')
+  parser.add_argument('--max_failures',required=False, type=int, default=5, help='failures before a message is written to --dead_letter_file and acked (0: never)')
+  parser.add_argument('--nack_delay',required=False, type=int, default=10, help='seconds before a failed message is redelivered, doubled per failure up to 600')
+  parser.add_argument('--dead_letter_file',required=False, default='dead_letter.jsonl', help='JSON lines file quarantined messages are appended to')
+  parser.add_argument('--no_warmup',required=False, action='store_true', help='subscribe at once, without the warm-up checks /readyz waits for')
+  _add_grpc_args(parser, grpc_pool)
+  parser.add_argument('--replay_window',required=False, type=int, default=0, help='drop messages whose epoch_time is more than N seconds from now, and repeats of a message within that time (0: off)')
+  parser.add_argument('--replay_capacity',required=False, type=int, default=1000000, help='with --replay_window, messages per window the replay filters are sized for')
+  parser.add_argument('--replay_error_rate',required=False, type=float, default=1e-6, help='with --replay_window, chance per filter that a new message is taken for a repeat')
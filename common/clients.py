@@ -0,0 +1,293 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Long-lived Pub/Sub and KMS clients, and the pieces of the asyncio subscriber."""
+
+import collections
+import functools
+import logging
+import os
+import threading
+import time
+
+
+class _PooledCall(object):
+    # one unary method over every channel of a _ChannelPool
+
+    def __init__(self, pool, callables):
+      self.pool = pool
+      self.callables = callables
+
+    def __call__(self, *args, **kwargs):
+      i = self.pool.acquire()
+      try:
+        return self.callables[i](*args, **kwargs)
+      finally:
+        self.pool.release(i)
+
+    def with_call(self, *args, **kwargs):
+      i = self.pool.acquire()
+      try:
+        return self.callables[i].with_call(*args, **kwargs)
+      finally:
+        self.pool.release(i)
+
+    def future(self, *args, **kwargs):
+      i = self.pool.acquire()
+      try:
+        future = self.callables[i].future(*args, **kwargs)
+      except Exception:
+        self.pool.release(i)
+        raise
+      future.add_done_callback(lambda f: self.pool.release(i))
+      return future
+
+
+class _ChannelPool(object):
+    """Several gRPC channels, each its own HTTP/2 connection, used as one.
+
+    A unary call goes to the channel with the fewest calls in flight and
+    waits while every channel already carries max_streams calls, the
+    concurrent stream limit of a connection.  Streaming calls, which only
+    the Pub/Sub clients make, stay on the first channel.
+    """
+
+    def __init__(self, channels, max_streams):
+      self.channels = channels
+      self.max_streams = max_streams
+      self.in_flight = [0] * len(channels)
+      self.condition = threading.Condition()
+
+    def acquire(self):
+      with self.condition:
+        while min(self.in_flight) >= self.max_streams:
+          self.condition.wait()
+        i = self.in_flight.index(min(self.in_flight))
+        self.in_flight[i] += 1
+        return i
+
+    def release(self, i):
+      with self.condition:
+        self.in_flight[i] -= 1
+        self.condition.notify()
+
+    def unary_unary(self, method, *args, **kwargs):
+      return _PooledCall(self, [c.unary_unary(method, *args, **kwargs) for c in self.channels])
+
+    def unary_stream(self, method, *args, **kwargs):
+      return self.channels[0].unary_stream(method, *args, **kwargs)
+
+    def stream_unary(self, method, *args, **kwargs):
+      return self.channels[0].stream_unary(method, *args, **kwargs)
+
+    def stream_stream(self, method, *args, **kwargs):
+      return self.channels[0].stream_stream(method, *args, **kwargs)
+
+    def subscribe(self, callback, try_to_connect=False):
+      self.channels[0].subscribe(callback, try_to_connect=try_to_connect)
+
+    def unsubscribe(self, callback):
+      self.channels[0].unsubscribe(callback)
+
+    def close(self):
+      for c in self.channels:
+        c.close()
+
+
+class ClientRegistry(object):
+    """The process's long-lived Pub/Sub and Cloud KMS clients.
+
+    Clients are created on first use and shared by every caller after that,
+    so publishes go through one set of batches and calls reuse open HTTP/2
+    connections instead of each creating their own.  Every channel pings the
+    server after keepalive_ms without traffic, so idle connections are not
+    dropped by NAT or load balancers between bursts.  With channels > 1 the
+    KMS client spreads its calls over that many connections, at most
+    max_streams at a time on each (Google front ends allow 100).
+    """
+
+    def __init__(self, channels=1, keepalive_ms=30000, max_streams=100):
+      self.channels = channels
+      self.max_streams = max_streams
+      self.options = [
+        ('grpc.keepalive_time_ms', keepalive_ms),
+        ('grpc.keepalive_timeout_ms', 10000),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.max_pings_without_data', 0),
+      ]
+      self.lock = threading.Lock()
+      self.clients = {}
+      # the credentials each client's transport handed its channel
+      self.channel_credentials = {}
+
+    def _channel(self, transport_class, pooled, key):
+      # the transport passes its own options (message size limits); ours replace any it also sets
+      def create(host, **kwargs):
+        self.channel_credentials[key] = kwargs.get('credentials')
+        ours = dict(self.options)
+        options = [o for o in kwargs.pop('options', None) or [] if o[0] not in ours] + self.options
+        if not pooled or self.channels <= 1:
+          return transport_class.create_channel(host, options=options, **kwargs)
+        # a local subchannel pool keeps each channel on its own connection
+        return _ChannelPool([transport_class.create_channel(host, options=options + [('grpc.use_local_subchannel_pool', 1)], **kwargs)
+                             for i in range(self.channels)], self.max_streams)
+      return create
+
+    def _get(self, key, create):
+      with self.lock:
+        client = self.clients.get(key)
+        if client is None:
+          client = self.clients[key] = create()
+        return client
+
+    def credentials(self, client):
+      # what client authenticates with, for Warmup.connect; None for the emulator's insecure channel
+      with self.lock:
+        for key, c in self.clients.items():
+          if c is client:
+            return self.channel_credentials.get(key)
+      return None
+
+    def publisher(self, publisher_options=None):
+      from google.cloud import pubsub
+      from google.pubsub_v1.services.publisher.transports.grpc import PublisherGrpcTransport
+      key = ('publisher', publisher_options)
+      def create():
+        kwargs = {}
+        if publisher_options is not None:
+          kwargs['publisher_options'] = publisher_options
+        # the client sets up its own insecure channel for the emulator
+        if not os.environ.get('PUBSUB_EMULATOR_HOST'):
+          kwargs['transport'] = functools.partial(PublisherGrpcTransport, channel=self._channel(PublisherGrpcTransport, False, key))
+        return pubsub.PublisherClient(**kwargs)
+      return self._get(key, create)
+
+    def subscriber(self):
+      from google.cloud import pubsub
+      from google.pubsub_v1.services.subscriber.transports.grpc import SubscriberGrpcTransport
+      def create():
+        if os.environ.get('PUBSUB_EMULATOR_HOST'):
+          return pubsub.SubscriberClient()
+        return pubsub.SubscriberClient(transport=functools.partial(SubscriberGrpcTransport, channel=self._channel(SubscriberGrpcTransport, False, 'subscriber')))
+      return self._get('subscriber', create)
+
+    def async_subscriber(self):
+      # the asyncio gapic client, for unary pull; create it on the event loop that will use it
+      from google.pubsub_v1.services.subscriber import SubscriberAsyncClient
+      from google.pubsub_v1.services.subscriber.transports.grpc_asyncio import SubscriberGrpcAsyncIOTransport
+      def create():
+        emulator = os.environ.get('PUBSUB_EMULATOR_HOST')
+        if emulator:
+          import grpc
+          return SubscriberAsyncClient(transport=SubscriberGrpcAsyncIOTransport(channel=grpc.aio.insecure_channel(emulator)))
+        return SubscriberAsyncClient(transport=functools.partial(SubscriberGrpcAsyncIOTransport, channel=self._channel(SubscriberGrpcAsyncIOTransport, False, 'async_subscriber')))
+      return self._get('async_subscriber', create)
+
+    def kms(self):
+      from google.cloud import kms
+      from google.cloud.kms_v1.services.key_management_service.transports.grpc import KeyManagementServiceGrpcTransport
+      def create():
+        return kms.KeyManagementServiceClient(transport=functools.partial(KeyManagementServiceGrpcTransport, channel=self._channel(KeyManagementServiceGrpcTransport, True, 'kms')))
+      return self._get('kms', create)
+
+
+class PulledMessage(object):
+    """A message from a unary pull, with the methods of a streaming pull message.
+
+    ack(), nack() and modify_ack_deadline() queue the ack id on an AsyncAcker
+    instead of making a call, so Quarantine and the replay checks work on it
+    unchanged.
+    """
+
+    def __init__(self, received, acker):
+      message = received.message
+      self.ack_id = received.ack_id
+      self.delivery_attempt = received.delivery_attempt or None
+      self.message_id = message.message_id
+      self.publish_time = message.publish_time
+      self.ordering_key = message.ordering_key
+      self.attributes = dict(message.attributes)
+      self.data = message.data
+      self.acker = acker
+      acker.lease(self.ack_id)
+
+    def ack(self):
+      self.acker.ack(self.ack_id)
+
+    def nack(self):
+      self.acker.modify_ack_deadline(self.ack_id, 0)
+
+    def modify_ack_deadline(self, seconds):
+      self.acker.modify_ack_deadline(self.ack_id, seconds)
+
+    def drop(self):
+      # nothing is held locally once the ack deadline is set
+      pass
+
+
+class AsyncAcker(object):
+    """Batches the acks and ack deadline changes of pulled messages.
+
+    run() sends what was queued every interval seconds, up to 2500 ack ids per
+    call.  Messages still being processed have their ack deadline extended to
+    lease_seconds every lease_seconds / 3, so a slow certificate fetch does not
+    get a message redelivered while it waits.
+    """
+
+    MAX_ACK_IDS = 2500
+
+    def __init__(self, client, subscription, interval=0.1, lease_seconds=60):
+      self.client = client
+      self.subscription = subscription
+      self.interval = interval
+      self.lease_seconds = lease_seconds
+      self.acks = []
+      self.deadlines = collections.defaultdict(list)
+      self.leased = set()
+
+    def lease(self, ack_id):
+      self.leased.add(ack_id)
+
+    def ack(self, ack_id):
+      self.leased.discard(ack_id)
+      self.acks.append(ack_id)
+
+    def modify_ack_deadline(self, ack_id, seconds):
+      self.leased.discard(ack_id)
+      self.deadlines[seconds].append(ack_id)
+
+    async def flush(self):
+      acks, self.acks = self.acks, []
+      deadlines, self.deadlines = self.deadlines, collections.defaultdict(list)
+      for i in range(0, len(acks), self.MAX_ACK_IDS):
+        await self.client.acknowledge(subscription=self.subscription, ack_ids=acks[i:i + self.MAX_ACK_IDS])
+      for seconds, ack_ids in deadlines.items():
+        for i in range(0, len(ack_ids), self.MAX_ACK_IDS):
+          await self.client.modify_ack_deadline(subscription=self.subscription, ack_ids=ack_ids[i:i + self.MAX_ACK_IDS],
+                                                ack_deadline_seconds=seconds)
+
+    async def run(self):
+      import asyncio
+      renewed = time.monotonic()
+      while True:
+        await asyncio.sleep(self.interval)
+        if self.leased and time.monotonic() - renewed >= self.lease_seconds / 3:
+          renewed = time.monotonic()
+          for ack_id in list(self.leased):
+            self.deadlines[self.lease_seconds].append(ack_id)
+        try:
+          await self.flush()
+        except Exception as e:
+          # the ack ids are lost; those messages are redelivered once their deadline passes
+          logging.error("Unable to send acks: " + str(e))
@@ -0,0 +1,567 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tink AEAD and MAC keys, their raw-key fast paths and batch methods, and RSA key wrapping."""
+
+import base64
+import binascii
+import concurrent.futures
+import functools
+import io
+import logging
+import os
+import struct
+import threading
+import time
+
+from hmac import compare_digest, digest as hmac_digest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.padding import MGF1, OAEP
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import tink
+from tink import aead, cleartext_keyset_handle, mac, proto_keyset_format, secret_key_access
+from tink.proto import aes_gcm_pb2, aes_gcm_siv_pb2, common_pb2, hmac_pb2, tink_pb2, xchacha20_poly1305_pb2
+
+
+# Tink primitive sets are registered the first time a class needs one, not at import;
+# registering everything (tink_config.register) costs a cold start for nothing
+_registered = set()
+
+
+def _register(primitive):
+  if primitive not in _registered:
+    if primitive == 'streaming_aead':
+      # `import tink` does not load streaming_aead; only blob payloads need it
+      from tink import streaming_aead
+      streaming_aead.register()
+    else:
+      {'aead': aead, 'mac': mac}[primitive].register()
+    _registered.add(primitive)
+
+
+# key templates publishers may generate keys with.  Subscribers need no setting:
+# the key type travels in the keyset, and Tink picks the key by its prefix
+KEY_TEMPLATES = {
+  'aead': ['AES256_GCM', 'AES256_GCM_SIV', 'XCHACHA20_POLY1305'],
+  'mac': ['HMAC_SHA256_256BITTAG', 'HMAC_SHA512_256BITTAG'],
+}
+
+
+def key_template(primitive, name):
+  if name not in KEY_TEMPLATES[primitive]:
+    raise ValueError('{} is not one of the {} templates: {}'.format(name, primitive, ', '.join(KEY_TEMPLATES[primitive])))
+  return getattr({'aead': aead.aead_key_templates, 'mac': mac.mac_key_templates}[primitive], name)
+
+
+def fastest_template(primitive, names=None, size=16384, seconds=0.2):
+  """Times each template on this host and returns the name of the fastest.
+
+  Every template encrypts (aead) or computes a tag over (mac) size random
+  bytes for about seconds, with a fresh key.  AES-GCM wins on CPUs with
+  AES-NI; without it XChaCha20-Poly1305 usually does, and HMAC-SHA512 is
+  faster than HMAC-SHA256 for large messages on 64 bit CPUs without SHA
+  extensions.
+  """
+  _register(primitive)
+  data = os.urandom(size)
+  speeds = {}
+  for name in names or KEY_TEMPLATES[primitive]:
+    handle = tink.new_keyset_handle(key_template(primitive, name))
+    if primitive == 'aead':
+      op = functools.partial(handle.primitive(aead.Aead).encrypt, data, b'')
+    else:
+      op = functools.partial(handle.primitive(mac.Mac).compute_mac, data)
+    op()
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+      op()
+      count += 1
+    speeds[name] = count * size / (time.perf_counter() - start)
+  fastest = max(speeds, key=speeds.get)
+  logging.info('{} templates, MB/s: {}; using {}'.format(
+      primitive, ', '.join('{} {:.0f}'.format(name, speed / 1e6) for name, speed in speeds.items()), fastest))
+  return fastest
+
+
+def _to_bytes(data):
+  if isinstance(data, str):
+    return data.encode('utf-8')
+  # a no-op for bytes; copies a bytearray or memoryview once
+  return bytes(data)
+
+
+def _batch_items(items):
+  # the items of a batch as buffers the raw AES-GCM and HMAC calls take: str is
+  # encoded once, bytes, bytearray and memoryview items are passed on uncopied
+  return [item.encode('utf-8') if isinstance(item, str) else item for item in items]
+
+
+def _cleartext_keyset(keyset_handle):
+  # the handle's own keyset, with its key material; getKey() is encrypted when the keyset came from key_uri
+  return tink_pb2.Keyset.FromString(proto_keyset_format.serialize(keyset_handle, secret_key_access.TOKEN))
+
+
+def _output_prefix(key):
+  # the bytes Tink puts in front of a ciphertext or tag of this key; None for
+  # the legacy formats, which only Tink itself handles
+  if key.output_prefix_type == tink_pb2.TINK:
+    return b'\x01' + struct.pack('>I', key.key_id)
+  if key.output_prefix_type == tink_pb2.RAW:
+    return b''
+  return None
+
+
+def _aes_gcm_keys(keyset):
+  # raw AES-GCM keys of a keyset by ciphertext prefix, so ciphertext can be
+  # decrypted straight into a caller's buffer instead of a new bytes object
+  keys = {}
+  for key in keyset.key:
+    if key.status != tink_pb2.ENABLED or key.key_data.type_url != 'type.googleapis.com/google.crypto.tink.AesGcmKey':
+      continue
+    prefix = _output_prefix(key)
+    if prefix is not None:
+      keys[prefix] = AESGCM(aes_gcm_pb2.AesGcmKey.FromString(key.key_data.value).key_value)
+  return keys
+
+
+def _raw_primary(keyset, raw_keys_of):
+  # (prefix, raw key) of the keyset's primary key, or (None, None) if only Tink can use it
+  primary = [key for key in keyset.key if key.key_id == keyset.primary_key_id]
+  return next(iter(raw_keys_of(tink_pb2.Keyset(key=primary)).items()), (None, None))
+
+
+def _raw_key(raw_keys, view):
+  # the raw key a ciphertext or tag was made with, and the length of its prefix
+  key = raw_keys.get(bytes(view[:5]))
+  if key is not None:
+    return key, 5
+  return raw_keys.get(b''), 0
+
+
+def _decrypt(raw_keys, primitive, ciphertext, associated_data):
+  # Tink AES-GCM ciphertext is prefix || 12 byte IV || ciphertext || 16 byte tag
+  view = memoryview(ciphertext)
+  key, prefix = _raw_key(raw_keys, view)
+  if key is not None and len(view) >= prefix + 28:
+    try:
+      return key.decrypt(view[prefix:prefix + 12], view[prefix + 12:], associated_data)
+    except InvalidTag:
+      pass
+  return primitive.decrypt(ciphertext, associated_data)
+
+
+def _decrypt_into(raw_keys, primitive, ciphertext, associated_data, buffer):
+  view = memoryview(ciphertext)
+  key, prefix = _raw_key(raw_keys, view)
+  if key is not None and hasattr(key, 'decrypt_into') and len(view) >= prefix + 28:
+    out = memoryview(buffer)[:len(view) - prefix - 28]
+    try:
+      key.decrypt_into(view[prefix:prefix + 12], view[prefix + 12:], associated_data, out)
+      return out
+    except InvalidTag:
+      pass
+  # older cryptography releases, or a key only Tink knows how to use
+  plaintext = primitive.decrypt(ciphertext, associated_data)
+  out = memoryview(buffer)[:len(plaintext)]
+  out[:] = plaintext
+  return out
+
+
+_HMAC_HASHES = {
+  common_pb2.SHA1: 'sha1',
+  common_pb2.SHA224: 'sha224',
+  common_pb2.SHA256: 'sha256',
+  common_pb2.SHA384: 'sha384',
+  common_pb2.SHA512: 'sha512',
+}
+
+
+def _hmac_keys(keyset):
+  # raw HMAC keys of a keyset by tag prefix, as (key, hash name, tag size)
+  keys = {}
+  for key in keyset.key:
+    if key.status != tink_pb2.ENABLED or key.key_data.type_url != 'type.googleapis.com/google.crypto.tink.HmacKey':
+      continue
+    prefix = _output_prefix(key)
+    hmac_key = hmac_pb2.HmacKey.FromString(key.key_data.value)
+    if prefix is not None and hmac_key.params.hash in _HMAC_HASHES:
+      keys[prefix] = (hmac_key.key_value, _HMAC_HASHES[hmac_key.params.hash], hmac_key.params.tag_size)
+  return keys
+
+
+def _verify_mac(raw_keys, primitive, data, tag):
+  view = memoryview(tag)
+  key, prefix = _raw_key(raw_keys, view)
+  if key is not None:
+    secret, hash_name, tag_size = key
+    if compare_digest(hmac_digest(secret, data, hash_name)[:tag_size], view[prefix:]):
+      return True
+  # a tag of another key with the same prefix, or one only Tink can check
+  try:
+    primitive.verify_mac(_to_bytes(tag), _to_bytes(data))
+    return True
+  except tink.TinkError:
+    return False
+
+
+# the *_many methods split large batches across threads: the raw AES-GCM and
+# HMAC calls release the GIL, so the threads run on all cores at once.  Below
+# BATCH_PARALLEL_BYTES handing items to other threads costs more than it saves
+BATCH_PARALLEL_BYTES = 1 << 20
+
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+
+def _batch_executor():
+  global _batch_pool
+  with _batch_pool_lock:
+    if _batch_pool is None:
+      _batch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='crypto-batch')
+  return _batch_pool
+
+
+def _run_batch(one, sizes, workers=None):
+  """Calls one(i) for each item of a batch whose item lengths are sizes.
+
+  Returns (results, errors): errors maps the index of every item that raised
+  to its exception, and results holds None at those indexes.  One bad item
+  does not stop the others.
+  """
+  count = len(sizes)
+  results = [None] * count
+  errors = {}
+
+  def run(start, end):
+    for i in range(start, end):
+      try:
+        results[i] = one(i)
+      except Exception as e:
+        errors[i] = e
+
+  if workers is None:
+    workers = os.cpu_count() or 1
+  total = sum(sizes)
+  if workers < 2 or count < 2 or total < BATCH_PARALLEL_BYTES:
+    run(0, count)
+    return results, errors
+  # runs of consecutive items of about equal bytes, a few per worker so one slow run does not hold up the batch
+  target = total / (workers * 4)
+  runs = []
+  start = size_sum = 0
+  for i, size in enumerate(sizes):
+    size_sum += size
+    if size_sum >= target:
+      runs.append((start, i + 1))
+      start, size_sum = i + 1, 0
+  if start < count:
+    runs.append((start, count))
+  pool = _batch_executor()
+  for future in [pool.submit(run, start, end) for start, end in runs]:
+    future.result()
+  return results, errors
+
+
+def _decrypt_many(raw_keys, primitive, ciphertexts, associated_data, buffer, workers, encoded):
+  # base64 decoding holds the GIL and runs at a fraction of AES-GCM speed; encoded=False
+  # takes the raw Tink ciphertext instead, eg from a backfill that stored it as is
+  decode = binascii.a2b_base64 if encoded else _to_bytes
+  ciphertexts = _batch_items(ciphertexts)
+  sizes = [len(c) for c in ciphertexts]
+  if buffer is None:
+    def one(i):
+      return _decrypt(raw_keys, primitive, decode(ciphertexts[i]), associated_data)
+    return _run_batch(one, sizes, workers)
+  # every ciphertext gets its own slice of the buffer; base64 decodes to at most 3/4 of its length
+  offsets = [0]
+  for size in sizes:
+    offsets.append(offsets[-1] + (size * 3 // 4 if encoded else size))
+  view = memoryview(buffer)
+  if len(view) < offsets[-1]:
+    raise ValueError('buffer holds {} bytes, the batch needs {}'.format(len(view), offsets[-1]))
+  def one(i):
+    return _decrypt_into(raw_keys, primitive, decode(ciphertexts[i]), associated_data, view[offsets[i]:offsets[i + 1]])
+  return _run_batch(one, sizes, workers)
+
+
+# wrapped keys: the byte that names a key type in the compact form, and the
+# Tink key it is rebuilt as.  The numbers are shared by every scheme
+COMPACT_KEY_VERSION = 1
+
+
+_COMPACT_KEY_TYPES = {
+  1: ('type.googleapis.com/google.crypto.tink.AesGcmKey', aes_gcm_pb2.AesGcmKey, None),
+  2: ('type.googleapis.com/google.crypto.tink.AesGcmSivKey', aes_gcm_siv_pb2.AesGcmSivKey, None),
+  3: ('type.googleapis.com/google.crypto.tink.XChaCha20Poly1305Key', xchacha20_poly1305_pb2.XChaCha20Poly1305Key, None),
+  4: ('type.googleapis.com/google.crypto.tink.HmacKey', hmac_pb2.HmacKey, hmac_pb2.HmacParams(hash=common_pb2.SHA256, tag_size=32)),
+  5: ('type.googleapis.com/google.crypto.tink.HmacKey', hmac_pb2.HmacKey, hmac_pb2.HmacParams(hash=common_pb2.SHA512, tag_size=32)),
+}
+
+
+def _compact_key_data(key_type, raw_key):
+  type_url, key_class, params = _COMPACT_KEY_TYPES[key_type]
+  if params is None:
+    return key_class(version=0, key_value=raw_key).SerializeToString()
+  return key_class(version=0, params=params, key_value=raw_key).SerializeToString()
+
+
+def _keyset(type_url, value, key_id):
+  # a single-key Tink keyset (TINK output prefix), base64 encoded
+  keyset = tink_pb2.Keyset(primary_key_id=key_id)
+  key = keyset.key.add()
+  key.key_data.type_url = type_url
+  key.key_data.value = value
+  key.key_data.key_material_type = tink_pb2.KeyData.SYMMETRIC
+  key.status = tink_pb2.ENABLED
+  key.key_id = key_id
+  key.output_prefix_type = tink_pb2.TINK
+  return base64.b64encode(keyset.SerializeToString()).decode('utf-8')
+
+
+def compact_key(encoded_key):
+  """Returns the compact wrapped form of a single-key Tink keyset, or None.
+
+  The compact form is version || key type || 4 byte Tink key id || raw key:
+  38 bytes for a 256 bit key instead of the base64 of the whole keyset.
+  Keysets with more than one key, or a key type or prefix it has no code
+  for, have no compact form and are wrapped whole.
+  """
+  keyset = tink_pb2.Keyset.FromString(base64.b64decode(encoded_key))
+  if len(keyset.key) != 1 or keyset.key[0].output_prefix_type != tink_pb2.TINK:
+    return None
+  key = keyset.key[0]
+  for key_type, (type_url, key_class, params) in _COMPACT_KEY_TYPES.items():
+    if key.key_data.type_url != type_url:
+      continue
+    raw_key = key_class.FromString(key.key_data.value).key_value
+    # HMAC keys of either hash share a type url; only the one that rebuilds the same key matches
+    if _compact_key_data(key_type, raw_key) == key.key_data.value:
+      return struct.pack('>BBI', COMPACT_KEY_VERSION, key_type, key.key_id) + raw_key
+  return None
+
+
+def expand_key(unwrapped):
+  # the base64 keyset an unwrapped key stands for; a whole keyset, as older
+  # publishers wrap, is base64 text and never starts with the version byte
+  if unwrapped[:1] != bytes([COMPACT_KEY_VERSION]):
+    return unwrapped
+  if len(unwrapped) < 6:
+    raise ValueError('compact key too short')
+  version, key_type, key_id = struct.unpack('>BBI', unwrapped[:6])
+  if key_type not in _COMPACT_KEY_TYPES:
+    raise ValueError('unknown compact key type {}'.format(key_type))
+  return _keyset(_COMPACT_KEY_TYPES[key_type][0], _compact_key_data(key_type, bytes(unwrapped[6:])), key_id)
+
+
+class RSACipher(object):
+
+   public_key = None
+   private_key = None
+
+   def __init__(self, public_key_pem = None, private_key = None, public_key = None):
+     if public_key_pem  is not None:
+       from cryptography.x509 import load_pem_x509_certificate
+       self.public_key = load_pem_x509_certificate(public_key_pem.encode(), backend=default_backend()).public_key()
+     if public_key is not None:
+       self.public_key = public_key
+     if private_key is not None:
+       self.private_key = private_key
+
+   def encrypt(self, raw):
+     return  base64.b64encode(self.public_key.encrypt(
+       raw, OAEP( mgf=MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),label=None)))
+
+   def decrypt(self, raw):
+     return  self.private_key.decrypt(base64.b64decode(raw), OAEP( mgf=MGF1(algorithm=hashes.SHA256()),algorithm=hashes.SHA256(), label=None )).decode('utf-8').strip()
+
+   def decrypt_bytes(self, raw):
+     # the plaintext as is, without the utf-8 decode and strip() of decrypt()
+     return  self.private_key.decrypt(binascii.a2b_base64(raw), OAEP( mgf=MGF1(algorithm=hashes.SHA256()),algorithm=hashes.SHA256(), label=None ))
+
+
+class AESCipher(object):
+
+    def __init__(self, encoded_key, key_uri=None, template='AES256_GCM'):
+      _register('aead')
+      self.gcp_aead = None
+      if key_uri != None:
+        # the Cloud KMS client library takes a long time to import; only key_uri needs it
+        from tink.integration import gcpkms
+        gcp_client = gcpkms.GcpKmsClient(key_uri=key_uri,credentials_path="")
+        self.gcp_aead = gcp_client.get_aead(key_uri)
+      if (encoded_key==None):
+        self.keyset_handle = tink.new_keyset_handle(key_template('aead', template))
+      elif self.gcp_aead != None:
+        reader = tink.BinaryKeysetReader(base64.b64decode(encoded_key))
+        self.keyset_handle = tink.KeysetHandle.read(reader, self.gcp_aead)
+      else:
+        reader = tink.BinaryKeysetReader(base64.b64decode(encoded_key))
+        self.keyset_handle = cleartext_keyset_handle.read(reader)
+      self.key=self.keyset_handle.keyset_info()
+      self.aead_primitive = self.keyset_handle.primitive(aead.Aead)
+      self.raw_keys = None
+
+    def printKeyInfo(self):
+      stream = io.StringIO()
+      writer = tink.JsonKeysetWriter(stream)    
+      cleartext_keyset_handle.write(writer, self.keyset_handle)
+      return stream.getvalue()
+
+    def getKey(self):
+      # the keyset encrypted with the key_uri KMS key when there is one, else in cleartext
+      iostream = io.BytesIO()
+      writer = tink.BinaryKeysetWriter(iostream)
+      if self.gcp_aead != None:
+        self.keyset_handle.write(writer,self.gcp_aead)
+      else:
+        cleartext_keyset_handle.write(writer, self.keyset_handle)
+      encoded_key = base64.b64encode(iostream.getvalue()).decode('utf-8')
+      return encoded_key
+
+    def encrypt(self, plaintext, associated_data):
+      try:
+        ciphertext = self.aead_primitive.encrypt(plaintext, associated_data.encode('utf-8'))
+        base64_bytes = base64.b64encode(ciphertext)
+        return (base64_bytes.decode('utf-8'))  
+      except tink.TinkError as e:
+        raise e      
+
+    def decrypt(self, ciphertext, associated_data):
+      try:
+        plaintext = self.aead_primitive.decrypt(base64.b64decode(ciphertext), associated_data.encode('utf-8'))
+        return(plaintext.decode('utf-8'))
+      except tink.TinkError as e:
+        raise e
+
+    def decrypt_bytes(self, ciphertext, associated_data=b''):
+      # accepts the base64 message data as str, bytes or memoryview and returns bytes as is
+      return self.aead_primitive.decrypt(binascii.a2b_base64(ciphertext), _to_bytes(associated_data))
+
+    def _raw_keys(self):
+      if self.raw_keys is None:
+        keyset = _cleartext_keyset(self.keyset_handle)
+        self.raw_primary = _raw_primary(keyset, _aes_gcm_keys)
+        self.raw_keys = _aes_gcm_keys(keyset)
+      return self.raw_keys
+
+    def decrypt_into(self, ciphertext, associated_data, buffer):
+      # decrypts into a preallocated buffer and returns a memoryview over the plaintext in it
+      return _decrypt_into(self._raw_keys(), self.aead_primitive, binascii.a2b_base64(ciphertext), _to_bytes(associated_data), buffer)
+
+    def encrypt_many(self, plaintexts, associated_data=b'', workers=None, encoded=True):
+      # returns (ciphertexts, errors): base64 ciphertexts as bytes, ready to publish, and None where errors has the index;
+      # encoded=False returns the raw Tink ciphertexts
+      self._raw_keys()
+      prefix, key = self.raw_primary
+      plaintexts = _batch_items(plaintexts)
+      associated_data = _to_bytes(associated_data)
+      def one(i):
+        if key is None:
+          ciphertext = self.aead_primitive.encrypt(_to_bytes(plaintexts[i]), associated_data)
+        else:
+          # what Tink writes: prefix || random 12 byte IV || ciphertext || tag
+          iv = os.urandom(12)
+          ciphertext = prefix + iv + key.encrypt(iv, plaintexts[i], associated_data)
+        return binascii.b2a_base64(ciphertext, newline=False) if encoded else ciphertext
+      return _run_batch(one, [len(p) for p in plaintexts], workers)
+
+    def decrypt_many(self, ciphertexts, associated_data=b'', buffer=None, workers=None, encoded=True):
+      # decrypt_bytes for each base64 ciphertext; returns (plaintexts, errors).  With a buffer the plaintexts
+      # are memoryviews into it, and a buffer as long as the ciphertexts together always fits
+      return _decrypt_many(self._raw_keys(), self.aead_primitive, ciphertexts, _to_bytes(associated_data), buffer, workers, encoded)
+
+
+class HMACFunctions(object):
+
+    def __init__(self, encoded_key, key_uri=None, template='HMAC_SHA256_256BITTAG'):
+      _register('mac')
+      self.gcp_aead = None
+      if key_uri != None:
+        # the Cloud KMS client library takes a long time to import; only key_uri needs it
+        from tink.integration import gcpkms
+        gcp_client = gcpkms.GcpKmsClient(key_uri=key_uri,credentials_path="")
+        self.gcp_aead = gcp_client.get_aead(key_uri)
+      if (encoded_key==None):
+        self.keyset_handle = tink.new_keyset_handle(key_template('mac', template))
+      elif self.gcp_aead != None:
+        reader = tink.BinaryKeysetReader(base64.b64decode(encoded_key))
+        self.keyset_handle = tink.KeysetHandle.read(reader, self.gcp_aead)
+      else:
+        reader = tink.BinaryKeysetReader(base64.b64decode(encoded_key))
+        self.keyset_handle = cleartext_keyset_handle.read(reader)
+      self.key = self.keyset_handle.keyset_info()        
+      self.mac = self.keyset_handle.primitive(mac.Mac)
+      self.raw_keys = None
+
+    def printKeyInfo(self):
+      stream = io.StringIO()
+      writer = tink.JsonKeysetWriter(stream)    
+      cleartext_keyset_handle.write(writer, self.keyset_handle)
+      return stream.getvalue()
+
+    def getKey(self):
+      # the keyset encrypted with the key_uri KMS key when there is one, else in cleartext
+      iostream = io.BytesIO()
+      writer = tink.BinaryKeysetWriter(iostream)
+      if self.gcp_aead != None:
+        self.keyset_handle.write(writer,self.gcp_aead)
+      else:
+        cleartext_keyset_handle.write(writer, self.keyset_handle)
+      encoded_key = base64.b64encode(iostream.getvalue()).decode('utf-8')
+      return encoded_key
+
+    def hash(self, msg):
+      tag = self.mac.compute_mac(msg)
+      return base64.b64encode(tag)
+
+    def verify(self,data, signature):
+      try:
+        self.mac.verify_mac(_to_bytes(signature), _to_bytes(data))
+        return True
+      except tink.TinkError:
+        return False
+
+    def _raw_keys(self):
+      if self.raw_keys is None:
+        keyset = _cleartext_keyset(self.keyset_handle)
+        self.raw_primary = _raw_primary(keyset, _hmac_keys)
+        self.raw_keys = _hmac_keys(keyset)
+      return self.raw_keys
+
+    def hash_many(self, messages, workers=None):
+      # returns (tags, errors): base64 tags as hash() returns them, and None where errors has the index
+      self._raw_keys()
+      prefix, key = self.raw_primary
+      messages = _batch_items(messages)
+      def one(i):
+        if key is None:
+          tag = self.mac.compute_mac(_to_bytes(messages[i]))
+        else:
+          secret, hash_name, tag_size = key
+          tag = prefix + hmac_digest(secret, messages[i], hash_name)[:tag_size]
+        return binascii.b2a_base64(tag, newline=False)
+      return _run_batch(one, [len(m) for m in messages], workers)
+
+    def verify_many(self, messages, signatures, workers=None):
+      # signatures are raw tags, as for verify(); returns (results, errors), False for a tag that does not match
+      raw_keys = self._raw_keys()
+      messages, signatures = _batch_items(messages), _batch_items(signatures)
+      def one(i):
+        return _verify_mac(raw_keys, self.mac, messages[i], signatures[i])
+      return _run_batch(one, [len(m) for m in messages], workers)
@@ -0,0 +1,347 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""KMS-wrapped data encryption keys: ids, derivation, rolling keysets and caches."""
+
+import base64
+import binascii
+import collections
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import tink
+from expiringdict import ExpiringDict
+from tink import aead, cleartext_keyset_handle, mac
+from tink.proto import tink_pb2
+
+from common.crypto import AESCipher, _COMPACT_KEY_TYPES, _aes_gcm_keys, _batch_items, _compact_key_data, _decrypt_into, _decrypt_many, _hmac_keys, _keyset, _register, _run_batch, _to_bytes, _verify_mac
+
+
+def wrapped_key_id(wrapped):
+  # short, stable identifier for a wrapped key: the first 64 bits of its sha256
+  if isinstance(wrapped, str):
+    wrapped = wrapped.encode('utf-8')
+  return hashlib.sha256(wrapped).hexdigest()[:16]
+
+
+# KMS associated data for master secrets; they are shared by all tenants so
+# they are not bound to a tenantID
+MASTER_SECRET_AAD = 'pubsub-master-secret'
+
+
+def new_master_secret():
+  return base64.b64encode(os.urandom(32)).decode('utf-8')
+
+
+def raw_keyset(key_type, raw_key, key_id):
+  # wraps raw key bytes in a single-key Tink keyset: AES256_GCM for 'aead', HMAC_SHA256_256BITTAG for 'mac'
+  if key_type == 'aead':
+    return _keyset(_COMPACT_KEY_TYPES[1][0], _compact_key_data(1, raw_key), key_id)
+  elif key_type == 'mac':
+    return _keyset(_COMPACT_KEY_TYPES[4][0], _compact_key_data(4, raw_key), key_id)
+  else:
+    raise ValueError('unknown key type ' + key_type)
+
+
+def derived_keyset(master_secret, key_type, tenant, window):
+  """Derives a per-tenant, per-window Tink keyset from a master secret with HKDF.
+
+  Publisher and subscriber derive the same key (and Tink key id) locally, so
+  only the master secret is ever wrapped with KMS.
+  """
+  info = 'type={}|tenant={}|window={}'.format(key_type, tenant, window).encode('utf-8')
+  okm = HKDF(algorithm=hashes.SHA256(), length=36, salt=None, info=info,
+             backend=default_backend()).derive(base64.b64decode(master_secret))
+  return raw_keyset(key_type, okm[:32], int.from_bytes(okm[32:], 'big'))
+
+
+class RollingKeyset(object):
+    """Merges unwrapped Tink keysets into one keyset and a single primitive.
+
+    Tink prefixes every ciphertext and tag with the id of the key that produced
+    it, so one primitive built over all live keys dispatches to the right key
+    without a per-message cache lookup.  Keys are pruned max_age_seconds after
+    they were last used, so a key stays loaded for as long as messages keep
+    arriving under it, even when only the first of them carried the wrapped key.
+    """
+
+    def __init__(self, primitive_class, max_age_seconds=20):
+      _register('mac' if primitive_class is mac.Mac else 'aead')
+      self.primitive_class = primitive_class
+      self.max_age_seconds = max_age_seconds
+      self.lock = threading.Lock()
+      self.keys = collections.OrderedDict()
+      self.primitive = None
+      self.raw_keys = {}
+      self.raw_macs = {}
+      # Tink key id -> when a ciphertext or tag under it was last decrypted or verified
+      self.used = {}
+
+    def add(self, encoded_key):
+      keyset = tink_pb2.Keyset.FromString(base64.b64decode(encoded_key))
+      now = time.time()
+      with self.lock:
+        for key in keyset.key:
+          # a new key with a colliding id replaces the older one
+          self.keys.pop(key.key_id, None)
+          self.keys[key.key_id] = (now, key)
+        self._rebuild(now)
+      return [key.key_id for key in keyset.key]
+
+    def contains(self, key_ids):
+      keys = self.keys
+      return all(key_id in keys for key_id in key_ids)
+
+    def _touch(self, data):
+      # data starts with the 5 byte TINK prefix, 0x01 and the key id; a plain dict
+      # store is atomic, so the hot path takes no lock
+      if data[:1] == b'\x01':
+        key_id = int.from_bytes(data[1:5], 'big')
+        if key_id in self.keys:
+          self.used[key_id] = time.time()
+
+    def _expired(self, now):
+      return [key_id for key_id, (added, _) in self.keys.items()
+              if now - max(added, self.used.get(key_id, 0)) > self.max_age_seconds]
+
+    def prune(self):
+      now = time.time()
+      with self.lock:
+        if self._expired(now):
+          self._rebuild(now)
+
+    def _rebuild(self, now):
+      for key_id in self._expired(now):
+        del self.keys[key_id]
+        self.used.pop(key_id, None)
+      if not self.keys:
+        self.primitive = None
+        self.raw_keys = {}
+        self.raw_macs = {}
+        return
+      keyset = tink_pb2.Keyset(key=[key for _, key in self.keys.values()])
+      keyset.primary_key_id = keyset.key[-1].key_id
+      self.primitive = cleartext_keyset_handle.from_keyset(keyset).primitive(self.primitive_class)
+      self.raw_keys = _aes_gcm_keys(keyset)
+      self.raw_macs = _hmac_keys(keyset)
+
+    def decrypt(self, ciphertext, associated_data):
+      return(self.decrypt_bytes(ciphertext, associated_data).decode('utf-8'))
+
+    def decrypt_bytes(self, ciphertext, associated_data):
+      primitive = self.primitive
+      if primitive is None:
+        raise tink.TinkError('no keys loaded')
+      ciphertext = binascii.a2b_base64(ciphertext)
+      plaintext = primitive.decrypt(ciphertext, _to_bytes(associated_data))
+      self._touch(ciphertext)
+      return plaintext
+
+    def decrypt_into(self, ciphertext, associated_data, buffer):
+      primitive, raw_keys = self.primitive, self.raw_keys
+      if primitive is None:
+        raise tink.TinkError('no keys loaded')
+      ciphertext = binascii.a2b_base64(ciphertext)
+      plaintext = _decrypt_into(raw_keys, primitive, ciphertext, _to_bytes(associated_data), buffer)
+      self._touch(ciphertext)
+      return plaintext
+
+    def decrypt_many(self, ciphertexts, associated_data, buffer=None, workers=None, encoded=True):
+      primitive, raw_keys = self.primitive, self.raw_keys
+      if primitive is None:
+        raise tink.TinkError('no keys loaded')
+      ciphertexts = _batch_items(ciphertexts)
+      plaintexts, errors = _decrypt_many(raw_keys, primitive, ciphertexts, _to_bytes(associated_data), buffer, workers, encoded)
+      # only keys that decrypted something are kept alive; 8 base64 characters hold the 5 byte prefix
+      for prefix in set(bytes(c[:8]) if encoded else bytes(c[:5]) for i, c in enumerate(ciphertexts) if i not in errors):
+        self._touch(binascii.a2b_base64(prefix) if encoded else prefix)
+      return plaintexts, errors
+
+    def verify(self, data, signature):
+      primitive = self.primitive
+      if primitive is None:
+        return False
+      try:
+        primitive.verify_mac(_to_bytes(signature), _to_bytes(data))
+      except tink.TinkError:
+        return False
+      self._touch(signature)
+      return True
+
+    def verify_many(self, messages, signatures, workers=None):
+      primitive, raw_keys = self.primitive, self.raw_macs
+      if primitive is None:
+        return [False] * len(messages), {}
+      messages, signatures = _batch_items(messages), _batch_items(signatures)
+      def one(i):
+        return _verify_mac(raw_keys, primitive, messages[i], signatures[i])
+      results, errors = _run_batch(one, [len(m) for m in messages], workers)
+      for prefix in set(bytes(s[:5]) for s, verified in zip(signatures, results) if verified):
+        self._touch(prefix)
+      return results, errors
+
+
+class TenantKeys(object):
+    """Key cache and rolling keysets of a single tenant."""
+
+    def __init__(self, tenant, max_len=100, max_age_seconds=20):
+      self.tenant = tenant
+      # maps a key id to the Tink key ids it added to the rolling keysets
+      self.cache = ExpiringDict(max_len=max_len, max_age_seconds=max_age_seconds)
+      self.dek_keyset = RollingKeyset(aead.Aead, max_age_seconds=max_age_seconds)
+      self.sign_keyset = RollingKeyset(mac.Mac, max_age_seconds=max_age_seconds)
+
+    def prune(self):
+      self.dek_keyset.prune()
+      self.sign_keyset.prune()
+
+
+class TenantScheduler(object):
+    """Weighted round-robin over per-tenant work queues.
+
+    Workers take up to `weight` items from a tenant before moving on to the
+    next tenant with pending work, so one tenant's backlog cannot starve the
+    others.
+    """
+
+    def __init__(self, workers=4, weights=None, default_weight=1):
+      self.weights = weights or {}
+      self.default_weight = default_weight
+      self.cond = threading.Condition()
+      self.queues = {}
+      self.credits = {}
+      self.ready = collections.deque()
+      for i in range(workers):
+        threading.Thread(target=self._run, name='tenant-worker-{}'.format(i), daemon=True).start()
+
+    def submit(self, tenant, fn, *args):
+      with self.cond:
+        queue = self.queues.setdefault(tenant, collections.deque())
+        if not queue:
+          self.ready.append(tenant)
+          self.credits[tenant] = self.weights.get(tenant, self.default_weight)
+        queue.append((fn, args))
+        self.cond.notify()
+
+    def pending(self, tenant):
+      with self.cond:
+        return len(self.queues.get(tenant, ()))
+
+    def _next(self):
+      with self.cond:
+        while not self.ready:
+          self.cond.wait()
+        tenant = self.ready[0]
+        queue = self.queues[tenant]
+        item = queue.popleft()
+        self.credits[tenant] -= 1
+        if not queue:
+          self.ready.popleft()
+        elif self.credits[tenant] <= 0:
+          self.credits[tenant] = self.weights.get(tenant, self.default_weight)
+          self.ready.rotate(-1)
+        return item
+
+    def _run(self):
+      while True:
+        fn, args = self._next()
+        try:
+          fn(*args)
+        except Exception as e:
+          logging.error("Unhandled error in tenant worker: " + str(e))
+
+
+class PersistentKeyCache(object):
+    """On-host cache of unwrapped keys shared by every subscriber process on a machine.
+
+    Entries live in a local SQLite database, sealed with an AEAD key-encryption
+    key (KEK) so the database alone never exposes a DEK.  The KEK is either a
+    Tink keyset encrypted with the Cloud KMS key kek_uri, kept at kek_path
+    (default: path + '.kek') and created by the first process, or a cleartext
+    keyset the caller provides at kek_path, readable by its owner only.
+    Each entry expires max_age_seconds after it was first unwrapped; set it to
+    the publishers' key rotation period so a restarted subscriber still finds
+    the keys in use.
+    """
+
+    def __init__(self, path, kek_path=None, kek_uri=None, max_age_seconds=3600):
+      self.max_age_seconds = max_age_seconds
+      if kek_uri is not None:
+        kek_path = kek_path or path + '.kek'
+        self.kek = AESCipher(encoded_key=self._load_wrapped_kek(kek_path, kek_uri), key_uri=kek_uri)
+      elif kek_path is not None:
+        self.kek = AESCipher(encoded_key=self._load_kek(kek_path))
+      else:
+        raise ValueError('the on-host key cache needs a KMS key-encryption key URI or a key-encryption key file')
+      self.lock = threading.Lock()
+      self.db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+      self.db.execute('PRAGMA journal_mode=WAL')
+      self.db.execute('CREATE TABLE IF NOT EXISTS keys (cache_key TEXT PRIMARY KEY, sealed TEXT NOT NULL, created REAL NOT NULL)')
+
+    def _load_wrapped_kek(self, kek_path, kek_uri):
+      # the first process on the host creates the KEK; only its KMS-encrypted form is written
+      try:
+        fd = os.open(kek_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+      except FileExistsError:
+        for _ in range(50):
+          with open(kek_path) as f:
+            encoded_key = f.read().strip()
+          if encoded_key:
+            return encoded_key
+          time.sleep(0.1)
+        raise ValueError('empty key-encryption key file ' + kek_path)
+      encoded_key = AESCipher(encoded_key=None, key_uri=kek_uri).getKey()
+      with os.fdopen(fd, 'w') as f:
+        f.write(encoded_key)
+      return encoded_key
+
+    def _load_kek(self, kek_path):
+      # a cleartext KEK is never created here, and is refused if anyone but its owner can read it
+      st = os.stat(kek_path)
+      if st.st_mode & 0o077 or st.st_uid != os.getuid():
+        raise ValueError('key-encryption key file {} must be owned by this user and not readable by others'.format(kek_path))
+      with open(kek_path) as f:
+        encoded_key = f.read().strip()
+      if not encoded_key:
+        raise ValueError('empty key-encryption key file ' + kek_path)
+      return encoded_key
+
+    def get(self, cache_key):
+      now = time.time()
+      with self.lock:
+        row = self.db.execute('SELECT sealed, created FROM keys WHERE cache_key = ?', (cache_key,)).fetchone()
+      if row is None:
+        return None
+      sealed, created = row
+      if now - created > self.max_age_seconds:
+        with self.lock:
+          self.db.execute('DELETE FROM keys WHERE cache_key = ?', (cache_key,))
+        return None
+      # the cache key is bound as associated data so sealed rows cannot be swapped
+      return self.kek.decrypt_bytes(sealed, associated_data=cache_key)
+
+    def put(self, cache_key, key):
+      # key is kept as the bytes KMS returned: an encoded keyset, or a raw compact key
+      sealed = self.kek.encrypt(_to_bytes(key), associated_data=cache_key)
+      now = time.time()
+      with self.lock:
+        self.db.execute('INSERT OR IGNORE INTO keys (cache_key, sealed, created) VALUES (?, ?, ?)', (cache_key, sealed, now))
+        self.db.execute('DELETE FROM keys WHERE created < ?', (now - self.max_age_seconds,))
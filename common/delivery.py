@@ -0,0 +1,215 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""What subscribers do with a message besides decrypting it: negative caching, backoff and quarantine, and the warm-up checks."""
+
+import base64
+import collections
+import json
+import logging
+import threading
+import time
+
+
+class NegativeCache(object):
+    """Wrapped keys and key references that are known to be bad.
+
+    A reference that failed to unwrap or resolve is remembered for ttl
+    seconds, so redeliveries, and other messages that carry the same
+    reference, fail locally instead of repeating the KMS call or certificate
+    fetch.  A ttl of 0 turns the cache off.
+    """
+
+    def __init__(self, ttl=300, max_len=10000):
+      self.ttl = ttl
+      self.max_len = max_len
+      self.lock = threading.Lock()
+      self.entries = collections.OrderedDict()
+
+    def add(self, ref, reason):
+      if self.ttl <= 0:
+        return
+      with self.lock:
+        self.entries.pop(ref, None)
+        self.entries[ref] = (time.monotonic() + self.ttl, reason)
+        while len(self.entries) > self.max_len:
+          self.entries.popitem(last=False)
+
+    def get(self, ref):
+      # returns why ref failed, or None if it is not known to be bad
+      with self.lock:
+        entry = self.entries.get(ref)
+        if entry is None:
+          return None
+        if time.monotonic() >= entry[0]:
+          del self.entries[ref]
+          return None
+        return entry[1]
+
+
+class Quarantine(object):
+    """Backs off, then dead-letters, messages that keep failing.
+
+    reject() replaces nack().  A nack has Pub/Sub redeliver the message at
+    once, so a message that can never succeed repeats its KMS call or cert
+    fetch in a tight loop.  Instead the ack deadline is set to base_delay,
+    doubled for each failure up to max_delay, and the message is dropped from
+    lease management so it comes back after that delay.  After max_failures
+    failures the message is appended to a JSON lines file and acked.
+
+    Failures are counted per message ID.  On subscriptions with a dead-letter
+    policy message.delivery_attempt is also set, and used when it is higher.
+
+    Releasing a message, by ack, nack or drop, lets the client library hand
+    out the next message with its ordering key.  So a failed message with an
+    ordering key holds that key: held() sends later messages with the key back
+    after the same delay, unprocessed, until the failed one is redelivered or
+    twice its delay has passed.
+    """
+
+    def __init__(self, path='dead_letter.jsonl', max_failures=5, base_delay=10, max_delay=600, max_len=100000):
+      self.path = path
+      self.max_failures = max_failures
+      self.base_delay = base_delay
+      self.max_delay = max_delay
+      self.max_len = max_len
+      self.lock = threading.Lock()
+      self.failures = collections.OrderedDict()
+      # ordering key -> (ID of its failed message, when the hold lapses, redelivery delay)
+      self.holds = {}
+
+    def held(self, message):
+      # returns True, after handing the message back, if an earlier message with its ordering key failed
+      key = message.ordering_key
+      if not key:
+        return False
+      with self.lock:
+        hold = self.holds.get(key)
+        if hold is None:
+          return False
+        message_id, until, delay = hold
+        if message.message_id == message_id or time.monotonic() >= until:
+          del self.holds[key]
+          return False
+      logging.info("Message {} waits for failed message {} with ordering key {}".format(message.message_id, message_id, key))
+      message.modify_ack_deadline(delay)
+      message.drop()
+      return True
+
+    def reject(self, message, reason):
+      # returns True if the message was quarantined
+      with self.lock:
+        failures = max(self.failures.pop(message.message_id, 0) + 1, message.delivery_attempt or 0)
+        quarantined = self.max_failures > 0 and failures >= self.max_failures
+        delay = min(self.base_delay * 2 ** (failures - 1), self.max_delay)
+        if quarantined:
+          self._write(message, reason, failures)
+        else:
+          self.failures[message.message_id] = failures
+          while len(self.failures) > self.max_len:
+            self.failures.popitem(last=False)
+          if message.ordering_key:
+            self.holds[message.ordering_key] = (message.message_id, time.monotonic() + 2 * delay, delay)
+      if quarantined:
+        logging.error("Quarantined message {} after {} failures: {}".format(message.message_id, failures, reason))
+        message.ack()
+        return True
+      logging.info("Message {} failed {} times; redelivery in {}s".format(message.message_id, failures, delay))
+      message.modify_ack_deadline(delay)
+      message.drop()
+      return False
+
+    def _write(self, message, reason, failures):
+      record = {
+        'message_id': message.message_id,
+        'publish_time': str(message.publish_time),
+        'ordering_key': message.ordering_key,
+        'attributes': dict(message.attributes),
+        'data': base64.b64encode(message.data).decode('utf-8'),
+        'failures': failures,
+        'reason': reason,
+        'quarantined_at': time.time(),
+      }
+      with open(self.path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class Warmup(object):
+    """Runs a subscriber's start-up checks before it pulls any messages.
+
+    Each check is a named function: opening gRPC channels, fetching tokens,
+    pre-fetching certificates or keys, a crypto self-test.  run() retries a
+    failed check up to attempts times and raises if it still fails, so an
+    instance that cannot work exits instead of taking messages.  Until every
+    check has passed /readyz answers 503; after that it answers 200.
+    """
+
+    def __init__(self, metrics=None, attempts=3, delay=2):
+      self.metrics = metrics
+      self.attempts = attempts
+      self.delay = delay
+      self.checks = []
+      self.results = collections.OrderedDict()
+      self.ready = threading.Event()
+      if metrics is not None:
+        metrics.paths['/readyz'] = self.status
+
+    def add(self, name, check, *args):
+      self.checks.append((name, check, args))
+      self.results[name] = 'pending'
+
+    def run(self):
+      for name, check, args in self.checks:
+        for attempt in range(1, self.attempts + 1):
+          start = time.perf_counter()
+          try:
+            if self.metrics is not None:
+              with self.metrics.stage('warmup_' + name):
+                check(*args)
+            else:
+              check(*args)
+          except Exception as e:
+            self.results[name] = 'failed: {}'.format(e)
+            logging.warning("Warm-up {} failed (attempt {}/{}): {}".format(name, attempt, self.attempts, e))
+            if attempt == self.attempts:
+              raise
+            time.sleep(self.delay)
+            continue
+          self.results[name] = 'ok {:.1f} ms'.format((time.perf_counter() - start) * 1000)
+          logging.info("Warm-up {} {}".format(name, self.results[name]))
+          break
+      self.ready.set()
+
+    def status(self):
+      body = ''.join('{} {}\n'.format(name, result) for name, result in self.results.items())
+      if self.ready.is_set():
+        return 200, 'ready\n' + body
+      return 503, 'not ready\n' + body
+
+    @staticmethod
+    def connect(client, credentials=None, timeout=10):
+      # opens the client's gRPC channel (DNS, TCP, TLS, HTTP/2) and fetches the access
+      # token of credentials (ClientRegistry.credentials), so the first real call pays for neither
+      import grpc
+      import google.auth.transport.requests
+      # pubsub_v1 clients older than 2.x wrap the generated client as .api rather than extend it
+      transport = client.transport if hasattr(client, 'transport') else client.api.transport
+      channel = transport.grpc_channel
+      for c in getattr(channel, 'channels', [channel]):
+        grpc.channel_ready_future(c).result(timeout=timeout)
+      if credentials is None:
+        logging.info("Warm-up: no client credentials, token is fetched on first use")
+        return
+      if not credentials.valid:
+        credentials.refresh(google.auth.transport.requests.Request())
@@ -0,0 +1,125 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The open-loop load generator the publishers run with --load_rate, and the ordering keys they publish with."""
+
+import logging
+import random
+import threading
+import time
+
+
+from common.metrics import LatencyHistogram
+
+
+def ordering_key(prefix, attributes):
+  # the --ordering_key to publish with, '' for none; each load_key value gets its own
+  if prefix is None:
+    return ''
+  if 'load_key' in attributes:
+    return '{}-{}'.format(prefix, attributes['load_key'])
+  return prefix
+
+
+class LoadGenerator(object):
+    """Open-loop publish load.
+
+    Each of `publishers` threads sends on a fixed schedule whether or not its
+    earlier publishes have completed, and latency is measured from the
+    scheduled send time.  A stalled publish therefore shows up as latency
+    rather than as a quietly lower offered rate (coordinated omission).
+
+    `publish(cleartext_message, attributes)` encrypts or signs one message and
+    returns the Pub/Sub publish future.
+    """
+
+    def __init__(self, publish, rate, duration=60, sizes='1024', attributes=1, publishers=1):
+      self.publish = publish
+      self.rate = rate
+      self.duration = duration
+      self.sizes = []
+      self.size_weights = []
+      for item in sizes.split(','):
+        size, _, weight = item.partition(':')
+        self.sizes.append(int(size))
+        self.size_weights.append(float(weight or 1))
+      self.attributes = attributes
+      self.publishers = publishers
+      self.histogram = LatencyHistogram()
+      self.lock = threading.Lock()
+      self.drained = threading.Condition(self.lock)
+      self.sent = 0
+      self.outstanding = 0
+      self.errors = 0
+      self.last_done = None
+
+    def run(self):
+      logging.info("Publishing {} msg/s for {}s from {} publishers".format(self.rate, self.duration, self.publishers))
+      start = time.perf_counter()
+      threads = [threading.Thread(target=self._publisher, args=(i, start), name='load-{}'.format(i), daemon=True)
+                 for i in range(self.publishers)]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+      with self.lock:
+        self.drained.wait_for(lambda: self.outstanding == 0, timeout=60)
+        elapsed = (self.last_done or time.perf_counter()) - start
+        completed = self.sent - self.outstanding - self.errors
+      logging.info("Sent {} messages, {} completed, {} failed, {} still outstanding".format(
+          self.sent, completed, self.errors, self.outstanding))
+      logging.info("Target rate {:.1f} msg/s, achieved {:.1f} msg/s".format(self.rate, completed / elapsed if elapsed > 0 else 0))
+      logging.info("Latency from scheduled send time:\n" + self.histogram.render())
+      return self.histogram
+
+    def _publisher(self, i, start):
+      interval = self.publishers / self.rate
+      intended = start + i / self.rate
+      end = start + self.duration
+      rng = random.Random()
+      while intended < end:
+        delay = intended - time.perf_counter()
+        if delay > 0:
+          time.sleep(delay)
+        cleartext_message = {
+          "data": 'x' * rng.choices(self.sizes, self.size_weights)[0],
+          "attributes": {
+            'epoch_time': int(time.time()),
+            # same-sized messages in the same second must still differ for replay detection
+            'nonce': '{:016x}'.format(rng.getrandbits(64)),
+          }
+        }
+        attributes = {'load_key': 'key-{}'.format(rng.randrange(self.attributes))}
+        cleartext_message['attributes'].update(attributes)
+        with self.lock:
+          self.sent += 1
+          self.outstanding += 1
+        try:
+          future = self.publish(cleartext_message, attributes)
+          future.add_done_callback(lambda f, intended=intended: self._done(intended, f.exception() is None))
+        except Exception as e:
+          logging.debug("Publish failed: " + str(e))
+          self._done(intended, False)
+        intended += interval
+
+    def _done(self, intended, ok):
+      now = time.perf_counter()
+      if ok:
+        self.histogram.record(now - intended)
+      with self.lock:
+        self.outstanding -= 1
+        if not ok:
+          self.errors += 1
+        self.last_done = now
+        self.drained.notify_all()
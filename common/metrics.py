@@ -0,0 +1,291 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prometheus metrics, the on-demand profiler and latency histograms."""
+
+import bisect
+import collections
+import contextlib
+import heapq
+import logging
+import math
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class Metrics(object):
+    """Per-stage latency histograms and error counters, cache hit/miss counters
+    and in-flight gauges, exported in the Prometheus text format on /metrics.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix='pubsub_crypto', **labels):
+      self.prefix = prefix
+      self.labels = labels
+      self.lock = threading.Lock()
+      self.histograms = {}
+      self.errors = collections.Counter()
+      self.caches = collections.Counter()
+      self.gauges = collections.Counter()
+      self.paths = {'/metrics': self.render}
+      self.tracer = None
+
+    @contextlib.contextmanager
+    def stage(self, name, count_errors=True):
+      start = time.perf_counter()
+      try:
+        yield
+      except Exception:
+        if count_errors:
+          self.error(name)
+        raise
+      finally:
+        elapsed = time.perf_counter() - start
+        self.observe(name, elapsed)
+        if self.tracer is not None:
+          self.tracer.record(name, elapsed)
+
+    @contextlib.contextmanager
+    def in_flight(self, name='messages'):
+      self.gauge(name, 1)
+      try:
+        yield
+      finally:
+        self.gauge(name, -1)
+
+    def observe(self, stage, seconds):
+      with self.lock:
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+          histogram = self.histograms[stage] = [[0] * len(self.BUCKETS), 0.0, 0]
+        i = bisect.bisect_left(self.BUCKETS, seconds)
+        if i < len(self.BUCKETS):
+          histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def error(self, stage):
+      with self.lock:
+        self.errors[stage] += 1
+
+    def cache(self, name, hit):
+      with self.lock:
+        self.caches[(name, 'hit' if hit else 'miss')] += 1
+
+    def gauge(self, name, delta):
+      with self.lock:
+        self.gauges[name] += delta
+
+    def _labels(self, **extra):
+      merged = dict(self.labels, **extra)
+      return '{' + ','.join('{}="{}"'.format(k, v) for k, v in sorted(merged.items())) + '}'
+
+    def render(self):
+      p = self.prefix
+      lines = ['# TYPE {}_stage_seconds histogram'.format(p)]
+      with self.lock:
+        for stage, (buckets, total, count) in sorted(self.histograms.items()):
+          cumulative = 0
+          for bound, n in zip(self.BUCKETS, buckets):
+            cumulative += n
+            lines.append('{}_stage_seconds_bucket{} {}'.format(p, self._labels(stage=stage, le=bound), cumulative))
+          lines.append('{}_stage_seconds_bucket{} {}'.format(p, self._labels(stage=stage, le='+Inf'), count))
+          lines.append('{}_stage_seconds_sum{} {}'.format(p, self._labels(stage=stage), total))
+          lines.append('{}_stage_seconds_count{} {}'.format(p, self._labels(stage=stage), count))
+        lines.append('# TYPE {}_stage_errors_total counter'.format(p))
+        for stage, n in sorted(self.errors.items()):
+          lines.append('{}_stage_errors_total{} {}'.format(p, self._labels(stage=stage), n))
+        lines.append('# TYPE {}_cache_requests_total counter'.format(p))
+        for (name, result), n in sorted(self.caches.items()):
+          lines.append('{}_cache_requests_total{} {}'.format(p, self._labels(cache=name, result=result), n))
+        lines.append('# TYPE {}_in_flight gauge'.format(p))
+        for name, n in sorted(self.gauges.items()):
+          lines.append('{}_in_flight{} {}'.format(p, self._labels(name=name), n))
+      return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+      import http.server
+      paths = self.paths
+
+      class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+          render = paths.get(self.path)
+          if render is None:
+            self.send_error(404)
+            return
+          # a path may answer (status, body) instead of a body, eg /readyz
+          body = render()
+          status = 200
+          if isinstance(body, tuple):
+            status, body = body
+          body = body.encode('utf-8')
+          self.send_response(status)
+          self.send_header('Content-Type', 'text/plain; version=0.0.4')
+          self.send_header('Content-Length', str(len(body)))
+          self.end_headers()
+          self.wfile.write(body)
+
+        def log_message(self, format, *args):
+          pass
+
+      server = http.server.ThreadingHTTPServer((host, port), Handler)
+      threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+      return server
+
+
+class Profiler(object):
+    """On-demand profiling for a running publisher or subscriber.
+
+    start() samples the stacks of every thread for a number of seconds and
+    writes them as collapsed stacks ("frame;frame;frame count" per line), the
+    input format of flamegraph.pl and speedscope.  It is triggered by SIGUSR1 or
+    GET /profile on the metrics server.
+
+    trace() times one message with perf_counter_ns.  Metrics stages recorded
+    while it is active become that message's breakdown, and the slowest
+    messages are kept for SIGUSR2 or GET /slowest.
+    """
+
+    def __init__(self, output_dir='.', seconds=30, interval=0.005, slowest=0):
+      self.output_dir = output_dir
+      self.seconds = seconds
+      self.interval = interval
+      self.slowest = slowest
+      self.sampling = threading.Lock()
+      self.lock = threading.Lock()
+      self.local = threading.local()
+      self.heap = []
+
+    def attach(self, metrics, trace=True):
+      # trace=False leaves stages untraced, where one thread interleaves many messages
+      metrics.paths['/profile'] = lambda: (self.start() or 'profile already running') + '\n'
+      if trace:
+        metrics.tracer = self
+        metrics.paths['/slowest'] = self.report
+
+    def install_signals(self):
+      if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.start())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: logging.info("Slowest messages:\n" + self.report()))
+
+    def start(self, seconds=None):
+      if not self.sampling.acquire(blocking=False):
+        return None
+      path = os.path.join(self.output_dir, 'profile-{}-{}.collapsed'.format(os.getpid(), int(time.time())))
+      threading.Thread(target=self._sample, args=(seconds or self.seconds, path), name='profiler', daemon=True).start()
+      logging.info("Profiling for {}s into {}".format(seconds or self.seconds, path))
+      return path
+
+    def _sample(self, seconds, path):
+      try:
+        counts = collections.Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+          names = dict((t.ident, t.name) for t in threading.enumerate())
+          for ident, frame in sys._current_frames().items():
+            if ident == me:
+              continue
+            stack = []
+            while frame is not None:
+              code = frame.f_code
+              stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+              frame = frame.f_back
+            stack.append(names.get(ident, 'thread-{}'.format(ident)))
+            counts[';'.join(reversed(stack))] += 1
+          time.sleep(self.interval)
+        with open(path, 'w') as f:
+          for stack, n in counts.most_common():
+            f.write('{} {}\n'.format(stack, n))
+        logging.info("Wrote profile " + path)
+      finally:
+        self.sampling.release()
+
+    @contextlib.contextmanager
+    def trace(self, message_id):
+      if self.slowest <= 0:
+        yield
+        return
+      self.local.stages = stages = []
+      start = time.perf_counter_ns()
+      try:
+        yield
+      finally:
+        self.local.stages = None
+        entry = (time.perf_counter_ns() - start, str(message_id), stages)
+        with self.lock:
+          if len(self.heap) < self.slowest:
+            heapq.heappush(self.heap, entry)
+          elif entry[0] > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def record(self, stage, seconds):
+      stages = getattr(self.local, 'stages', None)
+      if stages is not None:
+        stages.append((stage, int(seconds * 1e9)))
+
+    def report(self):
+      with self.lock:
+        entries = sorted(self.heap, reverse=True)
+      lines = []
+      for total, message_id, stages in entries:
+        breakdown = ' '.join('{}={:.3f}ms'.format(stage, ns / 1e6) for stage, ns in stages)
+        lines.append('{} {:.3f}ms {}'.format(message_id, total / 1e6, breakdown))
+      return '\n'.join(lines) + '\n'
+
+
+class LatencyHistogram(object):
+    """HDR-style log-linear latency histogram.
+
+    Every power of two is split into `sub_buckets` linear buckets, so any
+    recorded value is reported with a relative error below 1/sub_buckets from
+    microseconds up to minutes, in constant memory per decade.
+    """
+
+    PERCENTILES = (0.5, 0.75, 0.9, 0.95, 0.99, 0.999, 0.9999, 1.0)
+
+    def __init__(self, sub_buckets=32, unit=1e-6):
+      self.bits = sub_buckets.bit_length()
+      self.unit = unit
+      self.lock = threading.Lock()
+      self.counts = collections.Counter()
+      self.count = 0
+
+    def record(self, seconds):
+      value = max(int(seconds / self.unit), 1)
+      exponent = max(value.bit_length() - self.bits, 0)
+      with self.lock:
+        self.counts[(exponent, value >> exponent)] += 1
+        self.count += 1
+
+    def percentile(self, q):
+      with self.lock:
+        target = q * self.count
+        seen = 0
+        for exponent, sub in sorted(self.counts):
+          seen += self.counts[(exponent, sub)]
+          if seen >= target:
+            # report the upper edge of the bucket, like HdrHistogram does
+            return (((sub + 1) << exponent) - 1) * self.unit
+      return 0
+
+    def render(self):
+      lines = ['{:>12} {:>10} {:>10}'.format('latency ms', 'percentile', 'count')]
+      for q in self.PERCENTILES:
+        lines.append('{:>12.3f} {:>10.4%} {:>10}'.format(self.percentile(q) * 1000, q, int(math.ceil(q * self.count))))
+      return '\n'.join(lines)
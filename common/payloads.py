@@ -0,0 +1,439 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Payload formats: streaming encryption to a blob store, record frames and field-level encryption."""
+
+import base64
+import binascii
+import concurrent.futures
+import contextlib
+import copy
+import hashlib
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import tink
+from tink import cleartext_keyset_handle, streaming_aead
+
+from common.crypto import _register, _to_bytes
+
+
+class StreamingCipher(object):
+    """Tink streaming AEAD for payloads too large to hold in memory at once."""
+
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, encoded_key):
+      _register('streaming_aead')
+      if (encoded_key==None):
+        self.keyset_handle = tink.new_keyset_handle(streaming_aead.streaming_aead_key_templates.AES256_GCM_HKDF_1MB)
+      else:
+        reader = tink.BinaryKeysetReader(base64.b64decode(encoded_key))
+        self.keyset_handle = cleartext_keyset_handle.read(reader)
+      self.streaming_primitive = self.keyset_handle.primitive(streaming_aead.StreamingAead)
+
+    def getKey(self):
+      iostream = io.BytesIO()
+      writer = tink.BinaryKeysetWriter(iostream)
+      cleartext_keyset_handle.write(writer, self.keyset_handle)
+      encoded_key = base64.b64encode(iostream.getvalue()).decode('utf-8')
+      return encoded_key
+
+    def encrypt_stream(self, source, destination, associated_data):
+      # returns the sha256 of the ciphertext written to destination
+      destination = _HashingFile(destination)
+      with self.streaming_primitive.new_encrypting_stream(destination, associated_data.encode('utf-8')) as stream:
+        while True:
+          chunk = source.read(self.CHUNK_SIZE)
+          if not chunk:
+            break
+          stream.write(chunk)
+      return destination.sha256.hexdigest()
+
+    def decrypt_stream(self, source, associated_data, sha256=None):
+      # yields plaintext chunks; raises ValueError at the end if the ciphertext digest does not match
+      source = _HashingFile(source)
+      with self.streaming_primitive.new_decrypting_stream(source, associated_data.encode('utf-8')) as stream:
+        while True:
+          chunk = stream.read(self.CHUNK_SIZE)
+          if not chunk:
+            break
+          yield chunk
+      if sha256 is not None and source.sha256.hexdigest() != sha256:
+        raise ValueError("blob digest does not match the message")
+
+
+class _HashingFile(io.RawIOBase):
+    """Passes reads or writes through to a binary file and hashes the bytes."""
+
+    def __init__(self, f):
+      self.f = f
+      self.sha256 = hashlib.sha256()
+
+    def readable(self):
+      return True
+
+    def writable(self):
+      return True
+
+    def readinto(self, b):
+      n = self.f.readinto(b)
+      if n:
+        self.sha256.update(memoryview(b)[:n])
+      return n
+
+    def write(self, b):
+      self.sha256.update(b)
+      return self.f.write(b)
+
+    def close(self):
+      self.f.close()
+      super(_HashingFile, self).close()
+
+
+def blob_aad(tenant, ref, epoch_time):
+  # binds the blob to the tenant, to the reference the message points at and to the
+  # message's epoch_time attribute, which is then as good as authenticated
+  return '{}/{}/{}'.format(tenant, ref, epoch_time)
+
+
+class BlobStore(object):
+    """Where offloaded payloads are kept.
+
+    Subclasses implement writer(ref), a context manager yielding a binary file
+    that only becomes visible under `ref` once it exits cleanly, reader(ref)
+    and delete(ref).
+    """
+
+    def new_ref(self):
+      return binascii.hexlify(os.urandom(16)).decode('utf-8')
+
+    def check_ref(self, ref):
+      # refs come from message attributes, so they are checked before naming a file or object
+      if len(ref) != 32 or any(c not in '0123456789abcdef' for c in ref):
+        raise ValueError("invalid blob reference " + ref)
+      return ref
+
+    def writer(self, ref):
+      raise NotImplementedError()
+
+    def reader(self, ref):
+      raise NotImplementedError()
+
+    def delete(self, ref):
+      raise NotImplementedError()
+
+
+class LocalBlobStore(BlobStore):
+    """Blobs as files in one directory, eg a shared or mounted volume."""
+
+    def __init__(self, path):
+      self.path = path
+      os.makedirs(path, exist_ok=True)
+
+    def _path(self, ref):
+      return os.path.join(self.path, self.check_ref(ref))
+
+    @contextlib.contextmanager
+    def writer(self, ref):
+      path = self._path(ref)
+      f = open(path + '.tmp', 'wb')
+      try:
+        yield f
+      except Exception:
+        f.close()
+        os.remove(path + '.tmp')
+        raise
+      f.close()
+      os.replace(path + '.tmp', path)
+
+    def reader(self, ref):
+      return open(self._path(ref), 'rb')
+
+    def delete(self, ref):
+      try:
+        os.remove(self._path(ref))
+      except FileNotFoundError:
+        pass
+
+
+class GCSBlobStore(BlobStore):
+    """Blobs as objects under a prefix in a Cloud Storage bucket, eg gs://bucket/blobs.
+
+    Needs google-cloud-storage, which is only imported here.  An object is
+    written with a resumable upload, and only created when the upload is
+    finalized as the writer exits cleanly.
+    """
+
+    def __init__(self, url, client=None):
+      from google.cloud import storage
+      bucket, _, prefix = url[len('gs://'):].partition('/')
+      self.bucket = (client or storage.Client()).bucket(bucket)
+      self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def _blob(self, ref):
+      return self.bucket.blob(self.prefix + self.check_ref(ref))
+
+    @contextlib.contextmanager
+    def writer(self, ref):
+      f = self._blob(ref).open('wb', ignore_flush=True)
+      # on an error the upload is left unfinalized: no object is created, and
+      # Cloud Storage discards the session after a week
+      yield f
+      f.close()
+
+    def reader(self, ref):
+      return self._blob(ref).open('rb')
+
+    def delete(self, ref):
+      from google.api_core.exceptions import NotFound
+      try:
+        self._blob(ref).delete()
+      except NotFound:
+        pass
+
+
+def open_blob_store(location):
+    # a gs://bucket/prefix URL, or a local directory
+    if location.startswith('gs://'):
+      return GCSBlobStore(location)
+    return LocalBlobStore(location)
+
+
+def open_blob(blob_store, encoded_key, tenant, attributes):
+    """Decrypts the offloaded payload a message points at into a temporary file.
+
+    The blob is decrypted one segment at a time, and the file, at offset 0, is
+    only returned once the digest at the end of the blob matched: the consumer
+    never sees unauthenticated data and the payload is never in memory whole.
+    The file is deleted when it is closed.
+    """
+    ref = attributes['blob_ref']
+    sc = StreamingCipher(encoded_key=encoded_key)
+    payload = tempfile.TemporaryFile()
+    try:
+      with blob_store.reader(ref) as f:
+        for chunk in sc.decrypt_stream(f, blob_aad(tenant, ref, attributes['epoch_time']), attributes['blob_sha256']):
+          payload.write(chunk)
+    except BaseException:
+      payload.close()
+      raise
+    payload.seek(0)
+    return payload
+
+
+def pack_records(records):
+    """Packs records into one frame: each is a 4-byte big-endian length followed by the record."""
+    return b''.join(struct.pack('>I', len(r)) + r for r in records)
+
+
+def unpack_records(frame):
+    records = []
+    view = memoryview(frame)
+    offset = 0
+    while offset < len(view):
+      if offset + 4 > len(view):
+        raise ValueError("truncated record length at offset {}".format(offset))
+      length, = struct.unpack_from('>I', view, offset)
+      offset += 4
+      if offset + length > len(view):
+        raise ValueError("truncated record at offset {}".format(offset))
+      records.append(bytes(view[offset:offset + length]))
+      offset += length
+    return records
+
+
+def frame_aad(tenant, count):
+    # associated data of an encrypted frame: the record count is authenticated along with it
+    return '{}/records/{}'.format(tenant, count)
+
+
+def signed_frame(tenant, count, frame):
+    # what the signature of a frame covers.  The leading NUL keeps it apart from a
+    # single payload, which is JSON text, so neither passes for the other
+    return b'\x00' + frame_aad(tenant, count).encode('utf-8') + b'\x00' + bytes(frame)
+
+
+class RecordAggregator(object):
+    """Packs small records into frames that are encrypted and published once.
+
+    add() buffers a record.  A frame goes to publish_frame(frame, count) when
+    it would exceed max_bytes, holds max_records records, or max_latency
+    seconds after its first record arrived.  publish_frame returns the
+    publish future of the frame's message; the future add() returns resolves
+    to the same message ID.
+    """
+
+    def __init__(self, publish_frame, max_bytes=262144, max_records=500, max_latency=0.05):
+      self.publish_frame = publish_frame
+      self.max_bytes = max_bytes
+      self.max_records = max_records
+      self.max_latency = max_latency
+      self.cond = threading.Condition()
+      self.records = []
+      self.futures = []
+      self.size = 0
+      self.deadline = None
+      threading.Thread(target=self._run, name='aggregator', daemon=True).start()
+
+    def add(self, record):
+      future = concurrent.futures.Future()
+      batches = []
+      with self.cond:
+        if self.records and self.size + 4 + len(record) > self.max_bytes:
+          batches.append(self._take())
+        if not self.records:
+          self.deadline = time.monotonic() + self.max_latency
+          self.cond.notify()
+        self.records.append(record)
+        self.futures.append(future)
+        self.size += 4 + len(record)
+        if len(self.records) >= self.max_records or self.size >= self.max_bytes:
+          batches.append(self._take())
+      for batch in batches:
+        self._publish(*batch)
+      return future
+
+    def flush(self):
+      with self.cond:
+        batch = self._take()
+      self._publish(*batch)
+
+    def _take(self):
+      batch = (self.records, self.futures)
+      self.records, self.futures, self.size, self.deadline = [], [], 0, None
+      return batch
+
+    def _publish(self, records, futures):
+      if not records:
+        return
+      try:
+        message_future = self.publish_frame(pack_records(records), len(records))
+      except Exception as e:
+        for f in futures:
+          f.set_exception(e)
+        return
+
+      def done(message_future):
+        e = message_future.exception()
+        for f in futures:
+          if e is None:
+            f.set_result(message_future.result())
+          else:
+            f.set_exception(e)
+      message_future.add_done_callback(done)
+
+    def _run(self):
+      while True:
+        with self.cond:
+          while self.deadline is None or time.monotonic() < self.deadline:
+            self.cond.wait(None if self.deadline is None else self.deadline - time.monotonic())
+          batch = self._take()
+        self._publish(*batch)
+
+
+def field_aad(tenant, path):
+    return '{}/{}'.format(tenant, path)
+
+
+def field_seal_aad(tenant, encrypted_fields, data):
+    # what the seal of a field-level message covers: the serialized document as sent,
+    # clear fields and field ciphertexts alike, and the list of encrypted fields
+    return '{}/fields/{}/{}'.format(tenant, encrypted_fields, hashlib.sha256(_to_bytes(data)).hexdigest())
+
+
+def check_field_seal(cipher, data, attributes, tenant):
+    """Raises unless the field_seal attribute matches the message; nothing in the document is trusted before."""
+    if 'field_seal' not in attributes:
+      raise ValueError("field-level message has no field_seal attribute")
+    cipher.decrypt_bytes(attributes['field_seal'], field_seal_aad(tenant, attributes['encrypted_fields'], data))
+
+
+def _get_field(document, path):
+    for name in path.split('.'):
+      if not isinstance(document, dict) or name not in document:
+        raise KeyError(path)
+      document = document[name]
+    return document
+
+
+def _set_field(document, path, value):
+    names = path.split('.')
+    for name in names[:-1]:
+      document = document[name]
+    document[names[-1]] = value
+
+
+class FieldSchema(object):
+    """Field-level encryption of a JSON message.
+
+    The schema lists dotted field paths, eg
+
+      {"sensitive": ["data", "attributes.a"], "routing": ["attributes.b"]}
+
+    Each sensitive field is JSON encoded and encrypted on its own under the
+    message's DEK, with "<tenant>/<path>" as associated data, so a ciphertext
+    cannot be moved to another field or tenant.  Routing fields stay clear in
+    the document and are copied to message attributes, named after their last
+    path element, for subscription filters and routing before any crypto.
+
+    The serialized document is then sealed: the field_seal attribute is an
+    empty AEAD ciphertext under the same DEK whose associated data holds the
+    sha256 of the document and the encrypted_fields list.  It authenticates
+    the clear fields, and keeps field ciphertexts from being moved to another
+    message or dropped from the list.
+    """
+
+    def __init__(self, schema):
+      self.sensitive = list(schema.get('sensitive', []))
+      self.routing = list(schema.get('routing', []))
+      overlap = set(self.sensitive) & set(self.routing)
+      if overlap:
+        raise ValueError("fields cannot be both sensitive and routing: " + ','.join(sorted(overlap)))
+
+    def encrypt(self, cipher, document, tenant):
+      # returns the serialized document with its sensitive fields encrypted, and the attributes to publish with it
+      document = copy.deepcopy(document)
+      attributes = {}
+      for path in self.routing:
+        try:
+          attributes[path.split('.')[-1]] = str(_get_field(document, path))
+        except KeyError:
+          pass
+      encrypted = []
+      for path in self.sensitive:
+        try:
+          value = _get_field(document, path)
+        except KeyError:
+          continue
+        _set_field(document, path, cipher.encrypt(json.dumps(value).encode('utf-8'), associated_data=field_aad(tenant, path)))
+        encrypted.append(path)
+      attributes['encrypted_fields'] = ','.join(encrypted)
+      data = json.dumps(document)
+      attributes['field_seal'] = cipher.encrypt(b'', associated_data=field_seal_aad(tenant, attributes['encrypted_fields'], data))
+      return data, attributes
+
+
+def decrypt_fields(cipher, document, paths, tenant):
+    """Returns a copy of document with the fields in paths decrypted; document is left as is if any fails."""
+    values = [(path, json.loads(cipher.decrypt_bytes(_get_field(document, path), field_aad(tenant, path)))) for path in paths]
+    document = copy.deepcopy(document)
+    for path, value in values:
+      _set_field(document, path, value)
+    return document
@@ -0,0 +1,182 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replay protection for subscribers."""
+
+import collections
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+
+
+def stamped(attributes):
+  # epoch_time in the clear as well, so subscribers can reject stale and replayed messages before
+  # decrypting.  An offloaded payload has already set the one its blob is bound to
+  return dict({'epoch_time': str(int(time.time()))}, **attributes)
+
+
+class ReplayGuard(object):
+    """Rejects stale and replayed messages before anything is decrypted.
+
+    Publishers send epoch_time as a clear attribute as well as inside the
+    payload.  check() rejects a message whose epoch_time attribute is more
+    than window seconds from this host's clock, or whose data was already
+    seen.  Seen messages are kept by the sha256 of their data in Bloom
+    filters, one per window/4 seconds of arrival time, sized for capacity
+    messages per window.  Filters older than twice the window are dropped,
+    so memory stays fixed however many messages arrive.  A Bloom filter
+    can report data it has not seen, about error_rate of the time per
+    filter; that message is dropped as a replay.
+
+    The clear attribute is not authenticated.  check_inner() applies the same
+    window to the epoch_time inside the decrypted or verified payload, so a
+    replay with a rewritten attribute is either still in the filters or fails
+    there.  check_and_add() looks the data up and marks it seen under one lock,
+    so of two concurrent deliveries of the same data only one is accepted.
+    """
+
+    BUCKETS_PER_WINDOW = 4
+
+    def __init__(self, window=300, capacity=1000000, error_rate=1e-6):
+      self.window = window
+      self.bucket_seconds = window / self.BUCKETS_PER_WINDOW
+      n = max(1, capacity // self.BUCKETS_PER_WINDOW)
+      self.bits = max(64, int(-n * math.log(error_rate) / math.log(2) ** 2))
+      self.hashes = max(1, int(round(self.bits / n * math.log(2))))
+      self.lock = threading.Lock()
+      self.filters = collections.OrderedDict()
+
+    def _positions(self, data):
+      # double hashing with two 64 bit halves of the digest
+      digest = hashlib.sha256(data).digest()
+      h1 = int.from_bytes(digest[:8], 'big')
+      h2 = int.from_bytes(digest[8:16], 'big') | 1
+      return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _expire(self, now):
+      oldest = int((now - 2 * self.window) // self.bucket_seconds)
+      while self.filters and next(iter(self.filters)) < oldest:
+        self.filters.popitem(last=False)
+
+    def check(self, message):
+      # returns None for a fresh message, or why it is rejected
+      now = time.time()
+      epoch_time = message.attributes.get('epoch_time')
+      if epoch_time is None:
+        return 'no epoch_time attribute'
+      try:
+        skew = abs(now - int(epoch_time))
+      except ValueError:
+        return 'bad epoch_time attribute {}'.format(epoch_time)
+      if skew > self.window:
+        return 'epoch_time attribute is {:.0f}s from now'.format(skew)
+      positions = self._positions(message.data)
+      with self.lock:
+        self._expire(now)
+        if self._seen(positions):
+          return 'data already seen'
+      return None
+
+    def _seen(self, positions):
+      return any(all(bits[p >> 3] & (1 << (p & 7)) for p in positions) for bits in self.filters.values())
+
+    def _mark(self, positions, now):
+      bucket = int(now // self.bucket_seconds)
+      bits = self.filters.get(bucket)
+      if bits is None:
+        bits = self.filters[bucket] = bytearray((self.bits + 7) // 8)
+      for p in positions:
+        bits[p >> 3] |= 1 << (p & 7)
+
+    def check_inner(self, payload):
+      # payload is the decrypted or verified message as JSON bytes or a parsed dict;
+      # payloads that do not carry attributes.epoch_time pass.  An offloaded payload
+      # comes as a file and is not read: its blob is bound to the epoch_time attribute
+      if hasattr(payload, 'read'):
+        return None
+      if not isinstance(payload, dict):
+        try:
+          payload = json.loads(payload)
+        except ValueError:
+          return None
+      try:
+        epoch_time = int(payload['attributes']['epoch_time'])
+      except (KeyError, TypeError, ValueError):
+        return None
+      skew = abs(time.time() - epoch_time)
+      if skew > self.window:
+        return 'payload epoch_time is {:.0f}s from now'.format(skew)
+      return None
+
+    def add(self, message):
+      positions = self._positions(message.data)
+      now = time.time()
+      with self.lock:
+        self._expire(now)
+        self._mark(positions, now)
+
+    def check_and_add(self, message):
+      # called once the message is verified, so a redelivery of a message that failed is not a replay.
+      # Returns None if the data was not seen and is now marked, or why it is rejected
+      positions = self._positions(message.data)
+      now = time.time()
+      with self.lock:
+        self._expire(now)
+        if self._seen(positions):
+          return 'data already seen'
+        self._mark(positions, now)
+      return None
+
+
+class ReplayChecks(object):
+    """What a subscriber does with a ReplayGuard's verdicts.
+
+    Stale and repeated messages are acked, not retried, and counted as
+    'replay' errors.  guard is None when replay protection is off; then
+    every message passes.
+    """
+
+    def __init__(self, guard, metrics):
+      self.guard = guard
+      self.metrics = metrics
+
+    def drop(self, message, reason):
+      # returns False for reason None
+      if reason is None:
+        return False
+      logging.warning("Dropping message {}: {}".format(message.message_id, reason))
+      self.metrics.error('replay')
+      message.ack()
+      return True
+
+    def replayed(self, message):
+      # runs before any key lookup or decryption, on the clear epoch_time attribute and the data digest
+      if self.guard is None:
+        return False
+      with self.metrics.stage('replay_check'):
+        reason = self.guard.check(message)
+      return self.drop(message, reason)
+
+    def accepted(self, message, *payloads):
+      # the epoch_time inside each decrypted or verified payload is authenticated.  Only then is the message
+      # marked seen, in the same locked step as the lookup, so concurrent deliveries of the same data pass once
+      if self.guard is None:
+        return True
+      for payload in payloads:
+        if self.drop(message, self.guard.check_inner(payload)):
+          return False
+      return not self.drop(message, self.guard.check_and_add(message))
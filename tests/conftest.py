@@ -0,0 +1,51 @@
+# Copyright 2018 Google Inc. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class FakeMessage(object):
+    """Just enough of a streaming pull Message for the subscriber helpers."""
+
+    def __init__(self, data=b'payload', attributes=None, message_id='1', delivery_attempt=None):
+      self.data = data
+      self.attributes = {'epoch_time': str(int(time.time()))} if attributes is None else attributes
+      self.message_id = message_id
+      self.delivery_attempt = delivery_attempt
+      self.ordering_key = ''
+      self.publish_time = None
+      self.calls = []
+
+    def ack(self):
+      self.calls.append(('ack',))
+
+    def nack(self):
+      self.calls.append(('nack',))
+
+    def modify_ack_deadline(self, seconds):
+      self.calls.append(('modify_ack_deadline', seconds))
+
+    def drop(self):
+      self.calls.append(('drop',))
+
+
+@pytest.fixture
+def message():
+  return FakeMessage
@@ -0,0 +1,54 @@
+import hashlib
+
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.hazmat.primitives.asymmetric.padding import MGF1, PSS
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+
+from common.asymmetric import AsymmetricVerifier, kms_key_allowed
+
+
+KEY = 'projects/p/locations/l/keyRings/r/cryptoKeys/k'
+
+
+def test_key_covers_its_versions():
+  assert kms_key_allowed(KEY, [KEY])
+  assert kms_key_allowed(KEY + '/cryptoKeyVersions/3', [KEY])
+  assert not kms_key_allowed(KEY + '2', [KEY])
+  assert not kms_key_allowed('projects/attacker/locations/l/keyRings/r/cryptoKeys/k', [KEY])
+
+
+def test_version_covers_only_itself():
+  allowed = [KEY + '/cryptoKeyVersions/1']
+  assert kms_key_allowed(KEY + '/cryptoKeyVersions/1', allowed)
+  assert not kms_key_allowed(KEY + '/cryptoKeyVersions/2', allowed)
+  assert not kms_key_allowed(KEY, allowed)
+
+
+def pem(private_key):
+  return private_key.public_key().public_bytes(
+      serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+
+
+def test_verifies_ec_signature():
+  key = ec.generate_private_key(ec.SECP256R1())
+  digest = hashlib.sha256(b'payload').digest()
+  signature = key.sign(digest, ec.ECDSA(Prehashed(hashes.SHA256())))
+  verifier = AsymmetricVerifier(pem(key), 'EC_SIGN_P256_SHA256')
+  assert verifier.verify(digest, signature)
+  assert not verifier.verify(hashlib.sha256(b'other').digest(), signature)
+
+
+def test_verifies_rsa_pss_signature():
+  key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+  digest = hashlib.sha256(b'payload').digest()
+  signature = key.sign(digest, PSS(mgf=MGF1(hashes.SHA256()), salt_length=32), Prehashed(hashes.SHA256()))
+  verifier = AsymmetricVerifier(pem(key), 'RSA_SIGN_PSS_2048_SHA256')
+  assert verifier.verify(digest, signature)
+  assert not verifier.verify(digest, signature[:-1] + bytes([signature[-1] ^ 1]))
+
+
+def test_rejects_unsupported_algorithm():
+  with pytest.raises(ValueError):
+    AsymmetricVerifier(pem(ec.generate_private_key(ec.SECP256R1())), 'RSA_SIGN_PKCS1_2048_SHA256')
@@ -0,0 +1,16 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_replay_runs_every_scheme(tmp_path):
+  output = tmp_path / 'results.json'
+  subprocess.check_call([sys.executable, os.path.join(ROOT, 'bench', 'replay.py'), '--messages', '50',
+                         '--kms_latency_ms', '0', '--http_latency_ms', '0', '--output', str(output)])
+  with open(str(output)) as f:
+    results = json.load(f)
+  assert sorted(r['scheme'] for r in results) == ['kms', 'kms_dek', 'svc', 'symmetric']
+  assert all(r['messages'] == 50 and r['errors'] == 0 for r in results)
@@ -0,0 +1,25 @@
+import argparse
+
+from common.cli import add_publisher_args, add_subscriber_args
+from common.load import ordering_key
+
+
+def test_subscriber_args_leave_out_what_the_script_lacks():
+  parser = argparse.ArgumentParser()
+  add_subscriber_args(parser, negative_cache=False, trace_slowest=False)
+  args = parser.parse_args([])
+  assert args.replay_window == 0 and args.max_failures == 5 and args.grpc_keepalive_ms == 30000
+  assert not hasattr(args, 'negative_ttl') and not hasattr(args, 'trace_slowest') and not hasattr(args, 'grpc_channels')
+
+
+def test_publisher_args_with_grpc_pool():
+  parser = argparse.ArgumentParser()
+  add_publisher_args(parser, grpc_pool=True)
+  args = parser.parse_args(['--load_rate', '10', '--ordering_key', 'k'])
+  assert args.load_rate == 10 and args.grpc_channels == 1 and args.grpc_max_streams == 100
+
+
+def test_ordering_key_per_load_key():
+  assert ordering_key(None, {'load_key': '1'}) == ''
+  assert ordering_key('k', {}) == 'k'
+  assert ordering_key('k', {'load_key': '1'}) == 'k-1'
@@ -0,0 +1,14 @@
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+
+from common.clients import ClientRegistry
+
+
+def test_registry_knows_each_clients_credentials(monkeypatch):
+  credentials = AnonymousCredentials()
+  monkeypatch.delenv('PUBSUB_EMULATOR_HOST', raising=False)
+  monkeypatch.setattr(google.auth, 'default', lambda *args, **kwargs: (credentials, 'project'))
+  clients = ClientRegistry(channels=2)
+  assert clients.credentials(clients.subscriber()) is credentials
+  assert clients.credentials(clients.kms()) is credentials
+  assert clients.credentials(object()) is None
@@ -0,0 +1,166 @@
+import base64
+
+import pytest
+import tink
+from tink.proto import tink_pb2
+
+from common.crypto import AESCipher, HMACFunctions, KEY_TEMPLATES, RSACipher, compact_key, expand_key, fastest_template
+
+
+@pytest.mark.parametrize('template', KEY_TEMPLATES['aead'])
+def test_aead_templates_round_trip(template):
+  cipher = AESCipher(encoded_key=None, template=template)
+  # the key type travels in the keyset, so a reader needs no template
+  restored = AESCipher(encoded_key=cipher.getKey())
+  assert restored.decrypt_bytes(cipher.encrypt(b'data', 'aad'), 'aad') == b'data'
+
+
+@pytest.mark.parametrize('template', KEY_TEMPLATES['mac'])
+def test_mac_templates_round_trip(template):
+  mac = HMACFunctions(encoded_key=None, template=template)
+  restored = HMACFunctions(encoded_key=mac.getKey())
+  assert restored.verify(b'data', base64.b64decode(mac.hash(b'data')))
+
+
+def test_fastest_template_picks_an_approved_template():
+  assert fastest_template('aead', seconds=0.01) in KEY_TEMPLATES['aead']
+  assert fastest_template('mac', names=['HMAC_SHA512_256BITTAG'], seconds=0.01) == 'HMAC_SHA512_256BITTAG'
+  with pytest.raises(ValueError):
+    AESCipher(encoded_key=None, template='AES128_EAX')
+
+
+@pytest.mark.parametrize('template', KEY_TEMPLATES['aead'])
+def test_compact_aead_key_round_trip(template):
+  cipher = AESCipher(encoded_key=None, template=template)
+  compact = compact_key(cipher.getKey())
+  assert len(compact) == 6 + 32
+  restored = AESCipher(encoded_key=expand_key(compact))
+  assert restored.decrypt_bytes(cipher.encrypt(b'data', 'aad'), 'aad') == b'data'
+
+
+@pytest.mark.parametrize('template', KEY_TEMPLATES['mac'])
+def test_compact_mac_key_round_trip(template):
+  mac = HMACFunctions(encoded_key=None, template=template)
+  restored = HMACFunctions(encoded_key=expand_key(compact_key(mac.getKey())))
+  assert restored.verify(b'data', base64.b64decode(mac.hash(b'data')))
+  assert not restored.verify(b'other', base64.b64decode(mac.hash(b'data')))
+
+
+def test_expand_key_passes_keysets_through():
+  encoded_key = AESCipher(encoded_key=None).getKey()
+  assert expand_key(encoded_key.encode('utf-8')) == encoded_key.encode('utf-8')
+
+
+def test_expand_key_rejects_bad_keys():
+  with pytest.raises(ValueError):
+    expand_key(b'\x01\x01')
+  with pytest.raises(ValueError):
+    expand_key(b'\x01\x63\x00\x00\x00\x01' + bytes(32))
+
+
+def test_compact_key_needs_one_key():
+  keyset = tink_pb2.Keyset.FromString(base64.b64decode(AESCipher(encoded_key=None).getKey()))
+  second = keyset.key.add()
+  second.CopyFrom(keyset.key[0])
+  second.key_id += 1
+  assert compact_key(base64.b64encode(keyset.SerializeToString())) is None
+
+
+def test_compact_key_needs_tink_prefix():
+  keyset = tink_pb2.Keyset.FromString(base64.b64decode(AESCipher(encoded_key=None).getKey()))
+  keyset.key[0].output_prefix_type = tink_pb2.RAW
+  assert compact_key(base64.b64encode(keyset.SerializeToString())) is None
+
+
+def test_encrypt_many_decrypts_with_tink():
+  cipher = AESCipher(encoded_key=None)
+  plaintexts = [b'a' * n for n in (0, 1, 100, 5000)]
+  ciphertexts, errors = cipher.encrypt_many(plaintexts, associated_data='aad')
+  assert not errors
+  assert [cipher.decrypt_bytes(c, 'aad') for c in ciphertexts] == plaintexts
+
+
+def test_batch_methods_take_str():
+  cipher = AESCipher(encoded_key=None)
+  ciphertexts, errors = cipher.encrypt_many(['h\u00e9llo', b'bytes'], associated_data='aad')
+  assert not errors
+  plaintexts, errors = cipher.decrypt_many([c.decode('utf-8') for c in ciphertexts], associated_data='aad')
+  assert not errors
+  assert plaintexts == ['h\u00e9llo'.encode('utf-8'), b'bytes']
+  mac = HMACFunctions(encoded_key=None)
+  tags, errors = mac.hash_many(['h\u00e9llo'])
+  assert not errors
+  assert tags == [mac.hash('h\u00e9llo'.encode('utf-8'))]
+
+
+def test_decrypt_many_reports_errors():
+  cipher = AESCipher(encoded_key=None)
+  ciphertexts = [cipher.encrypt(p, 'aad').encode('utf-8') for p in (b'one', b'two', b'three')]
+  ciphertexts[1] = AESCipher(encoded_key=None).encrypt(b'two', 'aad').encode('utf-8')
+  plaintexts, errors = cipher.decrypt_many(ciphertexts, associated_data='aad')
+  assert plaintexts[0] == b'one' and plaintexts[2] == b'three'
+  assert plaintexts[1] is None and list(errors) == [1]
+
+
+def test_decrypt_many_into_buffer():
+  cipher = AESCipher(encoded_key=None)
+  plaintexts = [b'x' * 10, b'y' * 20]
+  ciphertexts, _ = cipher.encrypt_many(plaintexts)
+  buffer = bytearray(sum(len(c) for c in ciphertexts))
+  decrypted, errors = cipher.decrypt_many(ciphertexts, buffer=buffer)
+  assert not errors
+  assert [bytes(d) for d in decrypted] == plaintexts
+
+
+def test_batch_runs_on_threads():
+  cipher = AESCipher(encoded_key=None)
+  plaintexts = [bytes(4096)] * 600
+  ciphertexts, errors = cipher.encrypt_many(plaintexts, workers=4, encoded=False)
+  assert not errors
+  plaintexts, errors = cipher.decrypt_many(ciphertexts, workers=4, encoded=False)
+  assert not errors and all(p == bytes(4096) for p in plaintexts)
+
+
+def test_hash_many_and_verify_many():
+  mac = HMACFunctions(encoded_key=None)
+  messages = [b'one', b'two', b'three']
+  tags, errors = mac.hash_many(messages)
+  assert not errors
+  assert tags == [mac.hash(m) for m in messages]
+  raw_tags = [base64.b64decode(t) for t in tags]
+  raw_tags[2] = raw_tags[0]
+  results, errors = mac.verify_many(messages, raw_tags)
+  assert not errors
+  assert results == [True, True, False]
+
+
+def test_rsa_public_key_cipher_wraps_for_private_key():
+  from cryptography.hazmat.primitives.asymmetric import rsa
+  private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+  wrapper = RSACipher(public_key=private_key.public_key())
+  assert RSACipher(private_key=private_key).decrypt_bytes(wrapper.encrypt(b'dek')) == b'dek'
+
+
+def test_decrypt_bytes_takes_bytes_like_data():
+  cipher = AESCipher(encoded_key=None)
+  ciphertext = cipher.encrypt(b'\x00\xff', 'aad')
+  for data in (ciphertext, ciphertext.encode('utf-8'), memoryview(ciphertext.encode('utf-8'))):
+    assert cipher.decrypt_bytes(data, b'aad') == b'\x00\xff'
+
+
+def test_decrypt_into_writes_the_buffer():
+  cipher = AESCipher(encoded_key=None)
+  buffer = bytearray(64)
+  plaintext = cipher.decrypt_into(cipher.encrypt(b'data', 'aad'), 'aad', buffer)
+  assert plaintext == b'data' and buffer[:4] == b'data'
+  tampered = bytearray(base64.b64decode(cipher.encrypt(b'data', 'aad')))
+  tampered[-1] ^= 1
+  with pytest.raises(tink.TinkError):
+    cipher.decrypt_into(base64.b64encode(bytes(tampered)), 'aad', buffer)
+
+
+def test_verify_takes_bytes_like_data():
+  mac = HMACFunctions(encoded_key=None)
+  tag = base64.b64decode(mac.hash(b'data'))
+  assert mac.verify(memoryview(b'data'), memoryview(tag))
+  assert not mac.verify(bytearray(b'other'), tag)
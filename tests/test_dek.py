@@ -0,0 +1,133 @@
+import base64
+import os
+import threading
+import time
+
+import pytest
+from tink import aead
+
+from common.crypto import AESCipher, HMACFunctions, compact_key, expand_key
+from common.dek import PersistentKeyCache, RollingKeyset, TenantScheduler, derived_keyset, new_master_secret, wrapped_key_id
+
+
+@pytest.fixture
+def kek_file(tmp_path):
+  path = tmp_path / 'kek'
+  path.write_text(AESCipher(encoded_key=None).getKey())
+  os.chmod(path, 0o600)
+  return str(path)
+
+
+def test_persistent_cache_round_trip(tmp_path, kek_file):
+  cache = PersistentKeyCache(str(tmp_path / 'cache.db'), kek_path=kek_file)
+  cache.put('tenant/id', b'encoded key')
+  assert cache.get('tenant/id') == b'encoded key'
+  assert cache.get('tenant/other') is None
+  # another process on the host sees the same entries
+  assert PersistentKeyCache(str(tmp_path / 'cache.db'), kek_path=kek_file).get('tenant/id') == b'encoded key'
+
+
+def test_persistent_cache_keeps_compact_keys(tmp_path, kek_file):
+  cipher = AESCipher(encoded_key=None)
+  key = compact_key(cipher.getKey())
+  cache = PersistentKeyCache(str(tmp_path / 'cache.db'), kek_path=kek_file)
+  cache.put('tenant/id', key)
+  assert cache.get('tenant/id') == key
+  ciphertext = cipher.encrypt(b'data', 'aad')
+  assert AESCipher(encoded_key=expand_key(cache.get('tenant/id'))).decrypt_bytes(ciphertext, 'aad') == b'data'
+
+
+def test_persistent_cache_expires(tmp_path, kek_file):
+  cache = PersistentKeyCache(str(tmp_path / 'cache.db'), kek_path=kek_file, max_age_seconds=-1)
+  cache.put('tenant/id', b'encoded key')
+  assert cache.get('tenant/id') is None
+
+
+def test_persistent_cache_needs_a_kek(tmp_path):
+  with pytest.raises(ValueError):
+    PersistentKeyCache(str(tmp_path / 'cache.db'))
+  with pytest.raises(FileNotFoundError):
+    PersistentKeyCache(str(tmp_path / 'cache.db'), kek_path=str(tmp_path / 'missing'))
+  assert not os.path.exists(str(tmp_path / 'missing'))
+
+
+def test_persistent_cache_refuses_readable_kek(tmp_path, kek_file):
+  os.chmod(kek_file, 0o644)
+  with pytest.raises(ValueError):
+    PersistentKeyCache(str(tmp_path / 'cache.db'), kek_path=kek_file)
+
+
+def test_wrapped_key_id_is_a_short_stable_hash():
+  wrapped = base64.b64encode(b'wrapped dek').decode('utf-8')
+  key_id = wrapped_key_id(wrapped)
+  assert len(key_id) == 16
+  assert wrapped_key_id(wrapped.encode('utf-8')) == key_id
+  assert wrapped_key_id(base64.b64encode(b'another dek').decode('utf-8')) != key_id
+
+
+def test_rolling_keyset_keeps_keys_in_use(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(time, 'time', lambda: now[0])
+  cipher = AESCipher(encoded_key=None)
+  keyset = RollingKeyset(aead.Aead, max_age_seconds=20)
+  key_ids = keyset.add(cipher.getKey())
+  ciphertext = cipher.encrypt(b'data', 'aad')
+  for _ in range(3):
+    now[0] += 15
+    assert keyset.decrypt_bytes(ciphertext, 'aad') == b'data'
+    keyset.prune()
+  assert keyset.contains(key_ids)
+  now[0] += 21
+  keyset.prune()
+  assert not keyset.contains(key_ids)
+  assert not keyset.used
+
+
+def test_derived_keys_match_on_both_sides():
+  master_secret = new_master_secret()
+  publisher = AESCipher(encoded_key=derived_keyset(master_secret, 'aead', 'A', 7))
+  ciphertext = publisher.encrypt(b'data', 'A')
+  subscriber = AESCipher(encoded_key=derived_keyset(master_secret, 'aead', 'A', 7))
+  assert subscriber.decrypt(ciphertext, 'A') == 'data'
+  assert derived_keyset(master_secret, 'aead', 'B', 7) != derived_keyset(master_secret, 'aead', 'A', 7)
+  assert derived_keyset(master_secret, 'aead', 'A', 8) != derived_keyset(master_secret, 'aead', 'A', 7)
+  mac = HMACFunctions(encoded_key=derived_keyset(master_secret, 'mac', 'A', 7))
+  assert mac.verify(b'data', base64.b64decode(mac.hash(b'data')))
+
+
+def test_tenant_scheduler_is_weighted_round_robin():
+  scheduler = TenantScheduler(workers=1, weights={'A': 2})
+  started, release, done = threading.Event(), threading.Event(), threading.Event()
+  order = []
+
+  def block():
+    started.set()
+    release.wait()
+
+  scheduler.submit('A', block)
+  started.wait()
+  for item in ('A1', 'A2', 'A3', 'A4'):
+    scheduler.submit('A', order.append, item)
+  for item in ('B1', 'B2'):
+    scheduler.submit('B', order.append, item)
+  scheduler.submit('B', done.set)
+  assert scheduler.pending('A') == 4
+  release.set()
+  assert done.wait(5)
+  assert order == ['A1', 'A2', 'B1', 'A3', 'A4', 'B2']
+
+
+def test_rolling_keyset_decrypt_many_touches_decrypted_keys(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(time, 'time', lambda: now[0])
+  good, bad = AESCipher(encoded_key=None), AESCipher(encoded_key=None)
+  keyset = RollingKeyset(aead.Aead, max_age_seconds=20)
+  good_ids, bad_ids = keyset.add(good.getKey()), keyset.add(bad.getKey())
+  now[0] += 15
+  # str ciphertexts, and one whose key is loaded but whose associated data does not match
+  plaintexts, errors = keyset.decrypt_many([good.encrypt(b'data', 'aad'), bad.encrypt(b'data', 'other')], 'aad')
+  assert plaintexts[0] == b'data' and list(errors) == [1]
+  now[0] += 10
+  keyset.prune()
+  assert keyset.contains(good_ids)
+  assert not keyset.contains(bad_ids)
@@ -0,0 +1,120 @@
+import json
+import time
+
+import pytest
+
+from common.delivery import NegativeCache, Quarantine, Warmup
+
+
+def test_negative_cache_forgets_after_ttl(monkeypatch):
+  now = [100.0]
+  monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+  cache = NegativeCache(ttl=10)
+  assert cache.get('key') is None
+  cache.add('key', 'permission denied')
+  assert cache.get('key') == 'permission denied'
+  now[0] += 10
+  assert cache.get('key') is None
+  assert 'key' not in cache.entries
+
+
+def test_negative_cache_is_bounded_and_can_be_off():
+  cache = NegativeCache(ttl=10, max_len=2)
+  for ref in ('a', 'b', 'c'):
+    cache.add(ref, 'bad')
+  assert list(cache.entries) == ['b', 'c']
+  cache = NegativeCache(ttl=0)
+  cache.add('a', 'bad')
+  assert cache.get('a') is None
+
+
+def test_reject_backs_off(message, tmp_path):
+  quarantine = Quarantine(path=str(tmp_path / 'dead.jsonl'), max_failures=5, base_delay=10, max_delay=30)
+  m = message()
+  delays = []
+  for _ in range(4):
+    assert not quarantine.reject(m, 'bad')
+    delays.append(m.calls[-2][1])
+    assert m.calls[-1] == ('drop',)
+  assert delays == [10, 20, 30, 30]
+  assert not (tmp_path / 'dead.jsonl').exists()
+
+
+def test_reject_quarantines(message, tmp_path):
+  path = tmp_path / 'dead.jsonl'
+  quarantine = Quarantine(path=str(path), max_failures=2)
+  m = message(data=b'\x00\x01')
+  quarantine.reject(m, 'first')
+  assert quarantine.reject(m, 'second')
+  assert m.calls[-1] == ('ack',)
+  record = json.loads(path.read_text())
+  assert record['failures'] == 2
+  assert record['reason'] == 'second'
+  assert record['data'] == 'AAE='
+  assert m.message_id not in quarantine.failures
+
+
+def test_reject_uses_delivery_attempt(message, tmp_path):
+  quarantine = Quarantine(path=str(tmp_path / 'dead.jsonl'), max_failures=5)
+  assert quarantine.reject(message(delivery_attempt=5), 'bad')
+
+
+def test_failures_are_bounded(message, tmp_path):
+  quarantine = Quarantine(path=str(tmp_path / 'dead.jsonl'), max_len=3)
+  for i in range(5):
+    quarantine.reject(message(message_id=str(i)), 'bad')
+  assert list(quarantine.failures) == ['2', '3', '4']
+
+
+def test_failed_message_holds_its_ordering_key(message, tmp_path):
+  quarantine = Quarantine(path=str(tmp_path / 'dead.jsonl'), base_delay=10)
+  head, following, other = message(message_id='1'), message(message_id='2'), message(message_id='3')
+  head.ordering_key = following.ordering_key = 'key'
+  other.ordering_key = 'other'
+  assert not quarantine.held(head)
+  quarantine.reject(head, 'bad')
+  # later messages with the key go back after the same delay, without being processed or counted
+  assert quarantine.held(following)
+  assert following.calls == [('modify_ack_deadline', 10), ('drop',)]
+  assert following.message_id not in quarantine.failures
+  assert not quarantine.held(other)
+  # the failed message itself comes back, and once it is through the key is free again
+  assert not quarantine.held(head)
+  assert not quarantine.held(following)
+
+
+def test_ordering_key_hold_lapses(message, tmp_path, monkeypatch):
+  now = [100.0]
+  monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+  quarantine = Quarantine(path=str(tmp_path / 'dead.jsonl'), base_delay=10)
+  head, following = message(message_id='1'), message(message_id='2')
+  head.ordering_key = following.ordering_key = 'key'
+  quarantine.reject(head, 'bad')
+  now[0] += 21
+  assert not quarantine.held(following)
+
+
+def test_warmup_retries_a_check_then_reports_ready():
+  calls = []
+  def flaky():
+    calls.append(1)
+    if len(calls) < 2:
+      raise ValueError('not yet')
+  warmup = Warmup(attempts=3, delay=0)
+  warmup.add('flaky', flaky)
+  assert warmup.status()[0] == 503
+  warmup.run()
+  status, body = warmup.status()
+  assert status == 200 and 'flaky ok' in body
+  assert len(calls) == 2
+
+
+def test_warmup_gives_up_after_its_attempts():
+  def broken():
+    raise ValueError('no')
+  warmup = Warmup(attempts=2, delay=0)
+  warmup.add('broken', broken)
+  with pytest.raises(ValueError):
+    warmup.run()
+  status, body = warmup.status()
+  assert status == 503 and 'broken failed: no' in body
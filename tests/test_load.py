@@ -0,0 +1,30 @@
+import concurrent.futures
+
+from common.load import LoadGenerator
+from common.metrics import LatencyHistogram
+
+
+def test_histogram_error_is_bounded():
+  histogram = LatencyHistogram(sub_buckets=32)
+  for ms in range(1, 1001):
+    histogram.record(ms / 1000.0)
+  assert histogram.count == 1000
+  for q in (0.5, 0.9, 0.99, 1.0):
+    expected = q * 1000 / 1000.0
+    assert expected <= histogram.percentile(q) <= expected * (1 + 1 / 32.0) + 1e-6
+  assert 'percentile' in histogram.render()
+
+
+def test_load_generator_counts_every_publish():
+  def publish(cleartext_message, attributes):
+    assert cleartext_message['attributes']['load_key'] == attributes['load_key']
+    future = concurrent.futures.Future()
+    if len(cleartext_message['data']) == 10:
+      future.set_exception(ValueError('rejected'))
+    else:
+      future.set_result('1')
+    return future
+  load = LoadGenerator(publish, rate=200, duration=0.25, sizes='10:1,20:3', attributes=4, publishers=2)
+  histogram = load.run()
+  assert load.sent == 50 and load.outstanding == 0
+  assert histogram.count == load.sent - load.errors
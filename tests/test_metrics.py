@@ -0,0 +1,56 @@
+import os
+import time
+
+from common.metrics import Metrics, Profiler
+
+
+def test_stages_errors_and_caches_render():
+  metrics = Metrics(scheme='kms', role='subscriber')
+  with metrics.stage('kms_decrypt'):
+    time.sleep(0.002)
+  try:
+    with metrics.stage('kms_decrypt'):
+      raise ValueError('denied')
+  except ValueError:
+    pass
+  metrics.cache('key', False)
+  metrics.cache('key', True)
+  text = metrics.render()
+  assert 'pubsub_crypto_stage_seconds_bucket{le="0.001",role="subscriber",scheme="kms",stage="kms_decrypt"} 1' in text
+  assert 'pubsub_crypto_stage_seconds_count{role="subscriber",scheme="kms",stage="kms_decrypt"} 2' in text
+  assert 'pubsub_crypto_stage_errors_total{role="subscriber",scheme="kms",stage="kms_decrypt"} 1' in text
+  assert 'pubsub_crypto_cache_requests_total{cache="key",result="hit",role="subscriber",scheme="kms"} 1' in text
+
+
+def test_in_flight_gauge():
+  metrics = Metrics()
+  with metrics.in_flight():
+    assert metrics.gauges['messages'] == 1
+  assert metrics.gauges['messages'] == 0
+
+
+def test_profiler_keeps_the_slowest_messages():
+  metrics = Metrics()
+  profiler = Profiler(slowest=2)
+  profiler.attach(metrics)
+  for message_id, seconds in (('a', 0.001), ('b', 0.03), ('c', 0.02)):
+    with profiler.trace(message_id):
+      with metrics.stage('aead_decrypt'):
+        time.sleep(seconds)
+  lines = profiler.report().splitlines()
+  assert [line.split()[0] for line in lines] == ['b', 'c']
+  assert 'aead_decrypt=' in lines[0]
+  assert metrics.paths['/slowest']() == profiler.report()
+
+
+def test_profiler_writes_collapsed_stacks(tmp_path):
+  profiler = Profiler(output_dir=str(tmp_path), seconds=0.05)
+  path = profiler.start()
+  assert profiler.start() is None
+  with profiler.sampling:
+    pass
+  assert os.path.dirname(path) == str(tmp_path)
+  with open(path) as f:
+    samples = dict(line.rsplit(' ', 1) for line in f)
+  # threads left behind by other tests are sampled too
+  assert any(stack.startswith('MainThread;') and int(count) > 0 for stack, count in samples.items())
@@ -0,0 +1,152 @@
+import concurrent.futures
+import io
+import json
+import os
+
+import pytest
+import tink
+
+from common.crypto import AESCipher
+from common.payloads import FieldSchema, LocalBlobStore, RecordAggregator, StreamingCipher, blob_aad, check_field_seal, decrypt_fields, frame_aad, open_blob, pack_records, signed_frame, unpack_records
+
+
+def test_records_round_trip():
+  records = [b'', b'a', bytes(range(256)) * 10]
+  assert unpack_records(pack_records(records)) == records
+  assert unpack_records(b'') == []
+
+
+@pytest.mark.parametrize('frame', [b'\x00\x00\x00', b'\x00\x00\x00\x05abc'])
+def test_truncated_records(frame):
+  with pytest.raises(ValueError):
+    unpack_records(frame)
+
+
+def test_schema_rejects_overlap():
+  with pytest.raises(ValueError):
+    FieldSchema({'sensitive': ['data'], 'routing': ['data']})
+
+
+def test_fields_round_trip():
+  schema = FieldSchema({'sensitive': ['data', 'attributes.a', 'attributes.missing'], 'routing': ['attributes.b']})
+  cipher = AESCipher(encoded_key=None)
+  document = {'data': {'n': 1}, 'attributes': {'a': 'secret', 'b': 'route'}}
+  data, attributes = schema.encrypt(cipher, document, 'tenant')
+  check_field_seal(cipher, data, attributes, 'tenant')
+  assert attributes.pop('field_seal')
+  assert attributes == {'b': 'route', 'encrypted_fields': 'data,attributes.a'}
+  encrypted = json.loads(data)
+  assert encrypted['attributes']['b'] == 'route'
+  assert encrypted['attributes']['a'] != 'secret'
+  assert document['attributes']['a'] == 'secret'
+  assert decrypt_fields(cipher, encrypted, ['data', 'attributes.a'], 'tenant') == document
+
+
+def test_fields_are_bound_to_path_and_tenant():
+  schema = FieldSchema({'sensitive': ['attributes.a', 'attributes.b']})
+  cipher = AESCipher(encoded_key=None)
+  data, _ = schema.encrypt(cipher, {'attributes': {'a': 1, 'b': 2}}, 'tenant')
+  encrypted = json.loads(data)
+  with pytest.raises(tink.TinkError):
+    decrypt_fields(cipher, encrypted, ['attributes.a'], 'other')
+  encrypted['attributes']['a'], encrypted['attributes']['b'] = encrypted['attributes']['b'], encrypted['attributes']['a']
+  with pytest.raises(tink.TinkError):
+    decrypt_fields(cipher, encrypted, ['attributes.a'], 'tenant')
+
+
+def test_field_seal_covers_the_whole_message():
+  schema = FieldSchema({'sensitive': ['attributes.a']})
+  cipher = AESCipher(encoded_key=None)
+  data, attributes = schema.encrypt(cipher, {'attributes': {'a': 1, 'epoch_time': 100}}, 'tenant')
+  other, _ = schema.encrypt(cipher, {'attributes': {'a': 2, 'epoch_time': 100}}, 'tenant')
+  edited = json.loads(data)
+  edited['attributes']['epoch_time'] = 200
+  moved = json.loads(data)
+  moved['attributes']['a'] = json.loads(other)['attributes']['a']
+  for tampered in (json.dumps(edited), json.dumps(moved)):
+    with pytest.raises(tink.TinkError):
+      check_field_seal(cipher, tampered, attributes, 'tenant')
+  with pytest.raises(tink.TinkError):
+    check_field_seal(cipher, data, dict(attributes, encrypted_fields=''), 'tenant')
+  with pytest.raises(tink.TinkError):
+    check_field_seal(cipher, data, attributes, 'other')
+  with pytest.raises(ValueError):
+    check_field_seal(cipher, data, {'encrypted_fields': attributes['encrypted_fields']}, 'tenant')
+
+
+def test_frame_count_is_authenticated():
+  cipher = AESCipher(encoded_key=None)
+  frame = pack_records([b'one', b'two'])
+  ciphertext = cipher.encrypt(frame, frame_aad('tenant', 2))
+  assert unpack_records(cipher.decrypt_bytes(ciphertext, frame_aad('tenant', '2'))) == [b'one', b'two']
+  for associated_data in (frame_aad('tenant', 3), 'tenant'):
+    with pytest.raises(tink.TinkError):
+      cipher.decrypt_bytes(ciphertext, associated_data)
+
+
+def test_signed_frame_differs_from_payload():
+  frame = pack_records([b'{}'])
+  assert signed_frame('tenant', 1, frame) != signed_frame('tenant', 2, frame)
+  assert signed_frame('tenant', 1, frame)[:1] == b'\x00'
+
+
+def test_aggregator_closes_frames_on_count_and_size():
+  frames = []
+
+  def publish_frame(frame, count):
+    frames.append((unpack_records(frame), count))
+    future = concurrent.futures.Future()
+    future.set_result(str(len(frames)))
+    return future
+
+  aggregator = RecordAggregator(publish_frame, max_bytes=20, max_records=2, max_latency=60)
+  futures = [aggregator.add(record) for record in (b'a', b'b', b'0123456789', b'9876543210')]
+  assert frames == [([b'a', b'b'], 2), ([b'0123456789'], 1)]
+  aggregator.flush()
+  assert frames[-1] == ([b'9876543210'], 1)
+  assert [f.result() for f in futures] == ['1', '1', '2', '3']
+
+
+def test_aggregator_fails_every_record_of_a_frame():
+  def publish_frame(frame, count):
+    raise ValueError('publish failed')
+
+  aggregator = RecordAggregator(publish_frame, max_records=2, max_latency=60)
+  futures = [aggregator.add(b'a'), aggregator.add(b'b')]
+  for future in futures:
+    with pytest.raises(ValueError):
+      future.result()
+
+
+def offload(store, plaintext, epoch_time='100'):
+  sc = StreamingCipher(encoded_key=None)
+  ref = store.new_ref()
+  with store.writer(ref) as f:
+    digest = sc.encrypt_stream(io.BytesIO(plaintext), f, blob_aad('tenant', ref, epoch_time))
+  return sc.getKey(), {'blob_ref': ref, 'blob_sha256': digest, 'epoch_time': epoch_time}
+
+
+def test_blob_is_handed_on_as_a_file(tmp_path):
+  store = LocalBlobStore(str(tmp_path))
+  plaintext = os.urandom(3 * StreamingCipher.CHUNK_SIZE + 5)
+  key, attributes = offload(store, plaintext)
+  with open_blob(store, key, 'tenant', attributes) as payload:
+    assert payload.read() == plaintext
+
+
+def test_blob_is_bound_to_its_message(tmp_path):
+  store = LocalBlobStore(str(tmp_path))
+  key, attributes = offload(store, b'payload')
+  # a rewritten epoch_time attribute, another tenant or a stale digest yield no file
+  with pytest.raises(tink.TinkError):
+    open_blob(store, key, 'tenant', dict(attributes, epoch_time='200'))
+  with pytest.raises(tink.TinkError):
+    open_blob(store, key, 'other', attributes)
+  with pytest.raises(ValueError):
+    open_blob(store, key, 'tenant', dict(attributes, blob_sha256='0' * 64))
+
+
+def test_blob_refs_are_checked(tmp_path):
+  store = LocalBlobStore(str(tmp_path))
+  with pytest.raises(ValueError):
+    store.reader('../' + 'a' * 29)
@@ -0,0 +1,109 @@
+import contextlib
+import threading
+import time
+
+from common.replay import ReplayChecks, ReplayGuard, stamped
+
+
+def test_fresh_message_passes(message):
+  assert ReplayGuard().check(message()) is None
+
+
+def test_added_message_is_a_replay(message):
+  guard = ReplayGuard()
+  m = message()
+  guard.add(m)
+  assert guard.check(m) == 'data already seen'
+  assert guard.check(message(data=b'other')) is None
+
+
+def test_check_and_add(message):
+  guard = ReplayGuard()
+  m = message()
+  assert guard.check_and_add(m) is None
+  assert guard.check_and_add(m) == 'data already seen'
+
+
+def test_concurrent_deliveries_pass_once(message):
+  guard = ReplayGuard()
+  m = message()
+  results = []
+  start = threading.Barrier(8)
+
+  def deliver():
+    start.wait()
+    results.append(guard.check_and_add(m))
+  threads = [threading.Thread(target=deliver) for _ in range(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert results.count(None) == 1
+
+
+def test_epoch_time_attribute(message):
+  guard = ReplayGuard(window=60)
+  assert guard.check(message(attributes={})) == 'no epoch_time attribute'
+  assert guard.check(message(attributes={'epoch_time': 'x'})).startswith('bad epoch_time')
+  stale = str(int(time.time()) - 120)
+  assert 'from now' in guard.check(message(attributes={'epoch_time': stale}))
+
+
+def test_check_inner(message):
+  guard = ReplayGuard(window=60)
+  now = int(time.time())
+  assert guard.check_inner(b'not json') is None
+  assert guard.check_inner({'attributes': {'epoch_time': now}}) is None
+  assert 'payload epoch_time' in guard.check_inner({'attributes': {'epoch_time': now - 120}})
+
+
+def test_old_filters_expire(message, monkeypatch):
+  guard = ReplayGuard(window=60)
+  m = message()
+  guard.add(m)
+  later = time.time() + 3 * 60
+  monkeypatch.setattr(time, 'time', lambda: later)
+  m.attributes['epoch_time'] = str(int(later))
+  assert guard.check(m) is None
+  assert not guard.filters
+
+
+class FakeMetrics(object):
+
+    def __init__(self):
+      self.errors = []
+
+    def error(self, name):
+      self.errors.append(name)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+      yield
+
+
+def test_checks_drop_replays(message):
+  metrics = FakeMetrics()
+  checks = ReplayChecks(ReplayGuard(), metrics)
+  m = message(data=b'{"attributes": {"epoch_time": 0}}')
+  assert not checks.replayed(m)
+  # a stale inner epoch_time is dropped: acked, not retried
+  assert not checks.accepted(m, m.data)
+  assert m.calls == [('ack',)]
+  fresh = message()
+  assert checks.accepted(fresh, fresh.data)
+  assert checks.replayed(message())
+  assert metrics.errors == ['replay', 'replay']
+
+
+def test_checks_pass_everything_when_off(message):
+  checks = ReplayChecks(None, FakeMetrics())
+  m = message(attributes={})
+  assert not checks.replayed(m)
+  assert checks.accepted(m, m.data)
+  assert checks.accepted(m, m.data)
+  assert m.calls == []
+
+
+def test_stamped_keeps_an_epoch_time_already_set():
+  assert stamped({'a': 'b'})['epoch_time'].isdigit()
+  assert stamped({'epoch_time': '5'}) == {'epoch_time': '5'}